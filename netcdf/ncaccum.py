@@ -0,0 +1,427 @@
+"""
+Mergeable streaming accumulators for computing statistics over the chunks of
+a netcdf variable, e.g. as returned by nciter.iter_chunks.
+
+Each accumulator is updated with one chunk at a time, via its update method,
+and two accumulators of the same kind and configuration can be combined via
+the merge method. The same objects can therefore be used serially, with one
+accumulator per thread followed by a merge, or with nciter.chunk_map_reduce,
+for which suitable mapper and reducer functions are provided by ChunkMapper
+and merge. All arithmetic is carried out in double precision, whatever the
+data type of the variable.
+
+By default an accumulator reduces over all of the variable's dimensions. If
+the keep argument is specified then the dimensions it lists (by index or, if
+a variable rather than a shape is passed, by name) are retained, so that,
+for example, MeanVariance(var, keep='time') yields a time series of spatial
+means. Missing data, i.e. masked values and non-finite values (NaNs and also
+infinities), is excluded from all of the statistics and is counted separately
+by the Count accumulator.
+
+Example:
+
+    mv, mm = MeanVariance(var), MinMax(var)
+    for chunk in iter_chunks(var):
+        mv.update(chunk)
+        mm.update(chunk)
+    print(mv.mean, mv.std(), mm.max, mm.argmax)
+
+or, equivalently, using a pool of worker processes:
+
+    mv, mm = chunk_map_reduce(path, varname, ChunkMapper(MeanVariance(shape),
+        MinMax(shape)), merge)
+"""
+
+import copy
+import math
+
+import numpy as np
+
+try:
+    _string_types = basestring
+except NameError:
+    _string_types = str
+
+
+class Accumulator(object):
+    """
+    Base class for the accumulators defined in this module. The shape argument
+    is the shape of the full variable, or else the variable itself. The keep
+    argument lists the dimensions, if any, which are retained in the results.
+    Subclasses implement the _init, _update and _merge methods.
+    """
+
+    def __init__(self, shape, keep=None):
+        dimensions = getattr(shape, 'dimensions', None)
+        self.shape = tuple(getattr(shape, 'shape', shape))
+        if keep is None:
+            keep = ()
+        elif isinstance(keep, (int, _string_types)):
+            keep = (keep,)
+        keep = [dimensions.index(d) if isinstance(d, _string_types) else d % len(self.shape)
+            for d in keep]
+        self.keep = tuple(sorted(set(keep)))
+        self.result_shape = tuple(self.shape[d] for d in self.keep)
+        self._init()
+
+    def empty(self):
+        """Return a new, empty accumulator with the same configuration as this one."""
+        new = copy.copy(self)
+        new._init()
+        return new
+
+    def update(self, chunk, coords=None):
+        """
+        Update the accumulator with the data in chunk, which may be an NcDataChunk
+        object or else an array, in which case coords gives its location within
+        the variable as a sequence of slices (by default the origin). Returns the
+        accumulator.
+        """
+        if hasattr(chunk, 'coords'):
+            data, mask = chunk.data, getattr(chunk, 'mask', None)
+            if coords is None: coords = chunk.coords
+        else:
+            data, mask = chunk, None
+        if coords is None: coords = [slice(0, n) for n in np.shape(data)]
+        if mask is not None and not np.ma.isMA(data): data = np.ma.MaskedArray(data, mask)
+
+        # Arrange the data as one row per cell of the retained dimensions.
+        data = np.ma.asanyarray(data)
+        axes = self.keep + tuple(d for d in range(data.ndim) if d not in self.keep)
+        block = tuple(data.shape[d] for d in self.keep)
+        values = np.asarray(np.ma.getdata(data), dtype=np.float64).transpose(axes)
+        missing = np.ma.getmaskarray(data).transpose(axes) | ~np.isfinite(values)
+        nrows = int(np.prod(block, dtype=np.int64))
+        values = values.reshape(nrows, -1)
+        valid = ~missing.reshape(nrows, -1)
+
+        starts = [int(coords[d].start or 0) for d in range(data.ndim)]
+        target = tuple(slice(starts[d], starts[d] + data.shape[d]) for d in self.keep)
+        self._update(values, valid, target, block, starts, data.shape)
+        return self
+
+    def merge(self, other):
+        """Merge the state of accumulator other into this one, and return this one."""
+        if type(other) is not type(self) or other.shape != self.shape or other.keep != self.keep:
+            raise ValueError("Cannot merge accumulators of different kinds or configurations.")
+        self._merge(other)
+        return self
+
+    def _init(self):
+        raise NotImplementedError
+
+    def _update(self, values, valid, target, block, starts, chunkshape):
+        raise NotImplementedError
+
+    def _merge(self, other):
+        raise NotImplementedError
+
+
+class Count(Accumulator):
+    """Counts valid and missing (masked, NaN or infinite) values."""
+
+    def _init(self):
+        self.valid = np.zeros(self.result_shape, dtype=np.int64)
+        self.missing = np.zeros(self.result_shape, dtype=np.int64)
+
+    @property
+    def total(self):
+        return self.valid + self.missing
+
+    def _update(self, values, valid, target, block, starts, chunkshape):
+        nvalid = valid.sum(axis=1).reshape(block)
+        self.valid[target] += nvalid
+        self.missing[target] += valid.shape[1] - nvalid
+
+    def _merge(self, other):
+        self.valid += other.valid
+        self.missing += other.missing
+
+
+class MeanVariance(Accumulator):
+    """
+    Computes the count, sum, mean and variance of valid values. Partial results
+    are combined using the pairwise update formulae of Chan et al., which is
+    the parallel form of Welford's algorithm, and the sum is accumulated with
+    Kahan compensation, so that precision is retained over many chunks.
+    """
+
+    def _init(self):
+        self.count = np.zeros(self.result_shape, dtype=np.int64)
+        self._mean = np.zeros(self.result_shape)
+        self._m2 = np.zeros(self.result_shape)
+        self._sum = np.zeros(self.result_shape)
+        self._comp = np.zeros(self.result_shape)
+
+    @property
+    def sum(self):
+        return self._sum - self._comp
+
+    @property
+    def mean(self):
+        return np.where(self.count > 0, self._mean, np.nan)
+
+    def variance(self, ddof=0):
+        """Return the variance, with ddof delta degrees of freedom (0 for the population)."""
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(self.count > ddof, self._m2 / (self.count - ddof), np.nan)
+
+    def std(self, ddof=0):
+        """Return the standard deviation, with ddof delta degrees of freedom."""
+        return np.sqrt(self.variance(ddof))
+
+    def _update(self, values, valid, target, block, starts, chunkshape):
+        n = valid.sum(axis=1)
+        s = np.where(valid, values, 0.0).sum(axis=1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.where(n > 0, s / n, 0.0)
+        m2 = np.where(valid, (values - mean[:,None])**2, 0.0).sum(axis=1)
+        self._combine(target, n.reshape(block), mean.reshape(block), m2.reshape(block),
+            s.reshape(block), 0.0)
+
+    def _merge(self, other):
+        self._combine(Ellipsis, other.count, other._mean, other._m2, other._sum, other._comp)
+
+    def _combine(self, target, nb, meanb, m2b, sumb, compb):
+        na, meana, m2a = self.count[target], self._mean[target], self._m2[target]
+        n = na + nb
+        with np.errstate(invalid='ignore', divide='ignore'):
+            delta = meanb - meana
+            frac = np.where(n > 0, nb / np.maximum(n, 1).astype(np.float64), 0.0)
+            self._mean[target] = meana + delta * frac
+            self._m2[target] = m2a + m2b + delta**2 * na * frac
+        self.count[target] = n
+
+        # Kahan-compensated addition of the sums.
+        y = (sumb - compb) - self._comp[target]
+        t = self._sum[target] + y
+        self._comp[target] = (t - self._sum[target]) - y
+        self._sum[target] = t
+
+
+class MinMax(Accumulator):
+    """
+    Computes the minimum and maximum of valid values, together with their
+    locations. The argmin and argmax attributes are integer arrays of shape
+    result_shape + (ndim,) holding the global index of the first occurrence of
+    the minimum or maximum (in C order), or -1 where there are no valid values.
+    """
+
+    def _init(self):
+        self._min = np.full(self.result_shape, np.inf)
+        self._max = np.full(self.result_shape, -np.inf)
+        self._argmin = np.full(self.result_shape, -1, dtype=np.int64)
+        self._argmax = np.full(self.result_shape, -1, dtype=np.int64)
+
+    @property
+    def min(self):
+        return np.where(self._argmin >= 0, self._min, np.nan)
+
+    @property
+    def max(self):
+        return np.where(self._argmax >= 0, self._max, np.nan)
+
+    @property
+    def argmin(self):
+        return self._unravel(self._argmin)
+
+    @property
+    def argmax(self):
+        return self._unravel(self._argmax)
+
+    def _unravel(self, flat):
+        index = np.full(flat.shape + (len(self.shape),), -1, dtype=np.int64)
+        found = flat >= 0
+        index[found] = np.column_stack(np.unravel_index(flat[found], self.shape))
+        return index
+
+    def _update(self, values, valid, target, block, starts, chunkshape):
+        reduced = [d for d in range(len(chunkshape)) if d not in self.keep]
+        rows = np.unravel_index(np.arange(valid.shape[0]), block) if block else ()
+        any_valid = valid.any(axis=1)
+        for sign, best, arg in ((1, self._min, self._argmin), (-1, self._max, self._argmax)):
+            local = np.argmin(np.where(valid, sign*values, np.inf), axis=1)
+            value = values[np.arange(len(local)), local]
+            cols = np.unravel_index(local, [chunkshape[d] for d in reduced]) if reduced else ()
+            index = [None] * len(chunkshape)
+            for i, d in enumerate(self.keep): index[d] = rows[i] + starts[d]
+            for i, d in enumerate(reduced): index[d] = cols[i] + starts[d]
+            flat = np.where(any_valid, np.ravel_multi_index(index, self.shape), -1)
+            self._combine(sign, best, arg, target, value.reshape(block), flat.reshape(block))
+
+    def _merge(self, other):
+        self._combine(1, self._min, self._argmin, Ellipsis, other._min, other._argmin)
+        self._combine(-1, self._max, self._argmax, Ellipsis, other._max, other._argmax)
+
+    def _combine(self, sign, best, arg, target, value, flat):
+        # Ties are resolved in favour of the lower global index, so that the
+        # result does not depend upon the order in which chunks are processed.
+        cur, curflat = best[target], arg[target]
+        better = (flat >= 0) & ((curflat < 0) | (sign*value < sign*cur) |
+            ((value == cur) & (flat < curflat)))
+        best[target] = np.where(better, value, cur)
+        arg[target] = np.where(better, flat, curflat)
+
+
+class Histogram(Accumulator):
+    """
+    Computes a histogram of valid values using fixed bins, specified either as
+    a number of equal-width bins spanning range (a (min, max) tuple), or as a
+    sequence of bin edges. As with numpy.histogram, all but the last bin are
+    half-open, and the last bin includes its upper edge. Values lying outside
+    the bins are counted in the underflow and overflow attributes.
+    """
+
+    def __init__(self, shape, bins=10, range=None, keep=None):
+        if np.ndim(bins) == 0:
+            if range is None:
+                raise ValueError("A range must be specified along with the number of bins.")
+            self.edges = np.linspace(range[0], range[1], int(bins)+1)
+        else:
+            self.edges = np.asarray(bins, dtype=np.float64)
+        super(Histogram, self).__init__(shape, keep=keep)
+
+    def _init(self):
+        self.counts = np.zeros(self.result_shape + (len(self.edges)-1,), dtype=np.int64)
+        self.underflow = np.zeros(self.result_shape, dtype=np.int64)
+        self.overflow = np.zeros(self.result_shape, dtype=np.int64)
+
+    def _update(self, values, valid, target, block, starts, chunkshape):
+        nbins = len(self.edges) - 1
+        bins = np.searchsorted(self.edges, values, side='right') - 1
+        bins[values == self.edges[-1]] = nbins - 1
+        bins = np.clip(bins, -1, nbins) + 1
+        rows = np.broadcast_to(np.arange(values.shape[0])[:,None], values.shape)
+        counts = np.bincount((rows * (nbins+2) + bins)[valid], minlength=values.shape[0]*(nbins+2))
+        counts = counts.reshape(block + (nbins+2,))
+        self.underflow[target] += counts[...,0]
+        self.overflow[target] += counts[...,-1]
+        self.counts[target] += counts[...,1:-1]
+
+    def _merge(self, other):
+        if not np.array_equal(self.edges, other.edges):
+            raise ValueError("Cannot merge histograms with different bins.")
+        self.counts += other.counts
+        self.underflow += other.underflow
+        self.overflow += other.overflow
+
+
+class QuantileSketch(Accumulator):
+    """
+    Estimates quantiles of valid values using a logarithmically-bucketed sketch
+    (as per the DDSketch algorithm of Masson et al.). Each quantile estimate
+    lies within a fraction relative_accuracy of the true value of the quantile
+    (for the value at the nearest rank). Memory use grows with the logarithm of
+    the range of the data, not with the number of values, and sketches can be
+    merged exactly.
+    """
+
+    def __init__(self, shape, relative_accuracy=0.01, keep=None):
+        self.relative_accuracy = relative_accuracy
+        self._gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self._gamma)
+        super(QuantileSketch, self).__init__(shape, keep=keep)
+
+    def _init(self):
+        ncells = int(np.prod(self.result_shape, dtype=np.int64))
+        self._positive = [dict() for _ in range(ncells)]
+        self._negative = [dict() for _ in range(ncells)]
+        self._zeros = np.zeros(self.result_shape, dtype=np.int64)
+
+    @property
+    def count(self):
+        """The number of values added to the sketch."""
+        counts = [sum(p.values()) + sum(n.values()) for p, n in zip(self._positive, self._negative)]
+        return np.array(counts, dtype=np.int64).reshape(self.result_shape) + self._zeros
+
+    def quantile(self, q):
+        """
+        Return estimates of the q'th quantiles, where q is a number or sequence of
+        numbers between 0 and 1. If q is a sequence then the quantiles are given
+        by the last dimension of the result. Cells with no values yield NaN.
+        """
+        qs = np.atleast_1d(np.asarray(q, dtype=np.float64))
+        result = np.full((len(self._positive), len(qs)), np.nan)
+        zeros = self._zeros.ravel()
+        for cell, (pos, neg) in enumerate(zip(self._positive, self._negative)):
+            buckets = [(-self._value(k), neg[k]) for k in sorted(neg, reverse=True)]
+            if zeros[cell]: buckets.append((0.0, zeros[cell]))
+            buckets.extend((self._value(k), pos[k]) for k in sorted(pos))
+            if not buckets: continue
+            values = np.array([b[0] for b in buckets])
+            cumulative = np.cumsum([b[1] for b in buckets])
+            ranks = np.floor(qs * (cumulative[-1] - 1))
+            result[cell] = values[np.searchsorted(cumulative, ranks, side='right')]
+        result = result.reshape(self.result_shape + (len(qs),))
+        return result if np.ndim(q) else result[...,0]
+
+    def _value(self, key):
+        return 2 * self._gamma**key / (self._gamma + 1)
+
+    def _update(self, values, valid, target, block, starts, chunkshape):
+        rows = np.broadcast_to(np.arange(values.shape[0])[:,None], values.shape)[valid]
+        values = values[valid]
+        if self.keep:
+            index = np.unravel_index(rows, block)
+            cells = np.ravel_multi_index([i + s.start for i, s in zip(index, target)],
+                self.result_shape)
+        else:
+            cells = np.zeros(len(rows), dtype=np.int64)
+
+        zero = values == 0
+        np.add.at(self._zeros.reshape(-1), cells[zero], 1)
+        for sketch, select in ((self._positive, values > 0), (self._negative, values < 0)):
+            if not select.any(): continue
+            keys = np.ceil(np.log(np.abs(values[select])) / self._log_gamma).astype(np.int64)
+            pairs, counts = np.unique(np.column_stack((cells[select], keys)), axis=0,
+                return_counts=True)
+            for (cell, key), count in zip(pairs.tolist(), counts.tolist()):
+                buckets = sketch[cell]
+                buckets[key] = buckets.get(key, 0) + count
+
+    def _merge(self, other):
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError("Cannot merge sketches with different relative accuracies.")
+        for mine, theirs in zip(self._positive + self._negative, other._positive + other._negative):
+            for key, count in theirs.items():
+                mine[key] = mine.get(key, 0) + count
+        self._zeros += other._zeros
+
+
+class ChunkMapper(object):
+    """
+    A picklable mapper function for use with nciter.chunk_map_reduce. Each call
+    returns fresh copies of the specified prototype accumulators updated with
+    the given chunk, as a single accumulator if just one prototype was given or
+    else as a list. Use the merge function of this module as the reducer.
+    """
+
+    def __init__(self, *prototypes):
+        self.prototypes = [p.empty() for p in prototypes]
+
+    def __call__(self, chunk):
+        accumulators = [p.empty().update(chunk) for p in self.prototypes]
+        return accumulators[0] if len(accumulators) == 1 else accumulators
+
+
+def merge(a, b):
+    """
+    Merge accumulator b into accumulator a, or each accumulator in sequence b
+    into the corresponding accumulator in sequence a, and return a.
+    """
+    if isinstance(a, Accumulator):
+        return a.merge(b)
+    for x, y in zip(a, b):
+        x.merge(y)
+    return a
+
+
+def accumulate(chunks, *accumulators):
+    """
+    Update each of the specified accumulators with every chunk in iterable
+    chunks, e.g. iter_chunks(var), and return the accumulators.
+    """
+    for chunk in chunks:
+        for acc in accumulators:
+            acc.update(chunk)
+    return accumulators
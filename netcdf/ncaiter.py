@@ -0,0 +1,124 @@
+"""
+Asyncio interface to the chunk iteration facilities provided by the nciter module.
+
+The netcdf4-python module performs blocking I/O, so iterating over the chunks of
+a large variable from within a coroutine, e.g. in an asyncio-based service, would
+stall the event loop for the duration of the loop. The asynchronous generators in
+this module instead push each read onto an executor (by default the event loop's
+thread pool) and await the result, so that other tasks keep running in the mean-
+time. Reads are started only as the consumer asks for chunks, and no more than a
+fixed number of chunks are ever pending, so a slow consumer applies backpressure
+rather than causing data to pile up in memory.
+
+Note that the underlying netcdf and HDF5 libraries are not thread-safe, so nciter
+serialises the reads themselves; the benefit here is responsiveness of the event
+loop and overlap of I/O with other work, not parallel decompression.
+
+Requires Python 3.6 or later. Example:
+
+    async for chunk in aiter_chunks(var, max_pending=4):
+        await process(chunk)
+"""
+
+import asyncio
+from collections import deque
+
+import nciter
+
+
+async def aiter_chunks(var, max_pending=2, limiter=None, executor=None, mask='ma', **kwargs):
+    """
+    Asynchronously iterate over the chunks in netCDF variable var, returning
+    an NcDataChunk object for each one, in iteration order. Up to max_pending
+    chunks are read ahead of the consumer. If limiter is specified, it should
+    be an asyncio.Semaphore which is acquired for the duration of each read;
+    sharing one semaphore between several iterators bounds the total number of
+    concurrent reads. Reads are run on the specified concurrent.futures executor,
+    or on the event loop's default executor if none is given. The mask argument
+    and any other keyword arguments (target_bytes, max_chunk_multiple, region,
+    order) have the same meaning as for nciter.iter_chunks.
+    """
+    loop = asyncio.get_event_loop()
+    max_pending = max(int(max_pending), 1)
+    pending = deque()
+
+    async def read(hs):
+        if limiter is None:
+            return await loop.run_in_executor(executor, nciter.read_chunk, var, hs, mask)
+        async with limiter:
+            return await loop.run_in_executor(executor, nciter.read_chunk, var, hs, mask)
+
+    try:
+        for hs in nciter.var_hyperslabs(var, **kwargs):
+            if len(pending) >= max_pending:
+                yield await pending.popleft()
+            pending.append(asyncio.ensure_future(read(hs)))
+        while pending:
+            yield await pending.popleft()
+    finally:
+        # Abandon any outstanding reads if the consumer stops iterating early.
+        for future in pending:
+            future.cancel()
+
+
+async def amerge(*iterators, maxsize=8):
+    """
+    Merge the specified asynchronous iterators, e.g. several aiter_chunks()
+    iterators over different variables or files, into one stream. Returns
+    (index, item) tuples, where index identifies the source iterator, in the
+    order in which items become available. At most maxsize items are buffered
+    across all sources; once the buffer is full, the sources are suspended
+    until the consumer catches up.
+    """
+    queue = asyncio.Queue(maxsize=max(int(maxsize), 1))
+    done = object()
+
+    async def pump(index, iterator):
+        try:
+            async for item in iterator:
+                await queue.put((index, item))
+        except asyncio.CancelledError:
+            raise
+        except Exception as exc:
+            await queue.put((index, _Failure(exc)))
+        else:
+            await queue.put((index, done))
+
+    tasks = [asyncio.ensure_future(pump(i, it)) for i, it in enumerate(iterators)]
+    try:
+        remaining = len(tasks)
+        while remaining:
+            index, item = await queue.get()
+            if item is done:
+                remaining -= 1
+            elif isinstance(item, _Failure):
+                raise item.exc
+            else:
+                yield index, item
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+class _Failure(object):
+    """Wraps an exception raised by one of the sources passed to amerge."""
+    def __init__(self, exc):
+        self.exc = exc
+
+
+async def astream_chunks(variables, max_pending=2, max_reads=4, maxsize=8, executor=None,
+        **kwargs):
+    """
+    Asynchronously stream the chunks of several netcdf variables concurrently,
+    returning (variable, NcDataChunk) tuples as chunks become available. No more
+    than max_reads reads are in progress at once across all of the variables,
+    each variable has at most max_pending chunks read ahead, and at most maxsize
+    chunks are buffered awaiting the consumer. Any other keyword arguments are
+    passed to aiter_chunks.
+    """
+    variables = list(variables)
+    limiter = asyncio.Semaphore(max(int(max_reads), 1))
+    iterators = [aiter_chunks(var, max_pending=max_pending, limiter=limiter,
+        executor=executor, **kwargs) for var in variables]
+    async for index, chunk in amerge(*iterators, maxsize=maxsize):
+        yield variables[index], chunk
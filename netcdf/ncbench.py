@@ -0,0 +1,235 @@
+#!/usr/bin/env python2.7
+"""
+Benchmark the chunk iteration strategies provided by the nciter module. A set of synthetic netcdf-4
+files is generated across a matrix of array sizes, chunk shapes, compression levels and data types,
+and a full pass over the data variable in each file is timed for each iteration strategy and access
+order. Results are written as a JSON document, to stdout or to the file given by the -o option, so
+that they can be compared between runs, machines and versions of this module.
+
+Files are generated with a fixed random seed (see -s), so a given matrix is reproducible. They are
+created in a temporary directory which is deleted afterwards, unless a directory is specified with
+the -d option, in which case existing files are reused. Note that no attempt is made to flush the
+operating system's page cache between runs; the minimum time over the -r repeats is therefore
+a measure of decode and iteration overhead rather than of disk speed.
+
+Strategies: iter_chunks, threaded (iter_chunks with worker threads), proxy (ProxyNcVariable),
+subclass (NcIterableVariable) and mixin (NcVariable).
+"""
+import sys
+import os
+import json
+import platform
+import shutil
+import tempfile
+import time
+import netCDF4 as nc4
+import numpy as np
+
+import nciter
+
+usage = "Usage: %s [options]" % os.path.basename(sys.argv[0])
+
+# Array shapes (time, lat, lon) for each named size.
+SIZES = {
+    'small': (24, 180, 360),
+    'medium': (96, 360, 720),
+    'large': (365, 720, 1440),
+}
+
+# Chunk shapes, expressed as the divisors applied to each dimension of the array shape.
+CHUNKS = {
+    'contiguous': None,
+    'field': (0, 1, 1),      # one whole lat-lon field per chunk
+    'tile': (0, 4, 4),       # one quarter by one quarter tile of a field per chunk
+    'column': (1, 8, 8),     # the full time series of a small lat-lon box per chunk
+}
+
+STRATEGIES = ('iter_chunks', 'threaded', 'proxy', 'subclass', 'mixin')
+
+
+def main():
+    options = parse_args()
+    workdir = options.workdir or tempfile.mkdtemp(prefix='ncbench')
+    try:
+        if not os.path.exists(workdir): os.makedirs(workdir)
+        results = []
+        for size in options.sizes:
+            for chunks in options.chunks:
+                for complevel in options.complevels:
+                    # Contiguous variables cannot be compressed.
+                    if complevel and CHUNKS[chunks] is None: continue
+                    for dtype in options.dtypes:
+                        ncfile = make_file(workdir, size, chunks, complevel, dtype, options.seed)
+                        for strategy in options.strategies:
+                            for order in options.orders:
+                                result = dict(size=size, shape=SIZES[size], chunks=chunks,
+                                    complevel=complevel, dtype=dtype, strategy=strategy, order=order,
+                                    filesize=os.path.getsize(ncfile))
+                                result.update(time_strategy(ncfile, strategy, order, options.repeats,
+                                    options.workers))
+                                results.append(result)
+                                if options.verbose:
+                                    sys.stderr.write("{size} {chunks} z{complevel} {dtype} {strategy} "
+                                        "{order}: {min:.3f} s\n".format(**result))
+    finally:
+        if not options.workdir: shutil.rmtree(workdir)
+
+    doc = dict(meta=metadata(options), results=results)
+    if options.outfile:
+        with open(options.outfile, 'w') as fh:
+            json.dump(doc, fh, indent=1)
+    else:
+        print(json.dumps(doc, indent=1))
+
+
+def make_file(workdir, size, chunks, complevel, dtype, seed):
+    """
+    Create, unless it already exists, a netcdf-4 file containing a synthetic variable named 'data'
+    with the specified size, chunk layout, compression level and data type, and return its path.
+    The data is a smooth field plus noise, so that it compresses roughly as real data would.
+    """
+    ncfile = os.path.join(workdir, "bench_{0}_{1}_z{2}_{3}_s{4}.nc".format(size, chunks, complevel,
+        dtype, seed))
+    if os.path.exists(ncfile): return ncfile
+
+    shape = SIZES[size]
+    if CHUNKS[chunks] is None:
+        kwargs = dict(contiguous=True)
+    else:
+        kwargs = dict(chunksizes=[max(n // d, 1) if d else 1 for n, d in zip(shape, CHUNKS[chunks])])
+    if complevel:
+        kwargs.update(zlib=True, complevel=complevel, shuffle=True)
+
+    rng = np.random.RandomState(seed)
+    lat = np.linspace(-np.pi/2, np.pi/2, shape[1])
+    lon = np.linspace(0, 2*np.pi, shape[2])
+    field = 20 * np.cos(lat)[:,None] + 5 * np.sin(3*lon)[None,:]
+    scale = 100 if np.dtype(dtype).kind == 'i' else 1
+
+    tmpfile = ncfile + '.tmp'
+    ds = nc4.Dataset(tmpfile, 'w', format='NETCDF4')
+    try:
+        for name, n in zip(('time', 'lat', 'lon'), shape):
+            ds.createDimension(name, n)
+        var = ds.createVariable('data', dtype, ('time', 'lat', 'lon'), **kwargs)
+        for t in range(shape[0]):
+            values = field * np.cos(2*np.pi*t/shape[0]) + rng.standard_normal(shape[1:])
+            var[t] = (values * scale).astype(dtype)
+    finally:
+        ds.close()
+    os.rename(tmpfile, ncfile)
+    return ncfile
+
+
+def time_strategy(ncfile, strategy, order, repeats, workers):
+    """
+    Time repeated full passes over the data variable in ncfile using the specified iteration
+    strategy and dimension order, and return a dictionary of timing results.
+    """
+    times = []
+    for _ in range(repeats):
+        ds = nc4.Dataset(ncfile)
+        try:
+            chunks = iterate(ds, strategy, order, workers)
+            t0 = time.time()
+            nchunks = nbytes = 0
+            for data in chunks:
+                nchunks += 1
+                nbytes += data.nbytes
+            times.append(time.time() - t0)
+        finally:
+            ds.close()
+
+    tmin = min(times)
+    return dict(times=times, min=tmin, median=float(np.median(times)), nchunks=nchunks,
+        nbytes=nbytes, mb_per_sec=nbytes / 1024.0**2 / tmin if tmin else None)
+
+
+def iterate(ds, strategy, order, workers):
+    """Return an iterator over the data arrays of the chunks of variable 'data' in dataset ds."""
+    var = ds.variables['data']
+    if strategy == 'iter_chunks':
+        return (chunk.data for chunk in nciter.iter_chunks(var, order=order))
+    elif strategy == 'threaded':
+        return (chunk.data for chunk in nciter.iter_chunks(var, order=order, workers=workers))
+    elif strategy == 'proxy':
+        return iter(nciter.ProxyNcVariable(var, order=order))
+    elif strategy in ('subclass', 'mixin'):
+        # Wrap the existing variable in an instance of the solution 3 or 4 class, whose
+        # traversal order is a class attribute.
+        base = nciter.NcIterableVariable if strategy == 'subclass' else nciter.NcVariable
+        cls = type(base.__name__, (base,), dict(order=order))
+        dims = tuple(ds.dimensions[name] for name in var.dimensions)
+        return iter(cls(ds, var.name, var.datatype, dimensions=dims, id=var._varid))
+    else:
+        raise ValueError("Unknown strategy: " + strategy)
+
+
+def metadata(options):
+    """Return a dictionary describing the benchmark environment and settings."""
+    return dict(
+        timestamp=time.strftime('%Y-%m-%dT%H:%M:%S'),
+        host=platform.node(),
+        platform=platform.platform(),
+        python=platform.python_version(),
+        numpy=np.__version__,
+        netcdf4_python=nc4.__version__,
+        netcdf_lib=nc4.__netcdf4libversion__,
+        hdf5_lib=nc4.__hdf5libversion__,
+        seed=options.seed,
+        repeats=options.repeats,
+        workers=options.workers,
+    )
+
+
+def parse_args():
+    """Parse command-line options and arguments"""
+    import optparse
+
+    usage = "usage: %prog [options]"
+    parser = optparse.OptionParser(usage=usage, version="0.1")
+    parser.add_option("-d", dest="workdir",
+        help="directory in which to create (or reuse) the synthetic files")
+    parser.add_option("-o", dest="outfile",
+        help="file to write JSON results to (default: stdout)")
+    parser.add_option("-r", dest="repeats", type="int", default=3,
+        help="number of timed passes per strategy (default: 3)")
+    parser.add_option("-s", dest="seed", type="int", default=0,
+        help="random seed used to generate data (default: 0)")
+    parser.add_option("-v", dest="verbose", action="store_true",
+        help="report progress on stderr")
+    parser.add_option("-w", dest="workers", type="int", default=4,
+        help="number of threads used by the threaded strategy (default: 4)")
+    parser.add_option("--sizes", default="small",
+        help="comma-separated list of array sizes: " + ", ".join(sorted(SIZES)) + " (default: small)")
+    parser.add_option("--chunks", default="field,tile,column",
+        help="comma-separated list of chunk layouts: " + ", ".join(sorted(CHUNKS)) +
+        " (default: field,tile,column)")
+    parser.add_option("--complevels", default="0,4",
+        help="comma-separated list of zlib compression levels (default: 0,4)")
+    parser.add_option("--dtypes", default="f4,f8,i2",
+        help="comma-separated list of numpy data types (default: f4,f8,i2)")
+    parser.add_option("--strategies", default=",".join(STRATEGIES),
+        help="comma-separated list of strategies (default: all)")
+    parser.add_option("--orders", default="C,F",
+        help="comma-separated list of dimension orders (default: C,F)")
+
+    options, args = parser.parse_args()
+
+    options.sizes = options.sizes.split(',')
+    options.chunks = options.chunks.split(',')
+    options.complevels = [int(z) for z in options.complevels.split(',')]
+    options.dtypes = options.dtypes.split(',')
+    options.strategies = options.strategies.split(',')
+    options.orders = options.orders.split(',')
+    for name, values, valid in (('size', options.sizes, SIZES), ('chunk layout', options.chunks, CHUNKS),
+            ('strategy', options.strategies, STRATEGIES)):
+        for value in values:
+            if value not in valid: parser.error("Unknown {0}: {1}".format(name, value))
+    if options.repeats < 1: parser.error("Number of repeats must be at least 1.")
+
+    return options
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,207 @@
+"""
+An in-process cache of decoded data chunks, shared by all of the iteration paths
+in the nciter module, so that repeated passes over a variable do not re-read and
+re-decompress its chunks.
+
+Chunks are keyed by file path, modification time, variable name, hyperslab and
+the variable's masking and scaling settings, so a file that is modified after
+being read is not served stale data, and raw values are never served in place
+of decoded ones. Chunks evicted from memory may optionally be spilled to a
+directory of uncompressed .npz files, which are also visible to other processes
+that share the same spill directory.
+
+The cache is off by default. Example:
+
+    enable_chunk_cache(max_bytes=2**30, spill_dir='/scratch/chunks')
+    for chunk in iter_chunks(var):      # first pass reads from the file
+        ...
+    for chunk in iter_chunks(var):      # second pass is served from the cache
+        ...
+"""
+
+import hashlib
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+import nciter
+
+
+class ChunkCache(object):
+    """
+    Bounded-memory LRU cache of decoded data chunks. At most max_bytes bytes of
+    chunk data (and masks) are held in memory. If spill_dir is specified then
+    chunks evicted from memory are written to that directory, up to a total of
+    spill_max_bytes bytes if that is specified, and are reloaded from there on
+    a subsequent miss. The hits, misses, evictions, spill_hits and spill_writes
+    attributes count cache events; nbytes is the current in-memory size.
+    """
+
+    def __init__(self, max_bytes, spill_dir=None, spill_max_bytes=None):
+        """Initialize an instance object."""
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.spill_max_bytes = spill_max_bytes
+        self.nbytes = 0
+        self.hits = self.misses = self.evictions = 0
+        self.spill_hits = self.spill_writes = 0
+        self._entries = OrderedDict()
+        self._spilled = OrderedDict()
+        self._spill_bytes = 0
+        self._lock = threading.Lock()
+        if spill_dir and not os.path.isdir(spill_dir): os.makedirs(spill_dir)
+
+    def __repr__(self):
+        return ("<ChunkCache: {0.nbytes} bytes, {0.hits} hits, {0.misses} misses, "
+            "{0.evictions} evictions, {0.spill_hits} spill hits>").format(self)
+
+    def key(self, var, hyperslab, raw=False):
+        """
+        Return the cache key for the specified hyperslab of netcdf variable var,
+        or None if var is not backed by a file that can be identified. The key
+        includes the variable's automatic masking and scaling settings, so that
+        raw and decoded values are never confused; the raw flag means that
+        automatic masking is to be turned off for the read.
+        """
+        try:
+            group = var.group()
+            path = group.filepath()
+            mtime = os.stat(path).st_mtime
+            name = group.path.rstrip('/') + '/' + var.name
+        except (AttributeError, ValueError, OSError):
+            return None
+        decoding = (bool(getattr(var, 'mask', True)) and not raw, bool(getattr(var, 'scale', True)),
+            bool(getattr(var, 'always_mask', True)))
+        return (path, mtime, name, tuple((s.start, s.stop) for s in hyperslab), decoding)
+
+    def get(self, key):
+        """Return a copy of the chunk cached under key, or None if not cached."""
+        with self._lock:
+            data = self._entries.pop(key, None)
+            if data is not None:
+                self._entries[key] = data
+                self.hits += 1
+                return data.copy()
+
+        data = self._read_spill(key)
+        with self._lock:
+            if data is None:
+                self.misses += 1
+                return None
+            self.spill_hits += 1
+        self.put(key, data)
+        return data.copy()
+
+    def put(self, key, data):
+        """Add a copy of the specified chunk to the cache under key."""
+        nbytes = nciter.array_nbytes(data)
+        if nbytes > self.max_bytes: return
+        data = data.copy()
+        evicted = []
+        with self._lock:
+            if key in self._entries:
+                self.nbytes -= nciter.array_nbytes(self._entries.pop(key))
+            self._entries[key] = data
+            self.nbytes += nbytes
+            while self.nbytes > self.max_bytes:
+                oldkey, olddata = self._entries.popitem(last=False)
+                self.nbytes -= nciter.array_nbytes(olddata)
+                self.evictions += 1
+                evicted.append((oldkey, olddata))
+        for oldkey, olddata in evicted:
+            self._write_spill(oldkey, olddata)
+
+    def clear(self):
+        """Remove all chunks from memory, and any spill files written by this cache."""
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+            spilled = list(self._spilled)
+            self._spilled.clear()
+            self._spill_bytes = 0
+        for path in spilled:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def _spill_path(self, key):
+        """Return the pathname of the spill file for the specified key."""
+        return os.path.join(self.spill_dir, hashlib.sha1(repr(key).encode('utf-8')).hexdigest() + '.npz')
+
+    def _read_spill(self, key):
+        """Load the chunk for key from the spill directory, if present."""
+        if not self.spill_dir: return None
+        try:
+            with np.load(self._spill_path(key)) as npz:
+                if 'mask' in npz.files:
+                    return np.ma.MaskedArray(npz['data'], mask=npz['mask'])
+                return npz['data']
+        except (IOError, OSError, ValueError):
+            return None
+
+    def _write_spill(self, key, data):
+        """Write the chunk for key to the spill directory, evicting old spill files as needed."""
+        if not self.spill_dir: return
+        path = self._spill_path(key)
+        nbytes = nciter.array_nbytes(data)
+
+        # Chunks are immutable for a given key, so an existing file can be reused.
+        with self._lock:
+            if path in self._spilled:
+                self._spilled[path] = self._spilled.pop(path)
+                return
+        if os.path.exists(path): return
+        if self.spill_max_bytes is not None and nbytes > self.spill_max_bytes: return
+        arrays = dict(data=np.ma.getdata(data))
+        if np.ma.isMA(data): arrays['mask'] = np.ma.getmaskarray(data)
+
+        # Write to a temporary file and rename it so that readers never see a
+        # partially written file.
+        fd, tmppath = tempfile.mkstemp(dir=self.spill_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as fh:
+                np.savez(fh, **arrays)
+            os.rename(tmppath, path)
+        except (IOError, OSError):
+            if os.path.exists(tmppath): os.remove(tmppath)
+            return
+
+        removed = []
+        with self._lock:
+            self.spill_writes += 1
+            if path in self._spilled: self._spill_bytes -= self._spilled.pop(path)
+            self._spilled[path] = nbytes
+            self._spill_bytes += nbytes
+            while self.spill_max_bytes is not None and self._spill_bytes > self.spill_max_bytes:
+                oldpath, oldbytes = self._spilled.popitem(last=False)
+                self._spill_bytes -= oldbytes
+                removed.append(oldpath)
+        for oldpath in removed:
+            try:
+                os.remove(oldpath)
+            except OSError:
+                pass
+
+
+def enable_chunk_cache(max_bytes=256*1024**2, spill_dir=None, spill_max_bytes=None):
+    """
+    Enable the shared chunk cache, replacing any existing cache, and return the
+    new ChunkCache object. The arguments are passed to the ChunkCache constructor.
+    """
+    cache = ChunkCache(max_bytes, spill_dir=spill_dir, spill_max_bytes=spill_max_bytes)
+    nciter.set_shared_cache(cache)
+    return cache
+
+
+def disable_chunk_cache():
+    """Disable the shared chunk cache, discarding its contents from memory."""
+    nciter.set_shared_cache(None)
+
+
+def get_chunk_cache():
+    """Return the shared ChunkCache object, or None if the cache is disabled."""
+    return nciter.get_shared_cache()
@@ -0,0 +1,119 @@
+"""
+Checkpointing for long-running iterations over the chunks of a netcdf variable,
+so that an interrupted job, e.g. a batch task that is pre-empted, can pick up
+where it left off rather than starting again from the first chunk.
+
+A ChunkCheckpoint object is passed as the checkpoint argument of
+nciter.iter_chunks, which skips the chunks already consumed on resuming and
+saves progress, together with the caller's own state, as iteration proceeds.
+"""
+
+import os
+import pickle
+import tempfile
+import time
+
+import nciter
+
+
+class ChunkCheckpoint(object):
+    """
+    Records the progress of an iteration over the chunks of a netcdf variable,
+    i.e. the number of chunks consumed so far, together with arbitrary caller
+    state such as partial sums, in the file at path. The file is loaded, if it
+    exists, when the object is created. Pass the object as the checkpoint
+    argument of iter_chunks. The file is (re)written atomically, using pickle,
+    after every interval chunks and/or every seconds seconds, and again once
+    iteration is complete. Example:
+
+        ckpt = ChunkCheckpoint('job.ckpt', interval=100, state={'total': 0.0})
+        for chunk in iter_chunks(var, checkpoint=ckpt):
+            ckpt.state['total'] += chunk.data.sum()
+
+    The caller should only update the state attribute in step with consuming
+    chunks, so that the saved state always accounts for exactly the chunks that
+    have been consumed.
+    """
+
+    def __init__(self, path, interval=100, seconds=None, state=None):
+        """
+        Initialize a checkpoint which is saved to file path. If the file exists
+        then position and state are restored from it, and the state argument,
+        which is otherwise the initial caller state, is ignored.
+        """
+        self.path = path
+        self.interval = interval
+        self.seconds = seconds
+        self.position = 0
+        self.complete = False
+        self.state = state
+        self._key = None
+        self._since = 0
+        self._last = time.time()
+        if os.path.exists(path):
+            with open(path, 'rb') as fh:
+                saved = pickle.load(fh)
+            self.position = saved['position']
+            self.complete = saved['complete']
+            self.state = saved['state']
+            self._key = saved['key']
+
+    def save(self):
+        """Save the current position and state to file, replacing it atomically."""
+        saved = dict(key=self._key, position=self.position, complete=self.complete,
+            state=self.state)
+        fd, tmppath = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)),
+            suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as fh:
+                pickle.dump(saved, fh, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmppath, self.path)
+        except:
+            if os.path.exists(tmppath): os.remove(tmppath)
+            raise
+        self._since = 0
+        self._last = time.time()
+
+    def remove(self):
+        """Delete the checkpoint file, if it exists."""
+        if os.path.exists(self.path): os.remove(self.path)
+
+    def _resume(self, var, hyperslabs):
+        """
+        Check that this checkpoint belongs to an iteration over the specified
+        hyperslabs of variable var, and return the remaining hyperslabs.
+        """
+        if not hasattr(hyperslabs, '__getitem__'): hyperslabs = list(hyperslabs)
+        key = (var.name, tuple(var.shape), tuple(nciter.get_chunkshape(var)),
+            _hyperslabs_fingerprint(hyperslabs))
+        if self._key is not None and self._key != key:
+            raise ValueError("Checkpoint file {0} does not match this iteration over variable "
+                "{1}.".format(self.path, var.name))
+        self._key = key
+        if self.complete:
+            return []
+        return hyperslabs[self.position:]
+
+    def _track(self, chunks):
+        """Generator function which counts the chunks consumed by the caller."""
+        for chunk in chunks:
+            yield chunk
+            self.position += 1
+            self._since += 1
+            if ((self.interval and self._since >= self.interval) or
+                    (self.seconds is not None and time.time() - self._last >= self.seconds)):
+                self.save()
+        self.complete = True
+        self.save()
+
+
+def _hyperslabs_fingerprint(hyperslabs, nsamples=16):
+    """
+    Return a compact fingerprint of a sequence of hyperslabs, comprising its
+    length and a sample of evenly spaced hyperslabs (including the first two
+    and the last), which distinguishes sequences visited in different orders,
+    over different regions or shards, or in chunks of different sizes.
+    """
+    n = len(hyperslabs)
+    picks = sorted(set([0, 1, n-1] + [i * (n-1) // nsamples for i in range(nsamples+1)]))
+    return (n,) + tuple(tuple((s.start, s.stop) for s in hyperslabs[i]) for i in picks if 0 <= i < n)
@@ -0,0 +1,236 @@
+#!/usr/bin/env python2.7
+"""
+Build, update or summarise the per-chunk statistics index for a variable in a netcdf file.
+The index records the minimum, maximum, valid and missing value counts, sum and checksum of
+each storage chunk, and is saved as a sidecar file named <ncfile>.<varname>.idx.npz (or the
+file given by the -o option). The nciter.iter_chunks function can use the index to skip chunks
+which cannot satisfy a query, e.g. where=lambda s: s.max > 40, without reading them.
+
+By default a new index is built from scratch. The -u option updates an existing index, which
+only reads those chunks containing records added since the index was last built. The -s option
+just prints a summary of an existing index.
+
+The ChunkStatsIndex class, which holds the statistics and evaluates queries over them, may also
+be imported from this module for use in scripts.
+"""
+import sys
+import os
+import tempfile
+import zlib
+import netCDF4 as nc4
+import numpy as np
+
+from nciter import HyperslabSequence, get_chunkshape, read_hyperslabs, storage_chunk_numbers
+
+usage = "Usage: %s [options] ncfile varname" % os.path.basename(sys.argv[0])
+
+
+def main():
+    options, ncfile, varname = parse_args()
+    idxfile = options.idxfile or ChunkStatsIndex.sidecar_path(ncfile, varname)
+    ds = None
+    try:
+        if options.summary:
+            index = ChunkStatsIndex.load(idxfile)
+        else:
+            ds = nc4.Dataset(ncfile)
+            var = ds.variables[varname]
+            if options.update and os.path.exists(idxfile):
+                index = ChunkStatsIndex.load(idxfile)
+                nread = index.update(var, workers=options.workers)
+            else:
+                index = ChunkStatsIndex.build(var, workers=options.workers)
+                nread = len(index)
+            index.save(idxfile)
+            print("Read {0} of {1} chunks; index saved to {2}".format(nread, len(index), idxfile))
+        print_summary(index)
+    except KeyError:
+        sys.stderr.write("ERROR: Variable {0} not found in file {1}.\n".format(varname, ncfile))
+        sys.exit(1)
+    finally:
+        if ds is not None : ds.close()
+
+
+class ChunkStatsIndex(object):
+    """
+    Per-chunk statistics for a netcdf variable, indexed by storage chunk number
+    (in C order). The min, max, count (of valid values), masked (count of
+    missing values), sum and checksum attributes are numpy arrays with one
+    element per chunk. The min and max of a chunk with no valid values are NaN.
+    The checksum is a CRC-32 of each chunk's data and mask.
+
+    Use the build class method to create an index for a variable, the update
+    method to bring it up to date after records have been appended, and the
+    save and load methods to store it as a numpy .npz file. The select method
+    evaluates a predicate over the statistics of all chunks at once, e.g.
+    index.select(lambda s: (s.max > 40) & (s.count > 0)).
+    """
+
+    _FIELDS = ('min', 'max', 'count', 'masked', 'sum', 'checksum')
+
+    def __init__(self, varname, shape, chunkshape):
+        """Initialize an empty index for a variable with the given shape and chunk shape."""
+        self.varname = varname
+        self.shape = tuple(shape)
+        self.chunkshape = tuple(chunkshape)
+        n = len(HyperslabSequence(self.shape, self.chunkshape))
+        self.min = np.full(n, np.nan)
+        self.max = np.full(n, np.nan)
+        self.count = np.zeros(n, dtype=np.int64)
+        self.masked = np.zeros(n, dtype=np.int64)
+        self.sum = np.zeros(n)
+        self.checksum = np.zeros(n, dtype=np.uint32)
+
+    def __len__(self):
+        return len(self.count)
+
+    @classmethod
+    def build(cls, var, workers=None):
+        """Build and return an index for netcdf variable var by reading every chunk."""
+        index = cls(var.name, var.shape, get_chunkshape(var))
+        index._compute(var, 0, workers=workers)
+        return index
+
+    @classmethod
+    def load(cls, path):
+        """Load an index from the specified .npz file."""
+        with np.load(path) as npz:
+            index = cls.__new__(cls)
+            index.varname = str(npz['varname'])
+            index.shape = tuple(int(n) for n in npz['shape'])
+            index.chunkshape = tuple(int(n) for n in npz['chunkshape'])
+            for field in cls._FIELDS:
+                setattr(index, field, npz[field])
+        return index
+
+    @staticmethod
+    def sidecar_path(ncpath, varname):
+        """
+        Return the default sidecar file path for the index of the named
+        variable in netcdf file ncpath, i.e. <ncpath>.<varname>.idx.npz.
+        """
+        return "{0}.{1}.idx.npz".format(ncpath, varname)
+
+    def save(self, path):
+        """Save the index to the specified .npz file, replacing it atomically."""
+        arrays = dict((field, getattr(self, field)) for field in self._FIELDS)
+        fd, tmppath = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as fh:
+                np.savez(fh, varname=np.array(self.varname), shape=np.array(self.shape, dtype=np.int64),
+                    chunkshape=np.array(self.chunkshape, dtype=np.int64), **arrays)
+            os.rename(tmppath, path)
+        except:
+            if os.path.exists(tmppath): os.remove(tmppath)
+            raise
+
+    def update(self, var, workers=None):
+        """
+        Bring the index up to date with netcdf variable var following the
+        addition of records along its first dimension. Only those chunks which
+        contain new records are read. If the variable's trailing dimensions or
+        chunk shape have changed then the whole index is rebuilt. Returns the
+        number of chunks that were read.
+        """
+        chunkshape = tuple(get_chunkshape(var))
+        if var.shape == self.shape and chunkshape == self.chunkshape:
+            return 0
+        old_nrecs = self.shape[0] if self.shape else 0
+        rebuild = (not var.shape or var.shape[1:] != self.shape[1:] or chunkshape != self.chunkshape
+            or var.shape[0] < old_nrecs)
+
+        # With the first dimension outermost, chunk numbers of existing records
+        # are unchanged, and the new ones follow on from the last partial chunk.
+        fresh = ChunkStatsIndex(self.varname, var.shape, chunkshape)
+        first = 0
+        if not rebuild:
+            first = (old_nrecs // chunkshape[0]) * len(HyperslabSequence(var.shape[1:], chunkshape[1:]))
+            for field in self._FIELDS:
+                getattr(fresh, field)[:first] = getattr(self, field)[:first]
+        fresh._compute(var, first, workers=workers)
+        self.__dict__.update(fresh.__dict__)
+        return len(self) - first
+
+    def select(self, predicate):
+        """
+        Evaluate predicate, which is passed this index and should return a
+        boolean array or a list of chunk numbers, and return the numbers of the
+        matching chunks as an integer array.
+        """
+        result = np.asarray(predicate(self))
+        if result.dtype == bool:
+            return np.nonzero(result)[0]
+        return np.unique(result.astype(np.int64))
+
+    def filter_hyperslabs(self, var, hyperslabs, chunknums):
+        """
+        Generator function which yields those of the specified hyperslabs of
+        netcdf variable var which intersect any of the specified storage chunks.
+        """
+        if var.shape != self.shape or tuple(get_chunkshape(var)) != self.chunkshape:
+            raise ValueError("Chunk statistics index for {0} is out of date.".format(self.varname))
+        keep = np.zeros(len(self), dtype=bool)
+        keep[chunknums] = True
+        storage = HyperslabSequence(self.shape, self.chunkshape)
+        for hs in hyperslabs:
+            if keep[storage_chunk_numbers(storage, self.shape, self.chunkshape, hs)].any():
+                yield hs
+
+    def _compute(self, var, first, workers=None):
+        """Compute statistics for storage chunks numbered first onwards."""
+        hyperslabs = HyperslabSequence(self.shape, self.chunkshape)[first:]
+        for n, chunk in enumerate(read_hyperslabs(var, hyperslabs, workers), first):
+            data = np.ma.asarray(chunk.data)
+            mask = np.ma.getmaskarray(data)
+            self.count[n] = data.count()
+            self.masked[n] = data.size - self.count[n]
+            if self.count[n]:
+                self.min[n] = data.min()
+                self.max[n] = data.max()
+                self.sum[n] = data.sum(dtype=np.float64)
+            crc = zlib.crc32(np.ascontiguousarray(data.data).tobytes())
+            self.checksum[n] = zlib.crc32(np.packbits(mask).tobytes(), crc) & 0xffffffff
+
+
+def print_summary(index):
+    """Print a summary of the specified chunk statistics index."""
+    nvalid = np.count_nonzero(index.count)
+    print("variable:      {0}".format(index.varname))
+    print("shape:         {0}".format(index.shape))
+    print("chunk shape:   {0}".format(index.chunkshape))
+    print("chunks:        {0} ({1} with no valid values)".format(len(index), len(index) - nvalid))
+    print("valid values:  {0}".format(index.count.sum()))
+    print("missing:       {0}".format(index.masked.sum()))
+    if nvalid:
+        print("minimum:       {0}".format(np.nanmin(index.min)))
+        print("maximum:       {0}".format(np.nanmax(index.max)))
+        print("mean:          {0}".format(index.sum.sum() / index.count.sum()))
+
+
+def parse_args():
+    """Parse command-line options and arguments"""
+    import optparse
+
+    usage = "usage: %prog [options] ncfile varname"
+    parser = optparse.OptionParser(usage=usage, version="0.1")
+    parser.add_option("-o", dest="idxfile",
+        help="index file to create or read (default: <ncfile>.<varname>.idx.npz)")
+    parser.add_option("-s", dest="summary", action="store_true",
+        help="print a summary of an existing index, without reading the netcdf file")
+    parser.add_option("-u", dest="update", action="store_true",
+        help="update an existing index following the addition of new records")
+    parser.add_option("-w", dest="workers", type="int", default=None,
+        help="number of threads to use for reading chunks")
+
+    options, args = parser.parse_args()
+    if len(args) < 2 : parser.error("Insufficient arguments specified.")
+
+    ncfile, varname = args[:2]
+    if not os.path.exists(ncfile):
+        parser.error("File {0} does not exist.".format(ncfile))
+
+    return (options, ncfile, varname)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,392 @@
+#!/usr/bin/env python2.7
+"""
+Build a byte-range index of the storage chunks of the variables in a netcdf-4 file, and read
+chunks directly from the file using that index, bypassing the netcdf and HDF5 libraries.
+
+Reads made via netCDF4-python are serialised by the HDF5 library, which limits the throughput of
+multi-threaded readers such as nciter.iter_chunks(var, workers=N). The index records, for each
+storage chunk of each chunked (or contiguous) variable, its file offset, compressed size and
+filter mask, together with the variable's filter pipeline, data type and the attributes needed
+to mask and scale its data. The iter_direct_chunks function then reads the raw bytes of each
+chunk with positioned reads and decodes them (zlib/deflate, shuffle and fletcher32 filters are
+supported, and fletcher32 checksums are verified) on a pool of threads or processes, outside of
+any library lock, yielding NcDataChunk objects just like nciter.iter_chunks. Masking follows the
+_FillValue (or default fill value) and missing_value attributes, and scaling the scale_factor and
+add_offset attributes; valid_min, valid_max and valid_range are not applied.
+
+Building the index requires the h5py module. Reading from an existing index does not. The index
+records the size and modification time of the netcdf file, and reading fails if either changes.
+
+Command-line usage builds an index for a file, by default in <ncfile>.chunkmap.npz, and prints
+a summary of it.
+"""
+import sys
+import os
+import threading
+import zlib
+import multiprocessing
+import netCDF4
+import numpy as np
+
+import nciter
+
+usage = "Usage: %s [options] ncfile" % os.path.basename(sys.argv[0])
+
+# HDF5 filter identifiers.
+FILTER_DEFLATE = 1
+FILTER_SHUFFLE = 2
+FILTER_FLETCHER32 = 3
+SUPPORTED_FILTERS = (FILTER_DEFLATE, FILTER_SHUFFLE, FILTER_FLETCHER32)
+
+# Separator between variable names and field names in index files.
+_SEP = '::'
+
+
+def main():
+    options, ncfile = parse_args()
+    index = ChunkByteIndex.build(ncfile, varnames=options.varnames)
+    idxfile = options.idxfile or ChunkByteIndex.default_path(ncfile)
+    index.save(idxfile)
+    print("Index saved to {0}".format(idxfile))
+    for name in sorted(index.variables):
+        var = index.variables[name]
+        stored = var['offsets'] >= 0
+        print("{0}: shape {1}, chunks {2}, filters {3}, {4} of {5} chunks stored, {6} bytes".format(
+            name, var['shape'], var['chunkshape'], list(var['filters']), stored.sum(), len(stored),
+            var['sizes'][stored].sum()))
+
+
+class ChunkByteIndex(object):
+    """
+    A byte-range index of the storage chunks of the variables in a netcdf-4 file. The variables
+    attribute is a dictionary, keyed by variable path (e.g. 'tas' or 'group/tas'), of dictionaries
+    holding the variable's shape, chunkshape, dtype, filters, fill value, missing values, scale
+    factor and add offset, and the per-chunk offsets, sizes and filter masks. Chunks are numbered
+    in C order; unwritten chunks have an offset of -1.
+    """
+
+    def __init__(self, ncpath, variables, filesize=None, mtime=None):
+        self.ncpath = ncpath
+        self.variables = variables
+        self.filesize = filesize
+        self.mtime = mtime
+
+    @staticmethod
+    def default_path(ncpath):
+        return ncpath + '.chunkmap.npz'
+
+    @classmethod
+    def build(cls, ncpath, varnames=None):
+        """
+        Scan netcdf-4 file ncpath and return an index of its variables, or just those named in
+        varnames. Variables with unsupported storage layouts or filters are skipped.
+        """
+        import h5py
+
+        stat = os.stat(ncpath)
+        variables = {}
+        ds = netCDF4.Dataset(ncpath)
+        try:
+            with h5py.File(ncpath, 'r') as h5:
+                for path, var in _walk_variables(ds):
+                    if varnames and path not in varnames and var.name not in varnames: continue
+                    entry = _index_variable(h5[path], var)
+                    if entry is not None: variables[path] = entry
+        finally:
+            ds.close()
+        return cls(ncpath, variables, filesize=stat.st_size, mtime=stat.st_mtime)
+
+    @classmethod
+    def load(cls, path, ncpath=None):
+        """
+        Load an index from the specified .npz file. The netcdf file path recorded in the index
+        may be overridden with ncpath, e.g. if the file has been moved.
+        """
+        variables = {}
+        with np.load(path) as npz:
+            meta = npz['meta']
+            for key in npz.files:
+                if _SEP not in key: continue
+                name, field = key.split(_SEP)
+                value = npz[key]
+                variables.setdefault(name, {})[field] = value if value.ndim else value[()]
+        for entry in variables.values():
+            entry['shape'] = tuple(int(n) for n in entry['shape'])
+            entry['chunkshape'] = tuple(int(n) for n in entry['chunkshape'])
+            entry['dtype'] = np.dtype(str(entry['dtype']))
+        return cls(ncpath or str(meta[0]), variables, filesize=int(meta[1]), mtime=float(meta[2]))
+
+    def save(self, path):
+        """Save the index to the specified .npz file."""
+        arrays = dict(meta=np.array([self.ncpath, str(self.filesize), repr(self.mtime)]))
+        for name, entry in self.variables.items():
+            for field, value in entry.items():
+                if field == 'dtype': value = value.str
+                arrays[name + _SEP + field] = np.asarray(value)
+        with open(path, 'wb') as fh:
+            np.savez(fh, **arrays)
+
+    def check(self):
+        """Raise a ValueError if the netcdf file has changed since the index was built."""
+        stat = os.stat(self.ncpath)
+        if stat.st_size != self.filesize or stat.st_mtime != self.mtime:
+            raise ValueError("Netcdf file {0} has changed since it was indexed.".format(self.ncpath))
+
+
+def _walk_variables(group, prefix=''):
+    """Generator function which yields (path, variable) pairs for all variables in group."""
+    for name, var in group.variables.items():
+        yield prefix + name, var
+    for name, grp in group.groups.items():
+        for item in _walk_variables(grp, prefix + name + '/'):
+            yield item
+
+
+def _index_variable(dset, var):
+    """Return the index entry for h5py dataset dset, which stores netcdf variable var."""
+    import h5py
+
+    dsid = dset.id
+    dtype = dset.dtype
+    if dtype.kind not in 'biuf' or not var.ndim or not var.size: return None
+    plist = dsid.get_create_plist()
+    filters = [plist.get_filter(i)[0] for i in range(plist.get_nfilters())]
+    if any(f not in SUPPORTED_FILTERS for f in filters): return None
+
+    # The extent of a record variable along the unlimited dimension may be less
+    # than that of the dimension, in which case netcdf reports the rest as fill.
+    shape = tuple(var.shape)
+    layout = plist.get_layout()
+    if layout == h5py.h5d.CHUNKED:
+        chunkshape = tuple(dset.chunks)
+        storage = nciter.HyperslabSequence(shape, chunkshape)
+        offsets = np.full(len(storage), -1, dtype=np.int64)
+        sizes = np.zeros(len(storage), dtype=np.int64)
+        masks = np.zeros(len(storage), dtype=np.uint32)
+        for i in range(dsid.get_num_chunks()):
+            info = dsid.get_chunk_info(i)
+            n = storage.chunk_number(info.chunk_offset)
+            offsets[n], sizes[n], masks[n] = info.byte_offset, info.size, info.filter_mask
+    elif layout == h5py.h5d.CONTIGUOUS:
+        chunkshape = shape
+        offset = dsid.get_offset()
+        offsets = np.array([-1 if offset is None else offset], dtype=np.int64)
+        sizes = np.array([dsid.get_storage_size()], dtype=np.int64)
+        masks = np.zeros(1, dtype=np.uint32)
+    else:
+        return None
+
+    attrs = var.ncattrs()
+    if '_FillValue' in attrs:
+        fill = np.array([var.getncattr('_FillValue')], dtype=dtype)
+    elif dtype.itemsize > 1:
+        fill = np.array([netCDF4.default_fillvals[dtype.str[1:]]], dtype=dtype)
+    else:
+        fill = np.array([], dtype=dtype)
+    missing = np.atleast_1d(var.getncattr('missing_value')).astype(dtype) if 'missing_value' in attrs \
+        else np.array([], dtype=dtype)
+
+    return dict(shape=shape, chunkshape=chunkshape, dtype=dtype, filters=np.array(filters, dtype=np.int32),
+        offsets=offsets, sizes=sizes, masks=masks, fill=fill, missing=missing,
+        scale=np.atleast_1d(var.getncattr('scale_factor')) if 'scale_factor' in attrs else np.array([]),
+        offset=np.atleast_1d(var.getncattr('add_offset')) if 'add_offset' in attrs else np.array([]))
+
+
+def iter_direct_chunks(index, varname, workers=None, processes=None, ordered=True, mask='ma'):
+    """
+    Iterate over the storage chunks of the variable varname (a path, as recorded in index) in
+    C order, reading and decoding them directly from the netcdf file described by index, a
+    ChunkByteIndex object or the path of an index file. Each iteration returns an NcDataChunk
+    object, as per nciter.iter_chunks. Chunks are decoded on a pool of workers threads or, if
+    processes is specified, on a pool of that many processes. The ordered and mask arguments
+    have the same meaning as for nciter.iter_chunks.
+    """
+    if not isinstance(index, ChunkByteIndex): index = ChunkByteIndex.load(index)
+    index.check()
+    entry = index.variables[varname]
+    hyperslabs = nciter.HyperslabSequence(entry['shape'], entry['chunkshape'])
+
+    if processes and processes > 1:
+        # Hand each worker only the per-variable metadata and its own chunk's location.
+        slim = dict((k, v) for k, v in entry.items() if k not in ('offsets', 'sizes', 'masks'))
+        tasks = ((index.ncpath, slim, int(entry['offsets'][n]), int(entry['sizes'][n]),
+            int(entry['masks'][n]), hs, mask) for n, hs in enumerate(hyperslabs))
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.imap(_read_task, tasks, 4) if ordered else pool.imap_unordered(_read_task, tasks, 4)
+            for chunk in results:
+                yield chunk
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+        return
+
+    reader = _DirectReader(index.ncpath, entry)
+    try:
+        numbered = (_Numbered(n, hs) for n, hs in enumerate(hyperslabs))
+        for chunk in nciter.read_hyperslabs(reader, numbered, workers, ordered, mask=mask,
+                reader=_read_direct):
+            yield chunk
+    finally:
+        reader.close()
+
+
+class _Numbered(object):
+    """A hyperslab together with its chunk number."""
+    __slots__ = ('n', 'hyperslab')
+
+    def __init__(self, n, hyperslab):
+        self.n = n
+        self.hyperslab = hyperslab
+
+
+class _DirectReader(object):
+    """Reads raw chunk bytes from a netcdf file using positioned reads."""
+
+    def __init__(self, path, entry):
+        self.entry = entry
+        self._fd = os.open(path, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+        self._lock = threading.Lock()
+
+    def read(self, offset, size):
+        if hasattr(os, 'pread'):
+            return os.pread(self._fd, size, offset)
+        with self._lock:
+            os.lseek(self._fd, offset, os.SEEK_SET)
+            return os.read(self._fd, size)
+
+    def close(self):
+        os.close(self._fd)
+
+
+def _read_direct(reader, item, mask='ma'):
+    """Read and decode chunk number item.n via reader, returning an NcDataChunk object."""
+    entry = reader.entry
+    offset, size, skipped = int(entry['offsets'][item.n]), int(entry['sizes'][item.n]), \
+        int(entry['masks'][item.n])
+    raw = reader.read(offset, size) if offset >= 0 else None
+    return _decode(raw, entry, skipped, item.hyperslab, mask)
+
+
+def _read_task(task):
+    """Worker function for reading a chunk in a separate process."""
+    path, entry, offset, size, skipped, hyperslab, mask = task
+    reader = _DirectReader(path, entry)
+    try:
+        raw = reader.read(offset, size) if offset >= 0 else None
+    finally:
+        reader.close()
+    return _decode(raw, entry, skipped, hyperslab, mask)
+
+
+def _decode(raw, entry, skipped, hyperslab, mask):
+    """
+    Decode the raw bytes of a chunk, reversing those stages of the variable's filter pipeline
+    which were not skipped (as given by the bits of skipped), and then mask and scale the data
+    as per the variable's attributes.
+    """
+    dtype, chunkshape = entry['dtype'], entry['chunkshape']
+    if raw is None:
+        fill = entry['fill'][0] if len(entry['fill']) else 0
+        data = np.full(chunkshape, fill, dtype=dtype)
+    else:
+        filters = entry['filters']
+        for i in reversed(range(len(filters))):
+            if skipped & (1 << i): continue
+            if filters[i] == FILTER_DEFLATE:
+                raw = zlib.decompress(raw)
+            elif filters[i] == FILTER_SHUFFLE:
+                raw = _unshuffle(raw, dtype.itemsize)
+            elif filters[i] == FILTER_FLETCHER32:
+                raw = _check_fletcher32(raw, hyperslab)
+        data = np.frombuffer(raw, dtype=dtype).reshape(chunkshape)
+
+    # Clip edge chunks, which are stored at full size, to the variable's extent.
+    data = data[tuple(slice(0, s.stop-s.start) for s in hyperslab)]
+
+    missing = None
+    if mask != 'none':
+        values = np.concatenate([entry['fill'], entry['missing']])
+        if len(values):
+            missing = np.isin(data, values)
+            if dtype.kind == 'f' and np.isnan(values).any(): missing |= np.isnan(data)
+
+    if len(entry['scale']) or len(entry['offset']):
+        scale = entry['scale'][0] if len(entry['scale']) else 1
+        offset = entry['offset'][0] if len(entry['offset']) else 0
+        data = data * scale + offset
+    elif not data.flags.writeable:
+        data = data.copy()
+
+    if mask == 'separate':
+        return nciter.NcDataChunk(data, hyperslab, mask=missing if missing is not None
+            else np.zeros(data.shape, dtype=bool))
+    elif mask == 'ma':
+        data = np.ma.MaskedArray(data, mask=missing if missing is not None else False)
+    return nciter.NcDataChunk(data, hyperslab)
+
+
+def _check_fletcher32(raw, hyperslab):
+    """
+    Verify the checksum appended to a chunk by the HDF5 fletcher32 filter, raising an IOError if
+    it does not match, and return the chunk without the checksum. As in HDF5, checksums written
+    with the byte order of old library versions are also accepted.
+    """
+    body, stored = raw[:-4], int(np.frombuffer(raw[-4:], dtype='<u4')[0])
+    checksum = _fletcher32(body)
+    swapped = ((checksum & 0x00ff00ff) << 8) | ((checksum >> 8) & 0x00ff00ff)
+    if stored not in (checksum, swapped):
+        raise IOError("Fletcher32 checksum mismatch in chunk {0}.".format(
+            [(sl.start, sl.stop) for sl in hyperslab]))
+    return body
+
+
+def _fletcher32(data):
+    """
+    Return the HDF5 fletcher32 checksum of data, computed over big-endian 16-bit words (with an
+    odd final byte padded with zero). The sums are formed modulo 65535, with a non-zero sum which
+    is a multiple of 65535 represented by 65535, as in HDF5's ones'-complement arithmetic.
+    """
+    words = np.frombuffer(data, dtype='>u2', count=len(data)//2).astype(np.uint64)
+    if len(data) % 2: words = np.append(words, np.uint64(bytearray(data[-1:])[0] << 8))
+    weights = np.arange(len(words), 0, -1, dtype=np.uint64) % 65535
+    sum1, sum2 = [x % 65535 or (65535 if x else 0)
+        for x in (int(words.sum()), int((words * weights).sum()))]
+    return (sum2 << 16) | sum1
+
+
+def _unshuffle(raw, itemsize):
+    """Reverse the HDF5 shuffle filter, which groups together the nth bytes of all elements."""
+    if itemsize == 1: return raw
+    nelems = len(raw) // itemsize
+    body = np.frombuffer(raw, dtype=np.uint8, count=nelems*itemsize).reshape(itemsize, nelems)
+    return body.T.tobytes() + raw[nelems*itemsize:]
+
+
+def parse_args():
+    """Parse command-line options and arguments"""
+    import optparse
+
+    usage = "usage: %prog [options] ncfile"
+    parser = optparse.OptionParser(usage=usage, version="0.1")
+    parser.add_option("-o", dest="idxfile",
+        help="index file to create (default: <ncfile>.chunkmap.npz)")
+    parser.add_option("-v", dest="varnames",
+        help="comma-separated list of variables to index (default: all)")
+
+    options, args = parser.parse_args()
+    if len(args) < 1 : parser.error("Insufficient arguments specified.")
+
+    ncfile = args[0]
+    if not os.path.exists(ncfile):
+        parser.error("File {0} does not exist.".format(ncfile))
+    if options.varnames: options.varnames = options.varnames.split(',')
+
+    return (options, ncfile)
+
+
+if __name__ == "__main__":
+    main()
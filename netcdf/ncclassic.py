@@ -0,0 +1,201 @@
+"""
+Direct, memory-mapped access to the variables in netcdf-3 format files (classic,
+64-bit offset and 64-bit data), bypassing the netcdf library.
+
+In these files each variable is stored contiguously, uncompressed and big-endian,
+at an offset recorded in the file header, so the data can be exposed as a numpy
+memmap with no library overhead. Record variables are interleaved record by
+record, and so are exposed as strided views onto the file. See the netcdf
+documentation for a description of the file format.
+
+ClassicNcVariable objects provide the shape, dtype and chunking() attributes used
+by the nciter module, so they can be passed to nciter.iter_chunks. Example:
+
+    ncfile = ClassicNcFile('tas.nc')
+    for chunk in iter_chunks(ncfile.variables['tas'], target_bytes=2**24):
+        ...
+"""
+
+import os
+import struct
+from collections import OrderedDict
+
+import numpy as np
+
+# netcdf-3 external data types, keyed by nc_type code.
+_CLASSIC_TYPES = {1: '>i1', 2: 'S1', 3: '>i2', 4: '>i4', 5: '>f4', 6: '>f8',
+    7: '>u1', 8: '>u2', 9: '>u4', 10: '>i8', 11: '>u8'}
+
+# Header tags.
+_NC_DIMENSION, _NC_VARIABLE, _NC_ATTRIBUTE = 10, 11, 12
+_STREAMING, _STREAMING64 = 0xFFFFFFFF, 0xFFFFFFFFFFFFFFFF
+
+
+class ClassicNcFile(object):
+    """
+    Parses the header of a netcdf-3 format file and provides memory-mapped
+    access to its variables. The dimensions attribute is a dictionary of
+    dimension lengths, the ncattrs attribute a dictionary of global attributes,
+    and the variables attribute a dictionary of ClassicNcVariable objects, all
+    keyed by name. The numrecs attribute is the current number of records.
+    """
+
+    def __init__(self, path):
+        """Initialize an instance object by reading the file header."""
+        self.path = path
+        with open(path, 'rb') as fh:
+            magic = fh.read(4)
+            if magic[:3] != b'CDF' or magic[3:] not in (b'\x01', b'\x02', b'\x05'):
+                raise ValueError("{0} is not a netcdf-3 format file.".format(path))
+            self.version = ord(magic[3:])
+            self._fh = fh
+            self._nfmt = '>Q' if self.version == 5 else '>I'         # nelems/vsize format
+            self._ofmt = '>I' if self.version == 1 else '>Q'         # begin offset format
+            numrecs = self._unpack(self._nfmt)
+
+            # Dimensions, global attributes and variables, in that order.
+            self.dimensions = OrderedDict()
+            self._dimnames = []
+            for i in range(self._read_list_header(_NC_DIMENSION)):
+                name = self._read_name()
+                self.dimensions[name] = self._unpack(self._nfmt)
+                self._dimnames.append(name)
+            self.ncattrs = self._read_attributes()
+
+            varinfo = []
+            for i in range(self._read_list_header(_NC_VARIABLE)):
+                name = self._read_name()
+                dimids = [self._unpack(self._nfmt) for j in range(self._unpack(self._nfmt))]
+                attrs = self._read_attributes()
+                nctype = self._unpack('>I')
+                vsize = self._unpack(self._nfmt)
+                begin = self._unpack(self._ofmt)
+                varinfo.append((name, [self._dimnames[j] for j in dimids], attrs, nctype, vsize, begin))
+            del self._fh
+
+        # Determine the record dimension and the size of each record, which is the
+        # sum of the sizes of all record variables. As a special case, records
+        # are not padded if there is only one record variable.
+        recdims = [name for name, n in self.dimensions.items() if n == 0]
+        self.recdim = recdims[0] if recdims else None
+        recvars = [v for v in varinfo if v[1] and v[1][0] == self.recdim]
+        if len(recvars) == 1:
+            name, dims, attrs, nctype, vsize, begin = recvars[0]
+            recsize = np.dtype(_CLASSIC_TYPES[nctype]).itemsize
+            for d in dims[1:]: recsize *= self.dimensions[d]
+        else:
+            recsize = sum(v[4] for v in recvars)
+        self.recsize = recsize
+
+        if numrecs == (_STREAMING64 if self.version == 5 else _STREAMING):
+            # Header written in streaming mode: infer record count from file size.
+            if recvars and recsize:
+                start = min(v[5] for v in recvars)
+                numrecs = (os.path.getsize(path) - start) // recsize
+            else:
+                numrecs = 0
+        self.numrecs = numrecs
+
+        self.variables = OrderedDict()
+        for name, dims, attrs, nctype, vsize, begin in varinfo:
+            self.variables[name] = ClassicNcVariable(self, name, dims, attrs,
+                _CLASSIC_TYPES[nctype], vsize, begin)
+
+    def _unpack(self, fmt):
+        """Read and return a single big-endian value with the specified format."""
+        return struct.unpack(fmt, self._fh.read(struct.calcsize(fmt)))[0]
+
+    def _read_list_header(self, tag):
+        """Read the tag and element count of a list, returning the count."""
+        found = self._unpack('>I')
+        nelems = self._unpack(self._nfmt)
+        if found not in (0, tag):
+            raise ValueError("Unexpected tag {0} in header of {1}.".format(found, self.path))
+        return nelems
+
+    def _read_name(self):
+        """Read a padded name string."""
+        n = self._unpack(self._nfmt)
+        name = self._fh.read(n)
+        self._fh.read(-n % 4)
+        return name.decode('utf-8')
+
+    def _read_attributes(self):
+        """Read an attribute list and return it as a dictionary."""
+        attrs = OrderedDict()
+        for i in range(self._read_list_header(_NC_ATTRIBUTE)):
+            name = self._read_name()
+            dtype = np.dtype(_CLASSIC_TYPES[self._unpack('>I')])
+            n = self._unpack(self._nfmt)
+            nbytes = n * dtype.itemsize
+            raw = self._fh.read(nbytes)
+            self._fh.read(-nbytes % 4)
+            if dtype.kind == 'S':
+                attrs[name] = raw.decode('utf-8')
+            else:
+                values = np.frombuffer(raw, dtype=dtype)
+                attrs[name] = values[0] if n == 1 else values
+        return attrs
+
+
+class ClassicNcVariable(object):
+    """
+    Provides memory-mapped access to a variable in a netcdf-3 format file.
+    Indexing an instance returns a view onto the file (values are raw, i.e.
+    no masking or scaling is applied), as does the array property. For
+    compatibility with the iteration functions in the nciter module the
+    chunking() method reports a chunk shape of a single record (or, for non-record
+    variables, a single index along the first dimension); use the target_bytes
+    option of iter_chunks to read larger blocks.
+    """
+
+    def __init__(self, ncfile, name, dimensions, attrs, dtype, vsize, begin):
+        """Initialize an instance object."""
+        self.name = name
+        self.dimensions = tuple(dimensions)
+        self.ncattrs = attrs
+        self.dtype = np.dtype(dtype)
+        self.vsize = vsize
+        self.begin = begin
+        self.isrecord = bool(dimensions) and dimensions[0] == ncfile.recdim
+        self.shape = tuple(ncfile.numrecs if self.isrecord and i == 0 else ncfile.dimensions[d]
+            for i, d in enumerate(dimensions))
+        self._path = ncfile.path
+        self._recsize = ncfile.recsize
+        self._array = None
+
+    def __getitem__(self, key):
+        return self.array[key]
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def array(self):
+        """Return the variable's data as a (possibly strided) read-only memmap."""
+        if self._array is None:
+            count = 1
+            for n in self.shape: count *= n
+            if count == 0:
+                self._array = np.empty(self.shape, dtype=self.dtype)
+            elif not self.isrecord:
+                self._array = np.memmap(self._path, dtype=self.dtype, mode='r',
+                    offset=self.begin, shape=self.shape)
+            else:
+                # Map from the first record to the end of the last one, then
+                # view it with a stride of one record along the first dimension.
+                nbytes = self.dtype.itemsize * (count // self.shape[0])
+                mm = np.memmap(self._path, dtype=np.uint8, mode='r', offset=self.begin,
+                    shape=((self.shape[0]-1)*self._recsize + nbytes,))
+                strides = [self.dtype.itemsize]
+                for n in reversed(self.shape[2:]): strides.insert(0, strides[0]*n)
+                strides = [self._recsize] + strides[:len(self.shape)-1]
+                self._array = np.ndarray(self.shape, dtype=self.dtype, buffer=mm,
+                    strides=strides)
+        return self._array
+
+    def chunking(self):
+        """Return the nominal chunk shape used for iteration."""
+        if not self.shape: return 'contiguous'
+        return [1] + list(self.shape[1:])
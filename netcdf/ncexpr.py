@@ -0,0 +1,301 @@
+"""
+A small lazy expression engine for netcdf variables. Arithmetic on wrapped
+variables builds an expression graph rather than reading any data; the graph
+is only evaluated, block by block, when a result is requested. Memory use is
+therefore bounded by the block size rather than by the size of the variables,
+so expressions over data many times larger than RAM can be evaluated.
+
+Operands are aligned according to the numpy broadcasting rules, and missing
+data is handled via numpy masked arrays. Reductions (sum, mean, min, max,
+count, var and std) may be taken over all or selected axes, and are computed
+using the streaming accumulators in the ncaccum module. Blocks are aligned
+with the chunks of the largest variable in the expression (or, where it is
+contiguous, bounded by the target block size), and are evaluated on a pool
+of threads if requested. Note that reads from the netcdf library
+are serialised (see nciter), so threads speed up the arithmetic rather than
+the I/O itself.
+
+Example:
+
+    t1, t2 = wrap(ds1.variables['t']), wrap(ds2.variables['t'])
+    rmse = sqrt(((t1 - t2)**2).mean()).compute(workers=4)
+    anomaly = t1 - t1.mean(axis=0)
+    for chunk in anomaly.iter_chunks():
+        ...
+"""
+
+import operator
+
+import numpy as np
+
+import nciter
+from ncaccum import Count, MeanVariance, MinMax
+
+# Default size of the blocks in which expressions are evaluated.
+DEFAULT_BLOCK_BYTES = 16 * 1024**2
+
+
+class Expr(object):
+    """
+    Base class for the nodes of an expression graph. Each node has a shape and
+    a dtype, and can evaluate an arbitrary hyperslab of itself via the _block
+    method. Subclasses implement _block and, if they have child nodes, the
+    children attribute.
+    """
+
+    children = ()
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape, dtype=np.int64))
+
+    # Elementwise arithmetic.
+    def __add__(self, other): return Elementwise(operator.add, self, other)
+    def __radd__(self, other): return Elementwise(operator.add, other, self)
+    def __sub__(self, other): return Elementwise(operator.sub, self, other)
+    def __rsub__(self, other): return Elementwise(operator.sub, other, self)
+    def __mul__(self, other): return Elementwise(operator.mul, self, other)
+    def __rmul__(self, other): return Elementwise(operator.mul, other, self)
+    def __truediv__(self, other): return Elementwise(operator.truediv, self, other)
+    def __rtruediv__(self, other): return Elementwise(operator.truediv, other, self)
+    __div__, __rdiv__ = __truediv__, __rtruediv__
+    def __pow__(self, other): return Elementwise(operator.pow, self, other)
+    def __rpow__(self, other): return Elementwise(operator.pow, other, self)
+    def __neg__(self): return Elementwise(operator.neg, self)
+    def __abs__(self): return Elementwise(np.ma.absolute, self)
+
+    # Elementwise comparisons, which yield boolean expressions.
+    def __lt__(self, other): return Elementwise(operator.lt, self, other)
+    def __le__(self, other): return Elementwise(operator.le, self, other)
+    def __gt__(self, other): return Elementwise(operator.gt, self, other)
+    def __ge__(self, other): return Elementwise(operator.ge, self, other)
+
+    # Reductions.
+    def sum(self, axis=None): return Reduction(self, 'sum', axis)
+    def mean(self, axis=None): return Reduction(self, 'mean', axis)
+    def min(self, axis=None): return Reduction(self, 'min', axis)
+    def max(self, axis=None): return Reduction(self, 'max', axis)
+    def count(self, axis=None): return Reduction(self, 'count', axis)
+    def var(self, axis=None, ddof=0): return Reduction(self, 'var', axis, ddof=ddof)
+    def std(self, axis=None, ddof=0): return Reduction(self, 'std', axis, ddof=ddof)
+
+    def iter_chunks(self, workers=None, ordered=True, target_bytes=DEFAULT_BLOCK_BYTES):
+        """
+        Evaluate the expression block by block, yielding an NcDataChunk object
+        for each block. The workers, ordered and target_bytes arguments have the
+        same meaning as for nciter.iter_chunks.
+        """
+        _prepare(self, workers, target_bytes)
+        hyperslabs = nciter.HyperslabSequence(self.shape, _block_shape(self, target_bytes))
+        for chunk in nciter.read_hyperslabs(self, hyperslabs, workers, ordered,
+                reader=_evaluate_block):
+            yield chunk
+
+    def compute(self, workers=None, target_bytes=DEFAULT_BLOCK_BYTES):
+        """
+        Evaluate the expression and return the result as a masked array. Note
+        that the entire result is held in memory.
+        """
+        result = np.ma.masked_all(self.shape, dtype=self.dtype)
+        for chunk in self.iter_chunks(workers=workers, ordered=False, target_bytes=target_bytes):
+            result[chunk.coords] = chunk.data
+        return result
+
+    def _block(self, hyperslab, memo):
+        raise NotImplementedError
+
+
+class VarExpr(Expr):
+    """An expression node which wraps a netcdf variable (or any array-like object)."""
+
+    def __init__(self, var):
+        self.var = var
+        self.shape = tuple(var.shape)
+        self.dtype = np.dtype(var.dtype)
+
+    def _block(self, hyperslab, memo):
+        key = id(self)
+        if key not in memo:
+            if isinstance(self.var, np.ndarray):
+                memo[key] = self.var[hyperslab]
+            else:
+                memo[key] = nciter.read_chunk(self.var, hyperslab).data
+        return memo[key]
+
+
+class Elementwise(Expr):
+    """
+    An expression node which applies function func elementwise to one or more
+    operands, which may be expressions, numpy arrays or scalars. The shape of
+    the result is determined by the numpy broadcasting rules.
+    """
+
+    def __init__(self, func, *operands):
+        self.func = func
+        self.children = tuple(wrap(op) for op in operands)
+        self.shape = _broadcast_shape([child.shape for child in self.children])
+        self.dtype = func(*[np.ones(1, dtype=child.dtype) for child in self.children]).dtype
+
+    def _block(self, hyperslab, memo):
+        key = id(self)
+        if key not in memo:
+            args = [child._block(_operand_slice(hyperslab, child.shape), memo)
+                for child in self.children]
+            memo[key] = self.func(*[np.ma.asarray(arg) for arg in args])
+        return memo[key]
+
+
+class Reduction(Expr):
+    """
+    An expression node which reduces its operand over the specified axis or
+    axes (by default all of them) using operator op, one of 'sum', 'mean',
+    'min', 'max', 'count', 'var' or 'std'. The reduction is computed, and its
+    result held in memory, when first needed.
+    """
+
+    _OPS = dict(sum=MeanVariance, mean=MeanVariance, var=MeanVariance, std=MeanVariance,
+        min=MinMax, max=MinMax, count=Count)
+
+    def __init__(self, operand, op, axis=None, ddof=0):
+        if op not in self._OPS:
+            raise ValueError("Invalid reduction operator: {0!r}".format(op))
+        self.op = op
+        self.ddof = ddof
+        self.children = (wrap(operand),)
+        ndim = self.children[0].ndim
+        if axis is None:
+            axis = range(ndim)
+        elif isinstance(axis, int):
+            axis = (axis,)
+        self.axis = tuple(sorted(set(a % ndim for a in axis)))
+        self.keep = tuple(d for d in range(ndim) if d not in self.axis)
+        self.shape = tuple(self.children[0].shape[d] for d in self.keep)
+        self.dtype = np.dtype(np.int64 if op == 'count' else np.float64)
+        self._value = None
+
+    def compute(self, workers=None, target_bytes=DEFAULT_BLOCK_BYTES):
+        """
+        Evaluate the reduction, and return the result as a masked array, or as
+        a scalar if the reduction is over all axes.
+        """
+        if self._value is None:
+            operand = self.children[0]
+            acc = self._OPS[self.op](operand.shape, keep=self.keep)
+            for chunk in operand.iter_chunks(workers=workers, ordered=False,
+                    target_bytes=target_bytes):
+                acc.update(chunk)
+            self._value = self._result(acc)
+        return self._value
+
+    def _result(self, acc):
+        if self.op == 'count':
+            value = acc.valid
+        elif self.op == 'sum':
+            value = np.ma.masked_where(acc.count == 0, acc.sum)
+        elif self.op == 'mean':
+            value = np.ma.masked_invalid(acc.mean)
+        elif self.op == 'var':
+            value = np.ma.masked_invalid(acc.variance(self.ddof))
+        elif self.op == 'std':
+            value = np.ma.masked_invalid(acc.std(self.ddof))
+        else:
+            value = np.ma.masked_invalid(getattr(acc, self.op))
+        return value[()] if not self.keep else value
+
+    def _block(self, hyperslab, memo):
+        return np.ma.asarray(self.compute())[hyperslab]
+
+
+def wrap(value):
+    """
+    Return value as an expression node. Netcdf variables (indeed any object
+    with shape and dtype attributes that supports slicing), numpy arrays and
+    scalars are all accepted.
+    """
+    if isinstance(value, Expr):
+        return value
+    if hasattr(value, 'shape') and hasattr(value, 'dtype'):
+        return VarExpr(value)
+    return VarExpr(np.asarray(value))
+
+
+def apply(func, *operands):
+    """
+    Return an expression which applies func, e.g. a numpy.ma ufunc such as
+    numpy.ma.sqrt, elementwise to the specified operands.
+    """
+    return Elementwise(func, *operands)
+
+
+def sqrt(x):
+    return Elementwise(np.ma.sqrt, x)
+
+
+def where(condition, x, y):
+    return Elementwise(np.ma.where, condition, x, y)
+
+
+def _broadcast_shape(shapes):
+    """Return the shape resulting from broadcasting arrays of the specified shapes."""
+    ndim = max(len(shape) for shape in shapes) if shapes else 0
+    result = []
+    for d in range(ndim):
+        sizes = set(shape[d - ndim + len(shape)] for shape in shapes if d >= ndim - len(shape))
+        sizes.discard(1)
+        if len(sizes) > 1:
+            raise ValueError("Operands with shapes {0} cannot be broadcast together.".format(
+                ', '.join(str(shape) for shape in shapes)))
+        result.append(sizes.pop() if sizes else 1)
+    return tuple(result)
+
+
+def _operand_slice(hyperslab, shape):
+    """
+    Return the part of an operand of the specified shape needed to evaluate the
+    specified hyperslab of a broadcast result.
+    """
+    offset = len(hyperslab) - len(shape)
+    return tuple(slice(0, 1) if n == 1 else hyperslab[offset + d] for d, n in enumerate(shape))
+
+
+def _leaves(expr):
+    """Generator function which yields the leaf nodes of expr, excluding reductions."""
+    if isinstance(expr, VarExpr):
+        yield expr
+    elif not isinstance(expr, Reduction):
+        for child in expr.children:
+            for leaf in _leaves(child):
+                yield leaf
+
+
+def _block_shape(expr, target_bytes):
+    """
+    Return the shape of the blocks in which expr is evaluated, given a target
+    block size in bytes (of double-precision values). Blocks are made up of
+    whole chunks of the largest full-rank netcdf variable in the expression. If
+    that variable is contiguous, or there is no such variable, then the shape
+    of the expression is instead divided into blocks of at most target_bytes.
+    """
+    variables = [leaf.var for leaf in _leaves(expr) if not isinstance(leaf.var, np.ndarray)
+        and tuple(leaf.shape) == tuple(expr.shape)]
+    if not variables: return nciter.split_shape(expr.shape, target_bytes, 8)
+    var = max(variables, key=lambda var: np.prod(var.shape))
+    return nciter.block_shape(var, target_bytes=target_bytes, itemsize=8)
+
+
+def _prepare(expr, workers, target_bytes):
+    """Compute any reductions nested within expr, innermost first."""
+    for child in expr.children:
+        _prepare(child, workers, target_bytes)
+        if isinstance(child, Reduction):
+            child.compute(workers=workers, target_bytes=target_bytes)
+
+
+def _evaluate_block(expr, hyperslab, mask='ma'):
+    """Evaluate the specified hyperslab of expr and return it as an NcDataChunk object."""
+    data = expr._block(tuple(hyperslab), {})
+    return nciter.NcDataChunk(np.ma.asarray(data), hyperslab)
@@ -20,9 +20,40 @@ links (plenty more like these on the web):
 - http://www.itmaybeahack.com/book/python-2.6/html/p02/p02c08_generators.html
 """
 
+from bisect import bisect_right
+from collections import deque, OrderedDict
 from itertools import product
+import heapq
 import math
+import multiprocessing
+import posixpath
+import threading
+import time
 import netCDF4
+import numpy as np
+
+# The concurrent.futures module is part of the standard library from Python 3.2,
+# and is available for Python 2.7 as the 'futures' backport. Without it, reads
+# requested on a pool of threads are made serially instead.
+try:
+    from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+except ImportError:
+    ThreadPoolExecutor = None
+
+# The netCDF-C and HDF5 libraries are not thread-safe, and netCDF4-python
+# releases the GIL while calling into them, so every read made by this module
+# is serialised through the following lock. Other modules which call into the
+# libraries from several threads, e.g. ncwrite, share the same lock.
+nc_lock = threading.RLock()
+
+# The shared chunk cache consulted by read_chunk, if one has been enabled; see
+# set_shared_cache and the nccache module.
+_chunk_cache = None
+
+try:
+    _string_types = basestring
+except NameError:
+    _string_types = str
 
 
 # Define a utility class for representing a netcdf data chunk and its hyperslab
@@ -32,10 +63,13 @@ class NcDataChunk(object):
     Trivial class for representing a chunk of data from a netcdf variable.
     Instances provide a handle to the data (a numpy array), plus the index-space
     coordinates (aka hyperslab) of the data chunk within the original source data.
+    If the data is a plain numpy array then the mask attribute may hold a separate
+    boolean array which is True where data values are missing.
     """
-    def __init__(self, data, coords):
+    def __init__(self, data, coords, mask=None):
         self.data = data
         self.coords = coords
+        self.mask = mask
 
     def __str__(self):
         return "data(shape={0.shape}, dtype={0.dtype}), space={1}".format(
@@ -47,21 +81,316 @@ class NcDataChunk(object):
 # described later. A hyperslab definition is a list of one or more fully-specified
 # slice objects, e.g. [slice(0, 2, 1), slice(0, 4, 1), ...]. The step (=stride)
 # component is always set to 1 in order that no data is skipped.
-def iter_hyperslabs(array_shape, chunk_shape):
+def iter_hyperslabs(array_shape, chunk_shape, target_bytes=None, max_chunk_multiple=None,
+        itemsize=1, region=None, order=None):
     """
     Generator function for iterating over the hyperslab objects that define
-    successive data chunks of an n-D array of the given shape.
+    successive data chunks of an n-D array of the given shape. If target_bytes
+    or max_chunk_multiple is specified then adjacent chunks are merged into
+    larger hyperslabs as described under coalesce_chunkshape. If region is
+    specified then only those chunks which intersect it are visited, and each
+    hyperslab is clipped to the region (see iter_chunks). The order argument
+    sets the order in which dimensions are traversed (see iter_chunks).
+    """
+    for hyperslab in HyperslabSequence(array_shape, chunk_shape, target_bytes=target_bytes,
+            max_chunk_multiple=max_chunk_multiple, itemsize=itemsize, region=region,
+            order=order):
+        yield hyperslab
+
+
+def _hyperslab_axes(array_shape, chunk_shape, target_bytes=None, max_chunk_multiple=None,
+        itemsize=1, region=None):
+    """
+    Return, for each dimension of an array of the given shape, the list of slice
+    objects that make up the hyperslabs returned by iter_hyperslabs. The hyper-
+    slabs themselves are the cartesian product of these lists.
     """
+    chunk_shape = coalesce_chunkshape(array_shape, chunk_shape, target_bytes=target_bytes,
+        max_chunk_multiple=max_chunk_multiple, itemsize=itemsize)
+    region = _normalize_region(array_shape, region)
+
     # This code could be compressed into a single list comprehension, albeit a
     # fairly obtuse one.
-    hyperslabs = []
+    axes = []
     for dim in range(len(array_shape)):
-        stop = array_shape[dim]
+        start, stop = region[dim].start, region[dim].stop
         step = chunk_shape[dim]
-        hyperslabs.append([slice(i,min(i+step,stop),1) for i in range(0,stop,step)])
+        if start >= stop or not step:
+            axes.append([])
+            continue
+        first = start - start % step
+        axes.append([slice(max(i,start),min(i+step,stop),1) for i in range(first,stop,step)])
 
-    for hyperslab in product(*hyperslabs):
-        yield hyperslab
+    return axes
+
+
+def _normalize_region(array_shape, region):
+    """
+    Return the specified index-space region of an array of the given shape as a
+    tuple of slice objects with explicit start and stop values. Region may be
+    None, meaning the whole array, or a sequence of slice objects, integers or
+    Nones, one per leading dimension. Any unspecified trailing dimensions are
+    taken in full.
+    """
+    if region is None: region = ()
+    if len(region) > len(array_shape):
+        raise ValueError("Region has more dimensions than the array.")
+
+    slices = []
+    for dim, n in enumerate(array_shape):
+        s = region[dim] if dim < len(region) else None
+        if s is None:
+            s = slice(None)
+        elif not isinstance(s, slice):
+            s = slice(int(s), int(s)+1 if s != -1 else None)
+        start, stop, step = s.indices(n)
+        if step != 1:
+            raise ValueError("Region slices must have a step of 1.")
+        slices.append(slice(start, max(start, stop), 1))
+
+    return tuple(slices)
+
+
+def _normalize_order(ndim, order):
+    """
+    Return the specified dimension traversal order for an array with ndim
+    dimensions as a tuple of dimension indices, outermost first. Order may be
+    None or 'C' (the last dimension varies fastest), 'F' (the first dimension
+    varies fastest), 'storage' (the order in which chunks are laid out in the
+    file, which for both contiguous and HDF5 chunked storage is C order), or a
+    permutation of the dimension indices.
+    """
+    if order is None or order in ('C', 'storage'):
+        return tuple(range(ndim))
+    elif order == 'F':
+        return tuple(reversed(range(ndim)))
+    perm = tuple(int(d) % ndim if ndim else int(d) for d in order)
+    if sorted(perm) != list(range(ndim)):
+        raise ValueError("Invalid dimension order: {0}".format(order))
+    return perm
+
+
+def region_from_coords(var, **bounds):
+    """
+    Return the index-space region of netcdf variable var which corresponds to
+    the specified coordinate-space bounds. Each keyword argument names one of
+    the variable's dimensions and gives a (lower, upper) pair of coordinate
+    values, e.g. lat=(-30, 30). The values of the coordinate variable of the
+    same name are compared against these bounds, which are inclusive. The
+    result is a tuple of slice objects suitable for passing to iter_chunks.
+    """
+    group = var.group()
+    region = [slice(None)] * len(var.dimensions)
+    for dimname, (lower, upper) in bounds.items():
+        if dimname not in var.dimensions:
+            raise ValueError("Variable {0} has no dimension named {1}.".format(var.name, dimname))
+        if dimname not in group.variables:
+            raise ValueError("No coordinate variable found for dimension {0}.".format(dimname))
+        if lower > upper: lower, upper = upper, lower
+        coords = group.variables[dimname][:]
+        indices = np.nonzero((coords >= lower) & (coords <= upper))[0]
+        dim = var.dimensions.index(dimname)
+        if len(indices):
+            region[dim] = slice(int(indices[0]), int(indices[-1])+1)
+        else:
+            region[dim] = slice(0, 0)
+    return tuple(region)
+
+
+# Define a utility class which presents the hyperslabs generated by iter_hyperslabs
+# as a lazy, random-access sequence. Only the per-dimension lists of slices are
+# stored; the hyperslab for a given chunk number is computed on demand by
+# treating the chunk number as a mixed-radix integer whose digits index into
+# those lists. This keeps the cost of len(), indexing and slicing independent of
+# the total number of chunks.
+class HyperslabSequence(object):
+    """
+    Lazy sequence of the hyperslab objects that define successive data chunks of
+    an n-D array, in the same order as returned by iter_hyperslabs, which takes
+    the same arguments. Instances support len(), iteration, indexing by chunk
+    number and slicing (which returns another HyperslabSequence). The index()
+    method maps a hyperslab back to its chunk number, while chunk_number() does
+    the same for the index of an individual array element. Chunk numbers count
+    through the chunks in the traversal order given by the order argument.
+    """
+
+    def __init__(self, array_shape, chunk_shape, target_bytes=None, max_chunk_multiple=None,
+            itemsize=1, region=None, order=None):
+        """Initialize an instance object."""
+        self._axes = _hyperslab_axes(array_shape, chunk_shape, target_bytes,
+            max_chunk_multiple, itemsize, region)
+        self._order = _normalize_order(len(array_shape), order)
+        self._starts = [[s.start for s in axis] for axis in self._axes]
+        total = 1
+        for axis in self._axes: total *= len(axis)
+        self._total = total
+        self._range = (0, 1, total)   # (first, step, length) of selected chunk numbers
+
+    def __len__(self):
+        return self._range[2]
+
+    def __iter__(self):
+        first, step, length = self._range
+        if first == 0 and step == 1 and length == self._total:
+            if self._order == tuple(range(len(self._axes))):
+                for hyperslab in product(*self._axes):
+                    yield hyperslab
+            else:
+                # Traverse the dimensions in the specified order, then put each
+                # hyperslab back into dimension order.
+                inverse = [self._order.index(d) for d in range(len(self._axes))]
+                for slices in product(*[self._axes[d] for d in self._order]):
+                    yield tuple(slices[i] for i in inverse)
+        else:
+            stop = first + length*step
+            for n in range(first, stop, step):
+                yield self._hyperslab(n)
+
+    def __getitem__(self, key):
+        first, step, length = self._range
+        if isinstance(key, slice):
+            start, stop, stride = key.indices(length)
+            seq = object.__new__(self.__class__)
+            seq.__dict__.update(self.__dict__)
+            count = max(0, (stop - start + stride - (1 if stride > 0 else -1)) // stride)
+            seq._range = (first + start*step, step*stride, count)
+            return seq
+        i = int(key)
+        if i < 0: i += length
+        if not 0 <= i < length:
+            raise IndexError("Chunk number out of range.")
+        return self._hyperslab(first + i*step)
+
+    def __contains__(self, hyperslab):
+        try:
+            self.index(hyperslab)
+        except ValueError:
+            return False
+        return True
+
+    def __repr__(self):
+        return "<HyperslabSequence: {0} chunks>".format(len(self))
+
+    def index(self, hyperslab):
+        """Return the chunk number of the specified hyperslab."""
+        hyperslab = tuple(hyperslab)
+        n = self._number([s.start for s in hyperslab])
+        if n is None or self._hyperslab(n) != tuple(slice(s.start, s.stop, 1) for s in hyperslab):
+            raise ValueError("Hyperslab is not in sequence.")
+        return self._position(n)
+
+    def chunk_number(self, index):
+        """
+        Return the number of the chunk which contains the array element at the
+        specified index, e.g. (0, 10, 20).
+        """
+        n = self._number(index)
+        if n is None:
+            raise ValueError("Index {0} lies outside the chunks in sequence.".format(tuple(index)))
+        return self._position(n)
+
+    def _number(self, index):
+        """
+        Return the number, within the full sequence, of the chunk containing the
+        element at the specified index, or None if no chunk contains it.
+        """
+        if len(index) != len(self._axes): return None
+        n = 0
+        for d in self._order:
+            axis, i = self._axes[d], index[d]
+            digit = bisect_right(self._starts[d], i) - 1
+            if digit < 0 or i >= axis[digit].stop: return None
+            n = n*len(axis) + digit
+        return n
+
+    def _position(self, n):
+        """Map chunk number n of the full sequence to its position in this one."""
+        first, step, length = self._range
+        i, rem = divmod(n - first, step)
+        if rem or not 0 <= i < length:
+            raise ValueError("Chunk {0} is not in sequence.".format(n))
+        return i
+
+    def _hyperslab(self, n):
+        """Return the hyperslab for chunk number n of the full sequence."""
+        hyperslab = [None] * len(self._axes)
+        for d in reversed(self._order):
+            n, digit = divmod(n, len(self._axes[d]))
+            hyperslab[d] = self._axes[d][digit]
+        return tuple(hyperslab)
+
+
+# Define a utility function for merging small storage chunks into larger read
+# units. Chunks are merged along the innermost (fastest-varying) dimension first
+# and only spill over into the next dimension out once a merged chunk spans the
+# whole of the inner one. Each merged chunk is therefore a contiguous run of
+# storage chunks in C order, and its boundaries remain aligned with theirs.
+def coalesce_chunkshape(array_shape, chunk_shape, target_bytes=None, max_chunk_multiple=None,
+        itemsize=1):
+    """
+    Return the shape of the hyperslabs obtained by merging adjacent chunks of the
+    given shape such that each hyperslab holds no more than target_bytes bytes
+    (for elements of size itemsize) and no more than max_chunk_multiple chunks.
+    If neither limit is specified then the chunk shape is returned unchanged.
+    """
+    shape = list(chunk_shape)
+    if not (target_bytes or max_chunk_multiple): return tuple(shape)
+
+    nbytes = itemsize
+    for n in shape: nbytes *= n
+    multiple = 1
+
+    for dim in reversed(range(len(shape))):
+        nchunks = int(math.ceil(float(array_shape[dim])/chunk_shape[dim]))
+        k = nchunks
+        if target_bytes: k = min(k, target_bytes // max(nbytes, 1))
+        if max_chunk_multiple: k = min(k, max_chunk_multiple // multiple)
+        k = max(int(k), 1)
+        shape[dim] = min(chunk_shape[dim]*k, array_shape[dim])
+        nbytes *= k
+        multiple *= k
+        if k < nchunks: break
+
+    return tuple(shape)
+
+
+# Define a utility function for dividing a contiguous array into blocks of no
+# more than a given size. Each block spans the full extent of the dimensions
+# inside the outermost one that it splits, and a single index of those outside
+# it, so that every block is a contiguous run of the array in C order.
+def split_shape(array_shape, target_bytes, itemsize=1):
+    """
+    Return the shape of the largest blocks, each a contiguous run of elements
+    in C order, into which an array of the given shape can be divided such that
+    each block holds no more than target_bytes bytes (for elements of size
+    itemsize). A block always holds at least one element.
+    """
+    shape = [1] * len(array_shape)
+    nbytes = itemsize
+    for dim in reversed(range(len(array_shape))):
+        n = array_shape[dim]
+        k = max(min(n, target_bytes // nbytes), 1)
+        shape[dim] = k
+        if k < n: break
+        nbytes *= max(n, 1)
+    return tuple(shape)
+
+
+def block_shape(var, target_bytes=None, max_chunk_multiple=None, itemsize=None):
+    """
+    Return the shape of the hyperslabs in which netcdf variable var is read for
+    the specified options, which have the same meaning as for iter_chunks. The
+    chunks of a chunked variable are merged as per coalesce_chunkshape. A
+    contiguous variable, such as any variable in a netcdf-3 file, is read in a
+    single piece unless target_bytes is specified, in which case it is divided
+    into blocks as per split_shape. The itemsize argument overrides the size of
+    the variable's elements, e.g. if blocks are converted to another data type.
+    """
+    if itemsize is None: itemsize = _get_itemsize(var)
+    if target_bytes and not isinstance(var.chunking(), (list, tuple)):
+        return split_shape(var.shape, target_bytes, itemsize)
+    return coalesce_chunkshape(var.shape, get_chunkshape(var), target_bytes=target_bytes,
+        max_chunk_multiple=max_chunk_multiple, itemsize=itemsize)
 
 
 # Solution 1
@@ -70,28 +399,481 @@ def iter_hyperslabs(array_shape, chunk_shape):
 # specified netcdf variable, var. This is the simplest and safest solution.
 
 
-def iter_chunks(var):
+def iter_chunks(var, workers=None, ordered=True, max_inflight=None, target_bytes=None,
+        max_chunk_multiple=None, region=None, order=None, mask='ma', buffers=None,
+        where=None, index=None, shard=None, nshards=None, strategy='contiguous', weights=None,
+        checkpoint=None, stats=None):
     """
-    Iterate over the chunks in a netCDF variable in C order. If variable var
-    is not chunked (i.e. it's contiguous) then a single chunk representing the
-    entire variable is returned. Each iteration returns an NcDataChunk object,
-    which provides access to the numpy array for the chunk as well as the index-
-    space coordinates of the chunk within the netcdf variable. Note that the
-    data chunk is a separate numpy array rather than a view into the source
-    array owned by the var object. This means that changes to the chunk array
-    do not get applied to the source array by default.
+    Iterate over the chunks in a netCDF variable, by default in C order. If
+    variable var is not chunked (i.e. it's contiguous) then a single chunk
+    representing the entire variable is returned, unless target_bytes is
+    specified (see below). Each iteration returns an NcDataChunk object, which
+    provides access to the numpy array for the chunk as well as the index-space
+    coordinates of the chunk within the netcdf variable. Note that the data
+    chunk is a separate numpy array rather than a view into the source array
+    owned by the var object. This means that changes to the chunk array do not
+    get applied to the source array by default.
+
+    If workers is set to an integer greater than 1 then chunks are read ahead
+    on a pool of that many threads. In this case the ordered argument
+    determines whether chunks are yielded in iteration order (the default) or
+    in the order in which they finish reading, and max_inflight caps the number
+    of chunks that may be queued or held in memory at any one time (by default
+    twice the number of workers). Since the underlying netcdf and HDF5 libraries
+    are not thread-safe, the reads themselves, including decompression, are
+    serialised, so the pool only overlaps reading with the caller's processing
+    of earlier chunks. For parallel decoding use chunk_map_reduce, which reads
+    in separate processes, or the ncchunkmap module, which decodes the raw
+    chunk bytes outside of the netcdf library. Under Python 2.7 the pool requires
+    the futures backport of the concurrent.futures module; if this is missing
+    then chunks are read serially.
+
+    If target_bytes or max_chunk_multiple is specified then adjacent chunks are
+    merged into larger hyperslabs, each of up to target_bytes bytes or spanning
+    up to max_chunk_multiple chunks, which are then read in a single operation.
+    A contiguous variable is instead divided into blocks of up to target_bytes
+    bytes, each a contiguous run of the variable in C order (see block_shape).
+
+    If region is specified then only the chunks which intersect that region
+    are read, and each chunk is clipped to the region. The region is a tuple
+    of slice objects (or integers) in index space, one per leading dimension;
+    see region_from_coords for defining a region in coordinate space. Note
+    that chunk coordinates are still expressed in the index space of the full
+    variable.
+
+    The order argument sets the order in which the variable's dimensions are
+    traversed. It may be 'C' (the default), 'F', 'storage', or a permutation of
+    the dimensions, given as indices or names and listed outermost first. For
+    example, order=('lat', 'lon', 'time') visits the full time series of each
+    spatial chunk in turn. See also set_chunk_cache.
+
+    The mask argument determines how missing data is represented. By default
+    ('ma') chunk data is returned as a numpy masked array. If set to 'separate'
+    then chunk data is returned as a plain numpy array, with a boolean array
+    of missing values in the chunk's mask attribute. If set to 'none' then the
+    variable's automatic masking is turned off while reading, so that missing
+    values appear as the raw fill values and no mask is computed at all.
+
+    If buffers is set to an integer N then each chunk is copied into one of a
+    rotating pool of N preallocated arrays of the full chunk shape (edge chunks
+    are returned as views), so that no new arrays are handed to the consumer
+    during iteration. The data for a chunk is therefore only valid until N more
+    chunks have been read. Note that netCDF4-python does not support decoding
+    into a caller-supplied array, so this option bounds the memory held by the
+    consumer rather than avoiding the library's own allocation for each read.
+
+    If where is specified then it should be a predicate function which is
+    passed an ncchunkidx.ChunkStatsIndex object for the variable and returns a
+    boolean array, or a list of chunk numbers, identifying those storage chunks
+    which may contain data of interest, e.g. lambda s: s.max > 40. Chunks which
+    cannot match are skipped without being read. The index is taken from the
+    index argument or else loaded from the variable's default sidecar file (see
+    the ncchunkidx module).
+
+    If shard and nshards are specified then only the chunks belonging to shard
+    number shard (counting from 0) of nshards are read, e.g. to split a job
+    across an array of batch tasks. The two arguments must be given together,
+    and a ValueError is raised unless 0 <= shard < nshards. The strategy
+    argument determines how chunks are assigned to shards; see shard_hyperslabs
+    for details. For the 'balanced' strategy the chunks are weighted by their
+    compressed storage size if this can be determined (see
+    get_chunk_storage_sizes), or else by the explicit weights argument, one
+    value per chunk in iteration order.
+
+    If checkpoint is specified then it should be an nccheckpoint.ChunkCheckpoint
+    object, which records the number of chunks consumed so far, together with
+    the caller's own state, and saves them to file at regular intervals. If the
+    checkpoint was loaded from an earlier, interrupted run then iteration
+    resumes with the first chunk that had not been consumed. A chunk counts as
+    consumed once the caller asks for the next one. The same arguments must be
+    used for each run, otherwise a ValueError is raised, and chunks must be
+    returned in order.
+
+    If stats is specified then it should be an ncprofile.ChunkIterStats object,
+    in which read latencies, decoded sizes, queue waits and consumer processing
+    times are recorded for each chunk.
     """
 
-    # Get the chunk shape, if any, used by the variable.
-    chunkshape = var.chunking()
+    hyperslabs = var_hyperslabs(var, target_bytes=target_bytes,
+        max_chunk_multiple=max_chunk_multiple, region=region, order=order)
+
+    if shard is not None or nshards is not None:
+        if shard is None or nshards is None:
+            raise ValueError("The shard and nshards arguments must be specified together.")
+        if strategy == 'balanced' and weights is None:
+            weights = hyperslab_weights(var, hyperslabs)
+        hyperslabs = shard_hyperslabs(hyperslabs, shard, nshards, strategy=strategy,
+            weights=weights)
+
+    if where is not None:
+        if index is None:
+            from ncchunkidx import ChunkStatsIndex
+            index = ChunkStatsIndex.load(ChunkStatsIndex.sidecar_path(var.group().filepath(),
+                var.name))
+        hyperslabs = index.filter_hyperslabs(var, hyperslabs, index.select(where))
+
+    if checkpoint is not None:
+        if not ordered:
+            raise ValueError("Checkpointing requires chunks to be returned in order.")
+        hyperslabs = checkpoint._resume(var, hyperslabs)
+
+    read = read_chunk if stats is None else stats._reader(read_chunk)
+
+    # Loop over all chunk-sized hyperslabs, reading them in parallel if requested.
+    chunks = read_hyperslabs(var, hyperslabs, workers, ordered, max_inflight, mask, reader=read)
+
+    if buffers:
+        pool = _ChunkBufferPool(block_shape(var, target_bytes=target_bytes,
+            max_chunk_multiple=max_chunk_multiple), buffers)
+        chunks = (pool.fill(chunk) for chunk in chunks)
 
-    # If variable is contiguous then set chunk shape equal to variable shape.
+    if stats is not None:
+        chunks = stats._track(chunks)
+
+    if checkpoint is not None:
+        chunks = checkpoint._track(chunks)
+
+    for chunk in chunks:
+        yield chunk
+
+
+def get_chunkshape(var):
+    """
+    Return the chunk shape used by variable var. If the variable is contiguous
+    then the chunk shape is equal to the variable shape.
+    """
+    chunkshape = var.chunking()
     if not isinstance(chunkshape, (list, tuple)):
         chunkshape = var.shape
+    return chunkshape
+
+
+def var_hyperslabs(var, target_bytes=None, max_chunk_multiple=None, region=None, order=None):
+    """
+    Return a HyperslabSequence for iterating over the chunks of variable var
+    with the specified options, which have the same meaning as for iter_chunks.
+    """
+    if order is not None and not isinstance(order, _string_types):
+        order = [var.dimensions.index(d) if isinstance(d, _string_types) else d for d in order]
+    return HyperslabSequence(var.shape, block_shape(var, target_bytes=target_bytes,
+        max_chunk_multiple=max_chunk_multiple), region=region, order=order)
+
+
+def shard_hyperslabs(hyperslabs, shard, nshards, strategy='contiguous', weights=None):
+    """
+    Return the subset of a sequence of hyperslabs, e.g. a HyperslabSequence,
+    which belongs to shard number shard of nshards. The assignment of hyperslabs
+    to shards depends only on the arguments, so each shard can be computed
+    independently, and reproducibly, by a separate process or batch task. The
+    hyperslabs in each shard are returned in their original order.
+
+    The 'contiguous' strategy (the default) splits the hyperslabs into nshards
+    runs of near-equal length, which keeps each shard's reads close together
+    on disk. The 'round_robin' strategy deals hyperslabs out to each shard in
+    turn. The 'balanced' strategy assigns hyperslabs to shards such that the
+    sums of their weights are as near equal as possible, largest first, with
+    ties broken by position so that the result is deterministic. The weights
+    argument, one number per hyperslab, is required for this strategy.
+    """
+    if shard is None or nshards is None or not 0 <= int(shard) < int(nshards):
+        raise ValueError("Invalid shard {0} of {1} shards.".format(shard, nshards))
+    shard, nshards = int(shard), int(nshards)
+    n = len(hyperslabs)
+
+    if strategy == 'contiguous':
+        return hyperslabs[shard*n//nshards:(shard+1)*n//nshards]
+    elif strategy == 'round_robin':
+        return hyperslabs[shard::nshards]
+    elif strategy == 'balanced':
+        if weights is None:
+            raise ValueError("The balanced sharding strategy requires chunk weights.")
+        weights = np.asarray(weights, dtype=np.float64)
+        if weights.shape != (n,):
+            raise ValueError("Expected {0} chunk weights, got {1}.".format(n, weights.size))
+        loads = [(0.0, s) for s in range(nshards)]
+        owner = np.empty(n, dtype=np.int64)
+        for i in sorted(range(n), key=lambda i: (-weights[i], i)):
+            load, s = heapq.heappop(loads)
+            owner[i] = s
+            heapq.heappush(loads, (load + weights[i], s))
+        return [hyperslabs[int(i)] for i in np.nonzero(owner == shard)[0]]
+    else:
+        raise ValueError("Invalid sharding strategy: {0!r}".format(strategy))
+
+
+def get_chunk_storage_sizes(var):
+    """
+    Return an array of the compressed size in bytes of each storage chunk of
+    netCDF variable var, indexed by chunk number in C order, or None if the
+    sizes cannot be determined. Chunks which have not been written have size
+    zero. This requires the optional h5py module, and a netcdf-4 format file.
+    """
+    try:
+        import h5py
+    except ImportError:
+        return None
+
+    grp = var.group()
+    storage = HyperslabSequence(var.shape, get_chunkshape(var))
+    sizes = np.zeros(len(storage), dtype=np.int64)
+    try:
+        with nc_lock:
+            with h5py.File(grp.filepath(), 'r') as h5:
+                dsid = h5[posixpath.join(grp.path, var.name)].id
+                if not isinstance(var.chunking(), (list, tuple)):
+                    sizes[:] = dsid.get_storage_size()
+                    return sizes
+                for i in range(dsid.get_num_chunks()):
+                    info = dsid.get_chunk_info(i)
+                    sizes[storage.chunk_number(info.chunk_offset)] = info.size
+    except (IOError, OSError, KeyError, ValueError):
+        return None
+    return sizes
+
+
+def hyperslab_weights(var, hyperslabs, sizes=None):
+    """
+    Return an array of weights, one per hyperslab of variable var, suitable for
+    use with the 'balanced' sharding strategy. Each weight is the total storage
+    size of the chunks which intersect the hyperslab, using compressed sizes if
+    available (see get_chunk_storage_sizes) or else the uncompressed size of
+    the hyperslab itself.
+    """
+    if sizes is None: sizes = get_chunk_storage_sizes(var)
+    if sizes is None:
+        itemsize = _get_itemsize(var)
+        return np.array([np.prod([s.stop-s.start for s in hs]) * itemsize for hs in hyperslabs],
+            dtype=np.float64)
+    chunkshape = get_chunkshape(var)
+    storage = HyperslabSequence(var.shape, chunkshape)
+    return np.array([sizes[storage_chunk_numbers(storage, var.shape, chunkshape, hs)].sum()
+        for hs in hyperslabs], dtype=np.float64)
 
-    # Loop over all chunk-sized hyperslabs.
-    for hyperslab in iter_hyperslabs(var.shape, chunkshape):
-        yield NcDataChunk(var[hyperslab], hyperslab)
+
+def storage_chunk_numbers(storage, array_shape, chunk_shape, hyperslab):
+    """
+    Return the numbers, within HyperslabSequence storage, of the storage chunks
+    which intersect the specified hyperslab.
+    """
+    return [storage.chunk_number([s.start for s in chunk])
+        for chunk in HyperslabSequence(array_shape, chunk_shape, region=hyperslab)]
+
+
+def set_chunk_cache(var, target_bytes=None, max_chunk_multiple=None, region=None, order=None,
+        max_bytes=None, preemption=0.75):
+    """
+    Size the HDF5 chunk cache of netcdf variable var so that it can hold all of
+    the storage chunks visited during one sweep along the innermost dimension
+    of the specified iteration order (e.g. the full time series of one spatial
+    chunk for order=('lat', 'lon', 'time')). Those chunks then remain in cache
+    while the sweep is in progress, so any re-reads within it, such as those
+    made by overlapping or misaligned hyperslabs, are served from memory. The
+    remaining arguments have the same meaning as for iter_chunks, except that
+    max_bytes, if specified, caps the cache size. The (size, nelems, preemption)
+    settings applied to the variable are returned.
+    """
+    chunkshape = get_chunkshape(var)
+    readshape = block_shape(var, target_bytes=target_bytes, max_chunk_multiple=max_chunk_multiple)
+    hyperslabs = var_hyperslabs(var, target_bytes=target_bytes,
+        max_chunk_multiple=max_chunk_multiple, region=region, order=order)
+
+    # Count the storage chunks spanned by each read, and the reads per sweep.
+    nchunks = 1
+    for n, c in zip(readshape, chunkshape):
+        nchunks *= int(math.ceil(float(n)/c)) if c else 1
+    if var.ndim:
+        nchunks *= max(len(hyperslabs._axes[hyperslabs._order[-1]]), 1)
+
+    chunkbytes = _get_itemsize(var)
+    for c in chunkshape: chunkbytes *= c
+    size = nchunks * chunkbytes
+    if max_bytes: size = min(size, max_bytes)
+
+    # HDF5 recommends a prime number of hash slots, well in excess of the number
+    # of chunks that can be held in the cache.
+    nelems = _next_prime(max(1009, 10*nchunks))
+
+    var.set_var_chunk_cache(size=size, nelems=nelems, preemption=preemption)
+    return (size, nelems, preemption)
+
+
+def _next_prime(n):
+    """Return the smallest prime number greater than or equal to n."""
+    n = max(n, 2)
+    while True:
+        for i in range(2, int(math.sqrt(n))+1):
+            if n % i == 0: break
+        else:
+            return n
+        n += 1
+
+
+def _get_itemsize(var):
+    """Return the size in bytes of each element of variable var."""
+    return np.dtype(var.dtype).itemsize
+
+
+def array_nbytes(data):
+    """Return the number of bytes occupied by an array, including any mask."""
+    mask = np.ma.getmask(data)
+    return data.nbytes + (0 if mask is np.ma.nomask else mask.nbytes)
+
+
+def set_shared_cache(cache):
+    """
+    Install cache as the shared chunk cache consulted by read_chunk, and hence
+    by iter_chunks and the other readers in this module, or remove the current
+    cache if cache is None. The cache must provide key, get and put methods as
+    per nccache.ChunkCache. Returns the cache previously installed, if any.
+    """
+    global _chunk_cache
+    previous, _chunk_cache = _chunk_cache, cache
+    return previous
+
+
+def get_shared_cache():
+    """Return the shared chunk cache consulted by read_chunk, or None."""
+    return _chunk_cache
+
+
+def read_chunk(var, hyperslab, mask='ma'):
+    """
+    Read the specified hyperslab from var and return it as an NcDataChunk. The
+    mask argument has the same meaning as for iter_chunks.
+    """
+    if mask not in ('ma', 'separate', 'none'):
+        raise ValueError("Unrecognised mask option: {0}".format(mask))
+
+    # Look for the chunk in the shared chunk cache, if one is enabled.
+    cache = _chunk_cache
+    key = data = None
+    if cache is not None:
+        key = cache.key(var, hyperslab, mask == 'none')
+        if key is not None: data = cache.get(key)
+
+    if data is None:
+        with nc_lock:
+            if mask == 'none' and getattr(var, 'mask', False):
+                var.set_auto_mask(False)
+                try:
+                    data = var[hyperslab]
+                finally:
+                    var.set_auto_mask(True)
+            else:
+                data = var[hyperslab]
+        if key is not None: cache.put(key, data)
+
+    if mask == 'ma':
+        return NcDataChunk(data, hyperslab)
+    elif mask == 'none':
+        return NcDataChunk(np.ma.getdata(data), hyperslab)
+    else:
+        return NcDataChunk(np.ma.getdata(data), hyperslab, mask=np.ma.getmaskarray(data))
+
+
+def read_hyperslabs(var, hyperslabs, workers=None, ordered=True, max_inflight=None, mask='ma',
+        reader=None):
+    """
+    Return an iterator over the specified hyperslabs of variable var, e.g. those
+    of a HyperslabSequence, which yields an NcDataChunk object for each one. The
+    workers, ordered, max_inflight and mask arguments have the same meaning as
+    for iter_chunks. Each hyperslab is read by calling reader(var, hyperslab,
+    mask), by default read_chunk. Other readers may be used to present other
+    sources of chunks, in which case var may be any object the reader accepts.
+    """
+    if reader is None: reader = read_chunk
+    if workers and workers > 1:
+        return _iter_chunks_threaded(var, hyperslabs, workers, ordered, max_inflight, mask,
+            reader=reader)
+    return (reader(var, hs, mask) for hs in hyperslabs)
+
+
+class _ChunkBufferPool(object):
+    """
+    Rotating pool of preallocated arrays into which successive data chunks are
+    copied. The arrays are allocated, with the specified shape, when the first
+    chunk arrives; smaller chunks occupy a leading view of an array.
+    """
+
+    def __init__(self, shape, size):
+        """Initialize an instance object."""
+        self._shape = tuple(shape)
+        self._size = max(int(size), 1)
+        self._data = []
+        self._masks = [None] * self._size
+        self._next = 0
+
+    def fill(self, chunk):
+        """Copy chunk into the next array in the pool and return a new NcDataChunk."""
+        if not self._data:
+            dtype = np.asarray(chunk.data).dtype
+            self._data = [np.empty(self._shape, dtype=dtype) for i in range(self._size)]
+        k = self._next
+        self._next = (k+1) % self._size
+
+        view = tuple(slice(0, n) for n in np.shape(chunk.data))
+        data = self._data[k][view]
+        np.copyto(data, np.ma.getdata(chunk.data))
+
+        mask = np.ma.getmask(chunk.data) if np.ma.isMA(chunk.data) else chunk.mask
+        if mask is not None and mask is not np.ma.nomask:
+            if self._masks[k] is None: self._masks[k] = np.empty(self._shape, dtype=bool)
+            np.copyto(self._masks[k][view], mask)
+            mask = self._masks[k][view]
+
+        if np.ma.isMA(chunk.data):
+            data = np.ma.MaskedArray(data, mask=np.ma.nomask if mask is None else mask, copy=False)
+            return NcDataChunk(data, chunk.coords)
+        return NcDataChunk(data, chunk.coords, mask=mask)
+
+
+def _iter_chunks_threaded(var, hyperslabs, workers, ordered=True, max_inflight=None, mask='ma',
+        reader=None):
+    """
+    Generator function which reads the specified hyperslabs from var using a
+    pool of worker threads, yielding NcDataChunk objects either in the order in
+    which the hyperslabs were supplied or else as and when they are completed.
+    No more than max_inflight hyperslabs are submitted to the pool at once.
+    Hyperslabs are read using function reader, which defaults to read_chunk.
+    If the concurrent.futures module is unavailable then they are read serially.
+    """
+    if reader is None: reader = read_chunk
+    if ThreadPoolExecutor is None:
+        for hs in hyperslabs:
+            yield reader(var, hs, mask)
+        return
+    if max_inflight is None: max_inflight = 2 * workers
+    max_inflight = max(int(max_inflight), 1)
+
+    # Pending futures are kept in submission order if ordered output is wanted.
+    pending = deque() if ordered else set()
+    executor = ThreadPoolExecutor(max_workers=workers)
+
+    def next_chunk():
+        if ordered:
+            future = pending.popleft()
+        else:
+            done = wait(pending, return_when=FIRST_COMPLETED)[0]
+            future = done.pop()
+            pending.remove(future)
+        return future.result()
+
+    try:
+        for hs in hyperslabs:
+            if len(pending) >= max_inflight:
+                yield next_chunk()
+            future = executor.submit(reader, var, hs, mask)
+            if ordered:
+                pending.append(future)
+            else:
+                pending.add(future)
+        while pending:
+            yield next_chunk()
+    finally:
+        # Abandon any outstanding reads if the consumer stops iterating early.
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=True)
 
 
 # Solution 2
@@ -106,13 +888,19 @@ class ProxyNcVariable(object):
     Put a wrapper around a netcdf variable so that it can be iterated over in
     data chunks whose size is defined by the variable's chunking settings. In
     the case of variables that use contiguous data storage (which includes ALL
-    netcdf-3 variables), a single data chunk is returned.
+    netcdf-3 variables), a single data chunk is returned. If target_bytes or
+    max_chunk_multiple is specified then adjacent chunks are merged into larger
+    data chunks, if region is specified then iteration is restricted to that
+    region, and order sets the order in which dimensions are traversed, all as
+    described under iter_chunks.
     """
 
-    def __init__(self, var):
+    def __init__(self, var, target_bytes=None, max_chunk_multiple=None, region=None, order=None):
         """Initialize an instance object."""
         self._var = var     # reference to the actual netcdf variable object
         self._nchunks = None
+        self._options = dict(target_bytes=target_bytes, max_chunk_multiple=max_chunk_multiple,
+            region=region, order=order)
 
     def __getattr__(self, attr):
         """Hand off any other attribute/method requests to the real variable."""
@@ -122,21 +910,34 @@ class ProxyNcVariable(object):
     # Therefore we don't need to define a next() method within this class.
     def __iter__(self):
         """Iterate over all data chunks"""
-        for hs in iter_hyperslabs(self._var.shape, self._chunkshape):
-            yield self._var[hs]
+        for hs in self.hyperslabs:
+            yield read_chunk(self._var, hs).data
+
+    def prefetch(self, depth=2, max_bytes=None):
+        """
+        Return an NcChunkPrefetcher object which iterates over all data chunks,
+        reading up to depth chunks (or max_bytes bytes) ahead of the consumer.
+        """
+        return NcChunkPrefetcher(self._var, depth=depth, max_bytes=max_bytes, **self._options)
+
+    def set_chunk_cache(self, max_bytes=None, preemption=0.75):
+        """
+        Size the HDF5 chunk cache of the underlying variable to suit iteration
+        over its chunks, as described under the set_chunk_cache function.
+        """
+        return set_chunk_cache(self._var, max_bytes=max_bytes, preemption=preemption,
+            **self._options)
 
     @property
     def hyperslabs(self):
-        """Return a list of hyperslab objects that define all data chunks."""
-        return list(iter_hyperslabs(self._var.shape, self._chunkshape))
+        """Return a lazy sequence of hyperslab objects that define all data chunks."""
+        return var_hyperslabs(self._var, **self._options)
 
     @property
     def nchunks(self):
-        """Return the total number of chunks comprising the variable."""
+        """Return the total number of chunks comprising the variable (or region)."""
         if self._nchunks is None:
-            self._nchunks = 1
-            for i in range(len(self._var.shape)):
-                self._nchunks *= int(math.ceil(float(self._var.shape[i])/self._chunkshape[i]))
+            self._nchunks = len(self.hyperslabs)
         return self._nchunks
 
     @property
@@ -149,7 +950,9 @@ class ProxyNcVariable(object):
         """Return the shape of each data chunk as a tuple."""
         chunkshape = self._var.chunking()
         if not isinstance(chunkshape, (list, tuple)) : chunkshape = self._var.shape
-        return chunkshape
+        return coalesce_chunkshape(self._var.shape, chunkshape, itemsize=_get_itemsize(self._var),
+            target_bytes=self._options['target_bytes'],
+            max_chunk_multiple=self._options['max_chunk_multiple'])
 
 
 # Solution 3
@@ -163,6 +966,14 @@ class ProxyNcVariable(object):
 class NcIterableVariable(netCDF4.Variable):
     """Adds chunk-based iteration capabilities to netCDF4.Variable objects."""
 
+    # Setting an attribute on a netCDF4.Variable instance creates a netcdf
+    # attribute, so these chunk-merging limits and the dimension traversal
+    # order (see iter_chunks) are defined at class level. Override them in a
+    # subclass to change the default behaviour.
+    target_bytes = None
+    max_chunk_multiple = None
+    order = None
+
     # Instead of using __init__ to modify the state of an instance object we
     # use __new__ to create and return a new instance; for an explanation see
     # http://www.python.org/download/releases/2.2.3/descrintro/#__new__
@@ -179,21 +990,19 @@ class NcIterableVariable(netCDF4.Variable):
     # Therefore we don't need to define a next() method within this class.
     def __iter__(self):
         """Iterate over all data chunks"""
-        for hs in iter_hyperslabs(self.shape, self._chunkshape):
-            yield self[hs]
+        for hs in self.hyperslabs:
+            yield read_chunk(self, hs).data
 
     @property
     def hyperslabs(self):
-        """Return a list of hyperslab objects that define all data chunks"""
-        return list(iter_hyperslabs(self.shape, self._chunkshape))
+        """Return a lazy sequence of hyperslab objects that define all data chunks"""
+        return var_hyperslabs(self, target_bytes=self.target_bytes,
+            max_chunk_multiple=self.max_chunk_multiple, order=self.order)
 
     @property
     def nchunks(self):
         """Return the total number of chunks comprising the variable."""
-        n = 1
-        for i in range(len(self.shape)):
-            n *= int(math.ceil(float(self.shape[i])/self._chunkshape[i]))
-        return n
+        return len(self.hyperslabs)
 
     @property
     def varname(self):
@@ -205,7 +1014,8 @@ class NcIterableVariable(netCDF4.Variable):
         """Return the shape of each data chunk as a tuple."""
         chunkshape = self.chunking()
         if not isinstance(chunkshape, (list, tuple)) : chunkshape = self.shape
-        return chunkshape
+        return coalesce_chunkshape(self.shape, chunkshape, target_bytes=self.target_bytes,
+            max_chunk_multiple=self.max_chunk_multiple, itemsize=_get_itemsize(self))
 
 
 # Solution 4
@@ -226,32 +1036,39 @@ class NcChunkIteratorMixIn(object):
     stored in netCDF variables.
     """
 
+    # Setting an attribute on a netCDF4.Variable instance creates a netcdf
+    # attribute, so these chunk-merging limits and the dimension traversal
+    # order (see iter_chunks) are defined at class level. Override them in a
+    # subclass to change the default behaviour.
+    target_bytes = None
+    max_chunk_multiple = None
+    order = None
+
     # Note that the __iter__ method is written as a generator function.
     # Therefore we don't need to define a next() method within this class.
     def __iter__(self):
         """Iterate over all data chunks"""
-        for hs in iter_hyperslabs(self.shape, self._chunkshape):
-            yield self[hs]
+        for hs in self.hyperslabs:
+            yield read_chunk(self, hs).data
 
     @property
     def hyperslabs(self):
-        """Return a list of hyperslab objects that define all data chunks"""
-        return list(iter_hyperslabs(self.shape, self._chunkshape))
+        """Return a lazy sequence of hyperslab objects that define all data chunks"""
+        return var_hyperslabs(self, target_bytes=self.target_bytes,
+            max_chunk_multiple=self.max_chunk_multiple, order=self.order)
 
     @property
     def nchunks(self):
         """Return the total number of chunks comprising the variable."""
-        n = 1
-        for i in range(len(self.shape)):
-            n *= int(math.ceil(float(self.shape[i])/self._chunkshape[i]))
-        return n
+        return len(self.hyperslabs)
 
     @property
     def _chunkshape(self):
         """Return the shape of each data chunk as a tuple."""
         chunkshape = self.chunking()
         if not isinstance(chunkshape, (list, tuple)) : chunkshape = self.shape
-        return chunkshape
+        return coalesce_chunkshape(self.shape, chunkshape, target_bytes=self.target_bytes,
+            max_chunk_multiple=self.max_chunk_multiple, itemsize=_get_itemsize(self))
 
 
 # This is the target class to which we will add iteration capabilities.
@@ -276,3 +1093,619 @@ class NcVariable(netCDF4.Variable, NcChunkIteratorMixIn):
     def varname(self):
         """Return the name of this variable."""
         return self._name
+
+
+# Further iteration facilities
+# ----------------------------
+# The remaining functions and classes build on the Solution 1 machinery above
+# to cover more specialised access patterns.
+
+
+# Define a function which spreads per-chunk work for a netcdf variable over a
+# pool of processes. Since netcdf file handles cannot safely be shared across
+# a fork, the variable is identified by file path and name, and each worker
+# process opens the file for itself.
+
+
+def chunk_map_reduce(path, varname, mapper, reducer, processes=None, tasks_per_process=4,
+        target_bytes=None, max_chunk_multiple=None, region=None, order=None):
+    """
+    Apply the function mapper to each chunk of the variable named varname in
+    netcdf file path, and combine the results using the function reducer. The
+    chunks are divided into contiguous runs of hyperslabs, each of which is
+    handed to one of a pool of worker processes (by default one per CPU).
+
+    Each worker is handed a slice of a HyperslabSequence, so the hyperslabs
+    are never materialised as a list.
+
+    The mapper function is called with an NcDataChunk object and may return
+    any value. The reducer function is called with two such values and should
+    return their combination. Since partial results are combined in whatever
+    order the workers complete, reducer should be associative and commutative.
+    Both functions must be picklable, e.g. defined at module level. The
+    target_bytes, max_chunk_multiple, region and order arguments have the same
+    meaning as for iter_chunks.
+    """
+    # Read the chunk layout and close the file before any worker is forked.
+    ds = netCDF4.Dataset(path)
+    try:
+        var = ds.variables[varname]
+        hyperslabs = var_hyperslabs(var, target_bytes=target_bytes,
+            max_chunk_multiple=max_chunk_multiple, region=region, order=order)
+    finally:
+        ds.close()
+
+    if not len(hyperslabs):
+        raise ValueError("Variable {0} contains no data chunks.".format(varname))
+
+    if processes is None: processes = multiprocessing.cpu_count()
+    ntasks = min(len(hyperslabs), processes * tasks_per_process)
+    bounds = [len(hyperslabs) * i // ntasks for i in range(ntasks+1)]
+    tasks = [(path, varname, hyperslabs[bounds[i]:bounds[i+1]], mapper, reducer)
+        for i in range(ntasks)]
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        result = None
+        for i, partial in enumerate(pool.imap_unordered(_map_reduce_hyperslabs, tasks)):
+            result = partial if i == 0 else reducer(result, partial)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+    return result
+
+
+def _map_reduce_hyperslabs(task):
+    """
+    Worker function for chunk_map_reduce. Opens the netcdf file, applies the
+    mapper function to each of the specified hyperslabs, and returns the result
+    of reducing the mapped values.
+    """
+    path, varname, hyperslabs, mapper, reducer = task
+    ds = netCDF4.Dataset(path)
+    try:
+        var = ds.variables[varname]
+        result = None
+        for i, hs in enumerate(hyperslabs):
+            value = mapper(read_chunk(var, hs))
+            result = value if i == 0 else reducer(result, value)
+        return result
+    finally:
+        ds.close()
+
+
+# Define a class which reads data chunks ahead of the consumer on a background
+# thread so that disk reads and per-chunk computation can overlap.
+
+
+class NcChunkPrefetcher(object):
+    """
+    Iterate over the chunks of a netcdf variable, reading up to depth
+    chunks ahead of the consumer on a background thread. If max_bytes is set
+    then the reader also stops once the chunks buffered ahead of the consumer
+    would exceed that many bytes (although at least one chunk is always read).
+    Each iteration returns an NcDataChunk object. The target_bytes,
+    max_chunk_multiple, region, order and mask arguments have the same meaning
+    as for iter_chunks.
+
+    The consumer_wait attribute records the total time, in seconds, that the
+    consumer spent waiting for a chunk to be read, while the reader_wait
+    attribute records the time that the reader spent idle because the buffer
+    was full. A large consumer_wait indicates an I/O-bound pass; a large
+    reader_wait indicates a compute-bound one. These attributes, and the
+    nchunks and nbytes counts of chunks read, accumulate over successive passes.
+
+    Each iteration over the object makes a fresh pass over the variable with
+    its own reader thread. Only one pass may be in progress at a time.
+    """
+
+    def __init__(self, var, depth=2, max_bytes=None, target_bytes=None, max_chunk_multiple=None,
+            region=None, order=None, mask='ma'):
+        """Initialize an instance object."""
+        self._var = var
+        self._mask = mask
+        self._hyperslabs = var_hyperslabs(var, target_bytes=target_bytes,
+            max_chunk_multiple=max_chunk_multiple, region=region, order=order)
+        self.depth = max(int(depth), 1)
+        self.max_bytes = max_bytes
+        self.consumer_wait = 0.0
+        self.reader_wait = 0.0
+        self.nchunks = 0
+        self.nbytes = 0
+        self._buffer = deque()
+        self._buffered_bytes = 0
+        self._error = None
+        self._finished = False
+        self._closed = False
+        self._reader = None
+        self._cond = threading.Condition()
+
+    def __iter__(self):
+        """Iterate over all data chunks"""
+        with self._cond:
+            if self._reader is not None:
+                raise RuntimeError("A pass over this prefetcher is already in progress.")
+            self._buffer.clear()
+            self._buffered_bytes = 0
+            self._error = None
+            self._finished = self._closed = False
+            reader = self._reader = threading.Thread(target=self._read_ahead)
+        reader.daemon = True
+        reader.start()
+        try:
+            while True:
+                with self._cond:
+                    t0 = time.time()
+                    while not (self._buffer or self._finished):
+                        self._cond.wait()
+                    self.consumer_wait += time.time() - t0
+                    if not self._buffer:
+                        if self._error is not None: raise self._error
+                        break
+                    chunk, nbytes = self._buffer.popleft()
+                    self._buffered_bytes -= nbytes
+                    self._cond.notify_all()
+                yield chunk
+        finally:
+            self.close()
+            reader.join()
+            self._reader = None
+
+    def close(self):
+        """Stop the background reader and discard any buffered chunks."""
+        with self._cond:
+            self._closed = True
+            self._buffer.clear()
+            self._buffered_bytes = 0
+            self._cond.notify_all()
+
+    def _read_ahead(self):
+        """Read chunks into the buffer until the variable is exhausted."""
+        itemsize = _get_itemsize(self._var)
+        try:
+            for hs in self._hyperslabs:
+                nbytes = itemsize
+                for s in hs: nbytes *= s.stop - s.start
+                with self._cond:
+                    t0 = time.time()
+                    while not self._closed and self._buffer and (len(self._buffer) >= self.depth or
+                            (self.max_bytes and self._buffered_bytes+nbytes > self.max_bytes)):
+                        self._cond.wait()
+                    self.reader_wait += time.time() - t0
+                    if self._closed: return
+                chunk = read_chunk(self._var, hs, self._mask)
+                with self._cond:
+                    if self._closed: return
+                    self._buffer.append((chunk, nbytes))
+                    self._buffered_bytes += nbytes
+                    self.nchunks += 1
+                    self.nbytes += nbytes
+                    self._cond.notify_all()
+        except Exception as exc:
+            self._error = exc
+        finally:
+            with self._cond:
+                self._finished = True
+                self._cond.notify_all()
+
+
+# Define a generator function which iterates over several variables in lockstep,
+# as required when computing derived fields from two or more variables. The
+# variables are divided into cells using a grid whose boundaries coincide with
+# chunk boundaries of the variables. Lower-rank variables are aligned with the
+# trailing dimensions of the others, as per the numpy broadcasting rules.
+
+
+def zip_chunks(*variables, **kwargs):
+    """
+    Iterate over corresponding chunks of the specified netcdf variables, whose
+    shapes must be identical or else broadcastable. Each iteration returns a
+    tuple of NcDataChunk objects, one per variable, whose arrays cover the same
+    region of the broadcast index space; each chunk's coords are expressed in
+    the index space of its own variable.
+
+    The grid keyword determines how the variables' differing chunk shapes are
+    reconciled. If 'common' (the default) then only boundaries shared by all of
+    the variables are used, so that every storage chunk lies within a single
+    cell and is read exactly once; for unrelated chunk shapes this can give
+    large cells. If 'refine' then the union of all boundaries is used, giving
+    cells no larger than any chunk, in which case chunks which are split across
+    cells are best served from the HDF5 chunk cache (see set_chunk_cache) or
+    the shared chunk cache (see the nccache module).
+
+    Dimensions along which any variable is broadcast are traversed innermost,
+    and a broadcast variable's chunk is reused for as long as it is unchanged,
+    so that, for example, a climatology is read only once per spatial chunk
+    while a time series of data is zipped against it. The mask keyword has the
+    same meaning as for iter_chunks.
+    """
+    grid = kwargs.pop('grid', 'common')
+    mask = kwargs.pop('mask', 'ma')
+    if kwargs:
+        raise TypeError("Unexpected keyword arguments: {0}".format(', '.join(kwargs)))
+    if grid not in ('common', 'refine'):
+        raise ValueError("Unrecognised grid option: {0}".format(grid))
+    if not variables: return
+
+    # Determine the broadcast shape and then, for each of its dimensions, the
+    # set of chunk boundaries of each variable which is not broadcast along it.
+    ndim = max(len(var.shape) for var in variables)
+    shape = [1] * ndim
+    bounds = [None] * ndim
+    broadcast = [False] * ndim
+    for var in variables:
+        offset = ndim - len(var.shape)
+        for d, n in enumerate(var.shape):
+            dim = d + offset
+            if n == 1: continue
+            if shape[dim] != 1 and n != shape[dim]:
+                raise ValueError("Variable shapes {0} are not broadcastable.".format(
+                    [var.shape for var in variables]))
+            shape[dim] = n
+    for var in variables:
+        offset = ndim - len(var.shape)
+        for d, (n, c) in enumerate(zip(var.shape, get_chunkshape(var))):
+            dim = d + offset
+            if n != shape[dim]: continue
+            edges = set(range(0, n, c)) | set([n])
+            if bounds[dim] is None:
+                bounds[dim] = edges
+            elif grid == 'common':
+                bounds[dim] &= edges
+            else:
+                bounds[dim] |= edges
+    for var in variables:
+        offset = ndim - len(var.shape)
+        for dim in range(ndim):
+            if dim < offset or (var.shape[dim-offset] == 1 and shape[dim] != 1):
+                broadcast[dim] = True
+
+    axes = []
+    for dim in range(ndim):
+        edges = sorted(bounds[dim] if bounds[dim] is not None else set([0, shape[dim]]))
+        axes.append([slice(a, b, 1) for a, b in zip(edges[:-1], edges[1:])])
+    order = [d for d in range(ndim) if not broadcast[d]] + [d for d in range(ndim) if broadcast[d]]
+    inverse = [order.index(d) for d in range(ndim)]
+
+    last = [(None, None)] * len(variables)
+    for slices in product(*[axes[d] for d in order]):
+        cell = [slices[i] for i in inverse]
+        chunks = []
+        for k, var in enumerate(variables):
+            offset = ndim - len(var.shape)
+            hs = tuple(slice(0, 1, 1) if n == 1 and shape[d+offset] != 1 else cell[d+offset]
+                for d, n in enumerate(var.shape))
+            if last[k][0] != hs:
+                last[k] = (hs, read_chunk(var, hs, mask))
+            chunks.append(last[k][1])
+        yield tuple(chunks)
+
+
+# Define a class which presents a variable that is split across several netcdf
+# files, e.g. one file per month, as a single variable concatenated along its
+# first (normally unlimited) dimension. Files are opened only when their data
+# is needed, and a bounded pool of open files is maintained so that iterating
+# over hundreds of files does not exhaust the available file descriptors.
+
+
+class _DatasetPool(object):
+    """
+    Bounded pool of open netCDF4.Dataset objects, closed in LRU order. Files
+    that are pinned, i.e. in use by an ongoing read or iteration, are never
+    closed by the pool, so the number of open files may temporarily exceed
+    max_open if more files than that are pinned at once.
+    """
+
+    def __init__(self, max_open=8):
+        """Initialize an instance object."""
+        self.max_open = max(int(max_open), 1)
+        self._datasets = OrderedDict()
+        self._pins = {}
+        self._lock = threading.Lock()
+
+    def variable(self, path, varname):
+        """
+        Return the named variable from the specified file, opening it if necessary.
+        The variable is only valid until another file is opened; use acquire if it
+        is to be held for longer than that.
+        """
+        with self._lock:
+            return self._variable(path, varname)
+
+    def acquire(self, path, varname):
+        """
+        Return the named variable from the specified file, as per the variable
+        method, and pin the file open until a matching call to release.
+        """
+        with self._lock:
+            var = self._variable(path, varname)
+            self._pins[path] = self._pins.get(path, 0) + 1
+            return var
+
+    def release(self, path):
+        """Unpin a file pinned by an earlier call to acquire."""
+        with self._lock:
+            n = self._pins.pop(path, 0) - 1
+            if n > 0: self._pins[path] = n
+
+    def close(self):
+        """Close all open files."""
+        with self._lock:
+            with nc_lock:
+                for ds in self._datasets.values(): ds.close()
+            self._datasets.clear()
+            self._pins.clear()
+
+    def _variable(self, path, varname):
+        ds = self._datasets.pop(path, None)
+        if ds is None:
+            unpinned = [p for p in self._datasets if p not in self._pins]
+            while len(self._datasets) >= self.max_open and unpinned:
+                with nc_lock:
+                    self._datasets.pop(unpinned.pop(0)).close()
+            with nc_lock:
+                ds = netCDF4.Dataset(path)
+        self._datasets[path] = ds
+        return ds.variables[varname]
+
+
+class AggregatedNcVariable(object):
+    """
+    Presents the variable named varname in each of the specified netcdf files
+    as a single variable concatenated, in the order given, along its first
+    dimension. The variable must have the same trailing dimensions in each file.
+    At most max_open files are held open at any one time. If the number of
+    records in each file is known in advance then it may be passed via the
+    lengths argument, in which case files are not scanned up front.
+
+    Instances support indexing with slices (returning data concatenated from
+    the relevant files) and provide an iter_chunks method which yields the
+    chunks of each file in turn, with coordinates expressed in the index space
+    of the aggregated variable. Call close(), or use the instance as a context
+    manager, to close any open files.
+    """
+
+    def __init__(self, paths, varname, max_open=8, lengths=None):
+        """Initialize an instance object."""
+        self.paths = list(paths)
+        self.varname = varname
+        self._pool = _DatasetPool(max_open)
+        if not self.paths:
+            raise ValueError("At least one file must be specified.")
+
+        first = self._pool.variable(self.paths[0], varname)
+        if not first.ndim:
+            raise ValueError("Variable {0} has no dimension to aggregate along.".format(varname))
+        self.dimensions = first.dimensions
+        self.dtype = first.dtype
+        self._chunkshape = get_chunkshape(first)
+        trailing = first.shape[1:]
+
+        if lengths is None:
+            lengths = []
+            for path in self.paths:
+                var = self._pool.variable(path, varname)
+                if var.shape[1:] != trailing:
+                    raise ValueError("Variable {0} in file {1} has shape {2}, expected (*, {3}).".format(
+                        varname, path, var.shape, ', '.join(str(n) for n in trailing)))
+                lengths.append(var.shape[0])
+        elif len(lengths) != len(self.paths):
+            raise ValueError("Number of lengths does not match number of files.")
+
+        self._offsets = [0]
+        for n in lengths: self._offsets.append(self._offsets[-1] + int(n))
+        self.shape = (self._offsets[-1],) + tuple(trailing)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple): key = (key,)
+        if Ellipsis in key:
+            i = key.index(Ellipsis)
+            key = key[:i] + (slice(None),) * (self.ndim - len(key) + 1) + key[i+1:]
+        squeeze = tuple(0 if isinstance(k, (int, np.integer)) else slice(None) for k in key)
+        region = _normalize_region(self.shape, key)
+
+        start, stop = region[0].start, region[0].stop
+        pieces = []
+        for ifile, path in enumerate(self.paths):
+            lo, hi = self._offsets[ifile], self._offsets[ifile+1]
+            if hi <= start or lo >= stop or lo == hi: continue
+            local = (slice(max(start, lo) - lo, min(stop, hi) - lo, 1),) + region[1:]
+            var = self._pool.acquire(path, self.varname)
+            try:
+                pieces.append(read_chunk(var, local).data)
+            finally:
+                self._pool.release(path)
+
+        if pieces:
+            data = np.ma.concatenate(pieces) if len(pieces) > 1 else pieces[0]
+        else:
+            data = np.ma.masked_all([s.stop - s.start for s in region], dtype=self.dtype)
+        return data[squeeze]
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def nchunks(self):
+        """Return the total number of per-file chunks comprising the variable."""
+        return sum(len(self._file_hyperslabs(i)) for i in range(len(self.paths)))
+
+    def chunking(self):
+        """Return the chunk shape used by the variable in the first file."""
+        return self._chunkshape
+
+    def close(self):
+        """Close any open files."""
+        self._pool.close()
+
+    def iter_hyperslabs(self, region=None):
+        """
+        Iterate over the hyperslab objects that define all of the per-file data
+        chunks, expressed in the index space of the aggregated variable.
+        """
+        region = _normalize_region(self.shape, region)
+        for ifile in range(len(self.paths)):
+            offset = self._offsets[ifile]
+            for hs in self._file_hyperslabs(ifile, region):
+                yield (slice(hs[0].start+offset, hs[0].stop+offset, 1),) + hs[1:]
+
+    def iter_chunks(self, region=None, **kwargs):
+        """
+        Iterate over the chunks of the variable in each file in turn, returning
+        NcDataChunk objects whose coords are expressed in the index space of the
+        aggregated variable. Files which do not intersect region are skipped
+        without being opened. Any other keyword arguments are passed through to
+        the iter_chunks function.
+        """
+        region = _normalize_region(self.shape, region)
+        for ifile, path in enumerate(self.paths):
+            local = self._local_region(ifile, region)
+            if local is None: continue
+            offset = self._offsets[ifile]
+            # Pin the file open while its chunks are being read, since other reads
+            # from this variable may otherwise cause the pool to close it.
+            var = self._pool.acquire(path, self.varname)
+            try:
+                for chunk in iter_chunks(var, region=local, **kwargs):
+                    hs = chunk.coords
+                    coords = (slice(hs[0].start+offset, hs[0].stop+offset, 1),) + tuple(hs[1:])
+                    yield NcDataChunk(chunk.data, coords, mask=chunk.mask)
+            finally:
+                self._pool.release(path)
+
+    def _local_region(self, ifile, region):
+        """
+        Return the part of the specified region which lies within the given file,
+        in that file's index space, or None if there is no such part.
+        """
+        lo, hi = self._offsets[ifile], self._offsets[ifile+1]
+        start, stop = max(region[0].start, lo), min(region[0].stop, hi)
+        if start >= stop: return None
+        return (slice(start-lo, stop-lo, 1),) + tuple(region[1:])
+
+    def _file_hyperslabs(self, ifile, region=None):
+        """Return a HyperslabSequence for the chunks of the variable in the given file."""
+        if region is None: region = _normalize_region(self.shape, None)
+        local = self._local_region(ifile, region)
+        if local is None: return ()
+        var = self._pool.variable(self.paths[ifile], self.varname)
+        return var_hyperslabs(var, region=local)
+
+
+# Define a generator function which yields data chunks padded with a halo of
+# data from neighbouring chunks, as required by stencil-type computations such
+# as gradients and smoothing filters. Neighbouring blocks are served from a
+# small cache of recently read blocks rather than being re-read from the file.
+
+
+class NcHaloChunk(NcDataChunk):
+    """
+    Class for representing a chunk of data padded with a halo of neighbouring
+    data. The coords attribute gives the index-space coordinates of the chunk
+    interior within the source variable, while the interior attribute gives
+    the slices which select the interior from the padded data array.
+    """
+    def __init__(self, data, coords, interior):
+        super(NcHaloChunk, self).__init__(data, coords)
+        self.interior = interior
+
+
+def iter_halo_chunks(var, halo, mode='clamp', fill_value=None, cache_chunks=None,
+        target_bytes=None, max_chunk_multiple=None, region=None, order=None):
+    """
+    Iterate over the chunks in a netCDF variable, padding each one with halo
+    elements of neighbouring data on either side along each dimension. The halo
+    argument is either a single width or a sequence of widths, one per dimension.
+    Each iteration returns an NcHaloChunk object.
+
+    The mode argument determines how the halo is filled beyond the edges of the
+    variable, either for all dimensions or, if a sequence, per dimension: 'clamp'
+    repeats the edge values, 'wrap' takes values from the opposite edge (e.g. for
+    a periodic longitude dimension), and 'fill' uses fill_value or, if that is
+    None, masked values.
+
+    Blocks of data are read once and held in a cache of up to cache_chunks
+    blocks, which by default is large enough to hold two layers of blocks across
+    the outermost traversed dimension. The remaining arguments have the same
+    meaning as for iter_chunks.
+    """
+    ndim = len(var.shape)
+    halo = [int(halo)] * ndim if np.isscalar(halo) else [int(h) for h in halo]
+    modes = [mode] * ndim if isinstance(mode, _string_types) else list(mode)
+    if len(halo) != ndim or len(modes) != ndim:
+        raise ValueError("Halo widths and modes must be given for every dimension.")
+    for m in modes:
+        if m not in ('clamp', 'wrap', 'fill'):
+            raise ValueError("Unrecognised halo mode: {0}".format(m))
+
+    hyperslabs = var_hyperslabs(var, target_bytes=target_bytes,
+        max_chunk_multiple=max_chunk_multiple, region=region, order=order)
+    blockshape = coalesce_chunkshape(var.shape, get_chunkshape(var),
+        target_bytes=target_bytes, max_chunk_multiple=max_chunk_multiple,
+        itemsize=_get_itemsize(var))
+
+    if cache_chunks is None:
+        nblocks = [int(math.ceil(float(n)/b)) if b else 0 for n, b in zip(var.shape, blockshape)]
+        cache_chunks = 3**ndim
+        if ndim:
+            layer = 1
+            for d in hyperslabs._order[1:]: layer *= nblocks[d]
+            cache_chunks += 2*layer
+    cache = OrderedDict()
+
+    def get_block(index):
+        if index in cache:
+            block = cache.pop(index)
+        else:
+            hs = tuple(slice(i*b, min((i+1)*b, n), 1) for i, b, n in zip(index, blockshape, var.shape))
+            block = np.ma.asarray(read_chunk(var, hs).data)
+            while len(cache) >= max(cache_chunks, 1): cache.popitem(last=False)
+        cache[index] = block
+        return block
+
+    for hs in hyperslabs:
+        # Map the padded index range along each dimension onto source indices.
+        sources, valid = [], []
+        for d in range(ndim):
+            n = var.shape[d]
+            idx = np.arange(hs[d].start-halo[d], hs[d].stop+halo[d])
+            if modes[d] == 'clamp':
+                ok = np.ones(len(idx), dtype=bool)
+                idx = np.clip(idx, 0, n-1)
+            elif modes[d] == 'wrap':
+                ok = np.ones(len(idx), dtype=bool)
+                idx = idx % n
+            else:
+                ok = (idx >= 0) & (idx < n)
+                idx = np.where(ok, idx, 0)
+            sources.append(idx)
+            valid.append(ok)
+
+        data = np.ma.masked_all([len(idx) for idx in sources], dtype=var.dtype)
+        if fill_value is not None:
+            data[...] = fill_value
+
+        # Copy the relevant part of each intersecting block into the padded array.
+        blockids = [np.unique((idx // b)[ok]) for idx, ok, b in zip(sources, valid, blockshape)]
+        for index in product(*[ids.tolist() for ids in blockids]):
+            dst, src = [], []
+            for d, i in enumerate(index):
+                pos = np.nonzero(valid[d] & (sources[d] // blockshape[d] == i))[0]
+                dst.append(pos)
+                src.append(sources[d][pos] - i*blockshape[d])
+            block = get_block(index)
+            data[np.ix_(*dst)] = block[np.ix_(*src)]
+
+        interior = tuple(slice(h, h+s.stop-s.start, 1) for h, s in zip(halo, hs))
+        yield NcHaloChunk(data, hs, interior)
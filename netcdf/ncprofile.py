@@ -0,0 +1,152 @@
+"""
+Instrumentation for iterations over the chunks of a netcdf variable, so that
+slow passes can be diagnosed, e.g. to tell whether a job is limited by reading
+and decompression, by waiting on the netcdf library lock, or by the consumer's
+own processing of each chunk.
+
+A ChunkIterStats object is passed as the stats argument of nciter.iter_chunks.
+Instrumentation is only wired into the iteration pipeline when a stats object
+is supplied, so uninstrumented iteration pays nothing for it. Example:
+
+    stats = ChunkIterStats()
+    for chunk in iter_chunks(var, workers=4, stats=stats):
+        ...
+    print(stats.report())
+"""
+
+import math
+import threading
+import time
+
+import numpy as np
+
+import nciter
+
+_clock = getattr(time, 'perf_counter', time.time)
+
+
+class ChunkIterStats(object):
+    """
+    Collects statistics for one or more chunk iterations. Pass an instance as
+    the stats argument of iter_chunks. The following per-chunk samples, all in
+    seconds apart from nbytes, are recorded in lists of the same name:
+
+    * read_times: time taken to read, decompress and mask each chunk, including
+      any time spent waiting for the netcdf library lock, or else the time taken
+      to fetch the chunk from the chunk cache
+    * nbytes: the size of each decoded chunk
+    * wait_times: time the consumer spent waiting for each chunk to be returned
+      by the iterator (with worker threads, this is the queue wait)
+    * consumer_times: time the consumer spent processing each chunk, i.e. the
+      time between a chunk being returned and the next one being requested
+
+    If on_read is specified then it is called from the reading thread as
+    on_read(hyperslab, seconds, nbytes) after each chunk is read. If on_chunk
+    is specified then it is called as on_chunk(chunk, wait, consumer) once the
+    consumer has finished with each chunk. Use the report method to obtain a
+    summary including percentiles and histograms.
+    """
+
+    _SAMPLES = ('read_times', 'wait_times', 'consumer_times')
+
+    def __init__(self, on_read=None, on_chunk=None):
+        self.on_read = on_read
+        self.on_chunk = on_chunk
+        self.read_times = []
+        self.nbytes = []
+        self.wait_times = []
+        self.consumer_times = []
+        self.elapsed = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def nchunks(self):
+        """The number of chunks returned to the consumer."""
+        return len(self.wait_times)
+
+    @property
+    def total_bytes(self):
+        """The total number of bytes decoded."""
+        return sum(self.nbytes)
+
+    @property
+    def throughput(self):
+        """The number of bytes decoded per second of elapsed iteration time."""
+        return self.total_bytes / self.elapsed if self.elapsed else 0.0
+
+    def percentiles(self, name, q=(50, 90, 99)):
+        """Return the q'th percentiles of the named list of samples, e.g. 'read_times'."""
+        samples = getattr(self, name)
+        if not samples: return [float('nan')] * len(q)
+        return list(np.percentile(samples, q))
+
+    def histogram(self, name, bins=10):
+        """
+        Return a histogram of the named list of samples as a (counts, edges)
+        tuple. The bins are logarithmically spaced between the smallest and
+        largest positive samples, since latencies typically span several orders
+        of magnitude.
+        """
+        samples = np.asarray(getattr(self, name), dtype=np.float64)
+        positive = samples[samples > 0]
+        if not positive.size: return np.histogram(samples, bins=bins)
+        lo, hi = positive.min(), positive.max()
+        if hi <= lo: hi = lo * 2
+        edges = np.logspace(math.log10(lo), math.log10(hi), bins+1)
+        edges[0] = min(edges[0], samples.min())
+        edges[-1] = max(edges[-1], samples.max())
+        return np.histogram(samples, bins=edges)
+
+    def report(self, bins=10, width=40):
+        """Return a multi-line text summary of the statistics collected so far."""
+        mb = self.total_bytes / 1024.0**2
+        lines = ["chunks: {0}  decoded: {1:.1f} MiB  elapsed: {2:.3f} s  throughput: {3:.1f} MiB/s".format(
+            self.nchunks, mb, self.elapsed, mb / self.elapsed if self.elapsed else 0.0)]
+        for name in self._SAMPLES:
+            samples = getattr(self, name)
+            if not samples: continue
+            p50, p90, p99 = self.percentiles(name)
+            lines.append('')
+            lines.append("{0}: total {1:.3f} s  mean {2:.3g} s  p50 {3:.3g} s  p90 {4:.3g} s  "
+                "p99 {5:.3g} s  max {6:.3g} s".format(name, sum(samples), sum(samples) / len(samples),
+                p50, p90, p99, max(samples)))
+            counts, edges = self.histogram(name, bins=bins)
+            scale = float(width) / max(counts.max(), 1)
+            for i, count in enumerate(counts):
+                lines.append("  {0:9.3g} - {1:9.3g} s {2:7d} {3}".format(edges[i], edges[i+1], count,
+                    '#' * int(round(count * scale))))
+        return '\n'.join(lines)
+
+    def _reader(self, read):
+        """Return a version of chunk reading function read which records read statistics."""
+        def timed_read(var, hyperslab, mask='ma'):
+            t0 = _clock()
+            chunk = read(var, hyperslab, mask)
+            seconds = _clock() - t0
+            nbytes = nciter.array_nbytes(chunk.data)
+            with self._lock:
+                self.read_times.append(seconds)
+                self.nbytes.append(nbytes)
+            if self.on_read is not None: self.on_read(hyperslab, seconds, nbytes)
+            return chunk
+        return timed_read
+
+    def _track(self, chunks):
+        """Generator function which records consumer-side statistics for chunks."""
+        start = _clock()
+        chunks = iter(chunks)
+        try:
+            while True:
+                t0 = _clock()
+                try:
+                    chunk = next(chunks)
+                except StopIteration:
+                    break
+                t1 = _clock()
+                self.wait_times.append(t1 - t0)
+                yield chunk
+                t2 = _clock()
+                self.consumer_times.append(t2 - t1)
+                if self.on_chunk is not None: self.on_chunk(chunk, t1 - t0, t2 - t1)
+        finally:
+            self.elapsed += _clock() - start
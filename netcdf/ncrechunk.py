@@ -0,0 +1,273 @@
+#!/usr/bin/env python2.7
+"""
+Copy a netcdf file, changing the chunk shapes (and optionally the compression settings) of its
+variables, while keeping memory use within a specified budget. This is useful when, for example,
+a file is chunked as full lat-lon fields but needs to be read as long time series.
+
+New chunk sizes are specified per dimension with the -c option, e.g. -c time=365,lat=10,lon=10.
+Chunk sizes for dimensions that are not listed are copied from the source variable (or are the
+full dimension length if the source variable is contiguous). By default all variables are
+rechunked; the -v option restricts rechunking to the named variables, the rest being copied with
+their original chunking.
+
+Data is copied in blocks whose boundaries coincide with both the source and the target chunk
+boundaries, so that each source chunk is decompressed once and each target chunk is written once,
+in storage order. If such a block would exceed the memory budget (-m) then the data is copied in
+two stages via an uncompressed intermediate file, whose chunk shape is chosen to be as large as
+possible while keeping both stages within budget. A contiguous source, such as any variable in
+a netcdf-3 file, can be read in blocks of any shape, so it is always copied directly, in blocks
+made up of whole target chunks. Data values are copied exactly as stored, i.e. without applying
+masking or scale factors.
+"""
+import sys
+import os
+import shutil
+import tempfile
+import netCDF4 as nc4
+import numpy as np
+
+from nciter import coalesce_chunkshape, get_chunkshape, split_shape
+from ncwrite import copy_variable, _copy_datatype, _copy_kwargs
+
+usage = "Usage: %s [options] infile outfile" % os.path.basename(sys.argv[0])
+
+DEFAULT_MAX_BYTES = 256 * 1024**2
+
+
+def main():
+    options, infile, outfile = parse_args()
+    try:
+        rechunk_file(infile, outfile, chunks=options.chunks, complevel=options.complevel,
+            shuffle=options.shuffle, max_bytes=options.max_bytes, varnames=options.varnames,
+            tmpdir=options.tmpdir, verbose=options.verbose)
+    except (ValueError, KeyError) as exc:
+        sys.stderr.write("ERROR: {0}\n".format(exc))
+        sys.exit(1)
+
+
+def rechunk_file(infile, outfile, chunks=None, complevel=None, shuffle=None,
+        max_bytes=DEFAULT_MAX_BYTES, varnames=None, tmpdir=None, verbose=False):
+    """
+    Copy netcdf file infile to a new netcdf-4 file outfile, rechunking its variables as specified
+    by chunks, a dictionary of chunk sizes keyed by dimension name. If complevel or shuffle is
+    specified then it overrides the source variable's compression settings. If varnames is
+    specified then only those variables are rechunked. Groups, dimensions and attributes are
+    copied as they are.
+    """
+    src = nc4.Dataset(infile)
+    dst = nc4.Dataset(outfile, 'w', format='NETCDF4')
+    try:
+        _copy_group(src, dst, chunks or {}, complevel, shuffle, max_bytes, varnames, tmpdir, verbose)
+    finally:
+        dst.close()
+        src.close()
+
+
+def _copy_group(src, dst, chunks, complevel, shuffle, max_bytes, varnames, tmpdir, verbose):
+    """Copy the contents of group src, recursively, to group dst."""
+    dst.setncatts(dict((name, src.getncattr(name)) for name in src.ncattrs()))
+    for name, dim in src.dimensions.items():
+        dst.createDimension(name, None if dim.isunlimited() else len(dim))
+
+    for name, var in src.variables.items():
+        rechunk = varnames is None or name in varnames
+        target = target_chunkshape(var, chunks) if rechunk else None
+        kwargs = _copy_kwargs(var, target, complevel, shuffle)
+        out = dst.createVariable(name, _copy_datatype(var), var.dimensions, **kwargs)
+        out.setncatts(dict((att, var.getncattr(att)) for att in var.ncattrs() if att != '_FillValue'))
+        if verbose:
+            sys.stderr.write("{0}: {1} -> {2}\n".format(var.name, _storage(var), _storage(out)))
+        rechunk_variable(var, out, max_bytes=max_bytes, tmpdir=tmpdir, verbose=verbose)
+
+    for name, grp in src.groups.items():
+        _copy_group(grp, dst.createGroup(name), chunks, complevel, shuffle, max_bytes, varnames,
+            tmpdir, verbose)
+
+
+def target_chunkshape(var, chunks):
+    """
+    Return the target chunk shape for netcdf variable var given chunks, a dictionary of chunk
+    sizes keyed by dimension name. Sizes are limited to the dimension lengths.
+    """
+    source = get_chunkshape(var)
+    return [max(min(chunks.get(dim, c), n), 1) for dim, c, n in zip(var.dimensions, source, var.shape)]
+
+
+def _storage(var):
+    """Return a short description of the storage layout of variable var."""
+    chunking = var.chunking() if var.dimensions else 'contiguous'
+    return 'contiguous' if chunking == 'contiguous' else 'chunks ' + 'x'.join(map(str, chunking))
+
+
+def rechunk_variable(src, dst, max_bytes=DEFAULT_MAX_BYTES, tmpdir=None, verbose=False):
+    """
+    Copy the data in netcdf variable src to variable dst, which must have the same shape, within
+    a memory budget of max_bytes, via an intermediate file in directory tmpdir if necessary.
+    """
+    src.set_auto_maskandscale(False)
+    dst.set_auto_maskandscale(False)
+    if not src.dimensions or src.dtype == str or 0 in src.shape:
+        if src.size: dst[...] = src[...]
+        return
+
+    itemsize = src.dtype.itemsize
+    plan = plan_rechunk(src.shape, _chunkshape(src), _chunkshape(dst), itemsize, max_bytes)
+    if len(plan) == 1:
+        if verbose: sys.stderr.write("  direct copy in blocks of {0}\n".format(plan[0]))
+        copy_variable(src, dst, block=plan[0], max_bytes=max_bytes)
+        return
+
+    inter, blocks = plan
+    if verbose:
+        sys.stderr.write("  copy via intermediate chunks {0} in blocks of {1} then {2}\n".format(
+            inter, blocks[0], blocks[1]))
+    workdir = tempfile.mkdtemp(prefix='ncrechunk', dir=tmpdir)
+    try:
+        ds = nc4.Dataset(os.path.join(workdir, 'intermediate.nc'), 'w', format='NETCDF4')
+        try:
+            for i, n in enumerate(src.shape):
+                ds.createDimension('dim{0}'.format(i), n)
+            tmp = ds.createVariable(src.name, src.dtype, tuple('dim{0}'.format(i)
+                for i in range(src.ndim)), chunksizes=inter)
+            tmp.set_auto_maskandscale(False)
+            copy_variable(src, tmp, block=blocks[0], max_bytes=max_bytes)
+            copy_variable(tmp, dst, block=blocks[1], max_bytes=max_bytes)
+        finally:
+            ds.close()
+    finally:
+        shutil.rmtree(workdir)
+
+
+def plan_rechunk(shape, source, target, itemsize, max_bytes):
+    """
+    Plan the copying of an array of the specified shape and itemsize from chunk shape source to
+    chunk shape target, using no more than max_bytes of memory for each block of data held. If a
+    direct copy is possible then a list containing just the block shape is returned. Otherwise a
+    tuple (intermediate, (block1, block2)) is returned, giving the chunk shape of an intermediate
+    array and the block shapes for copying to it and then from it. A ValueError is raised if
+    neither plan fits within the memory budget.
+
+    Either chunk shape may be None, meaning that the array is stored contiguously. Since such an
+    array can be read or written in blocks of any shape, it is copied directly, in blocks of whole
+    chunks of the other array (or contiguous runs, if both are contiguous) merged up to max_bytes.
+    """
+    shape = tuple(shape)
+
+    def nbytes(c):
+        return int(np.prod(c, dtype=np.int64)) * itemsize
+
+    if source is None or target is None:
+        chunks = target if source is None else source
+        if chunks is None:
+            return [split_shape(shape, max_bytes, itemsize)]
+        chunks = tuple(min(c, n) for c, n in zip(chunks, shape))
+        if nbytes(chunks) > max_bytes:
+            raise ValueError("Memory budget of {0} bytes is too small for chunk shape {1}.".format(
+                max_bytes, chunks))
+        return [coalesce_chunkshape(shape, chunks, target_bytes=max_bytes, itemsize=itemsize)]
+
+    source, target = tuple(source), tuple(target)
+
+    def block(a, b):
+        return tuple(min(_lcm(x, y), n) for x, y, n in zip(a, b, shape))
+
+    direct = block(source, target)
+    if nbytes(direct) <= max_bytes:
+        return [direct]
+
+    # Start from the largest intermediate chunk shape that divides both the source and target
+    # chunk shapes, for which each stage needs to hold just one source or target chunk, then
+    # grow it for as long as both stages remain within budget.
+    inter = [_gcd(a, b) for a, b in zip(source, target)]
+    cost = lambda c: max(nbytes(block(source, c)), nbytes(block(c, target)))
+    if cost(inter) > max_bytes:
+        raise ValueError("Memory budget of {0} bytes is too small for chunk shapes {1} and {2}.".format(
+            max_bytes, source, target))
+
+    candidates = [sorted(set(_divisors(a) + _divisors(b))) for a, b in zip(source, target)]
+    while True:
+        best = None
+        for d in range(len(shape)):
+            for size in candidates[d]:
+                if size <= inter[d]: continue
+                trial = inter[:d] + [size] + inter[d+1:]
+                if cost(trial) <= max_bytes and (best is None or np.prod(trial) > np.prod(best)):
+                    best = trial
+                break
+        if best is None: break
+        inter = best
+
+    inter = tuple(inter)
+    return inter, (block(source, inter), block(inter, target))
+
+
+def _chunkshape(var):
+    """Return the chunk shape of netcdf variable var, or None if it is contiguous."""
+    return get_chunkshape(var) if isinstance(var.chunking(), (list, tuple)) else None
+
+
+def _gcd(a, b):
+    while b: a, b = b, a % b
+    return a
+
+
+def _lcm(a, b):
+    return a * b // _gcd(a, b)
+
+
+def _divisors(n):
+    """Return the divisors of positive integer n."""
+    small = [i for i in range(1, int(n**0.5) + 1) if n % i == 0]
+    return small + [n // i for i in small]
+
+
+def parse_size(text):
+    """Parse a memory size such as 512M or 2G, returning a number of bytes."""
+    units = dict(K=1024, M=1024**2, G=1024**3, T=1024**4)
+    text = text.strip().upper().rstrip('B')
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+
+def parse_args():
+    """Parse command-line options and arguments"""
+    import optparse
+
+    usage = "usage: %prog [options] infile outfile"
+    parser = optparse.OptionParser(usage=usage, version="0.1")
+    parser.add_option("-c", dest="chunks", default="",
+        help="comma-separated list of dim=size chunk sizes, e.g. time=365,lat=10,lon=10")
+    parser.add_option("-d", dest="complevel", type="int", default=None,
+        help="zlib compression level, 0 for none (default: as source)")
+    parser.add_option("-s", dest="shuffle", action="store_true", default=None,
+        help="apply the shuffle filter (default: as source)")
+    parser.add_option("-m", dest="max_bytes", default="256M",
+        help="memory budget for data blocks, e.g. 512M or 2G (default: 256M)")
+    parser.add_option("-t", dest="tmpdir",
+        help="directory for intermediate files (default: system temporary directory)")
+    parser.add_option("-v", dest="varnames",
+        help="comma-separated list of variables to rechunk (default: all)")
+    parser.add_option("-V", dest="verbose", action="store_true",
+        help="report the copy plan for each variable")
+
+    options, args = parser.parse_args()
+    if len(args) < 2 : parser.error("Insufficient arguments specified.")
+
+    infile, outfile = args[:2]
+    if not os.path.exists(infile):
+        parser.error("File {0} does not exist.".format(infile))
+
+    try:
+        options.chunks = dict((dim, int(size)) for dim, size in
+            (item.split('=') for item in options.chunks.split(',') if item))
+        options.max_bytes = parse_size(options.max_bytes)
+    except ValueError:
+        parser.error("Invalid chunk size or memory budget specified.")
+    if options.varnames: options.varnames = options.varnames.split(',')
+
+    return (options, infile, outfile)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,7 +3,8 @@
 Computes and prints the RMS error between the variable named var1 in netcdf file1
 and variable var2 in netcdf file2. If var2 isn't specified then it defaults to var1.
 This script assumes that the data arrays associated with var1 and var2 either have
-the same shape or else are broadcastable, one to the other.
+the same shape or else are broadcastable, one to the other. The RMS error is computed
+chunk by chunk, so neither variable needs to be loaded into memory in its entirety.
 """
 
 import sys
@@ -11,6 +12,8 @@ import netCDF4 as nc4
 import numpy as np
 import numpy.ma as ma
 
+import ncexpr
+
 usage = "Usage: ncrmse file1 file2 var1 [var2]"
 
 
@@ -32,7 +35,7 @@ def main():
         ds2 = nc4.Dataset(file2, 'r')
         var1 = ds1.variables[varname1]
         var2 = ds2.variables[varname2]
-        rmse = rmserror(var1[:], var2[:])
+        rmse = rmserror_chunked(var1, var2)
         print >>sys.stdout, rmse
         retcode = 0
     except KeyError:
@@ -57,5 +60,17 @@ def rmserror(arr1, arr2):
     return ma.sqrt( ((arr1-arr2)**2).mean(dtype='float64') )
 
 
+def rmserror_chunked(var1, var2, workers=None):
+    """
+    Compute RMS error between two netcdf variables (or arrays) by evaluating the
+    expression chunk by chunk, using the specified number of worker threads.
+    """
+    x, y = ncexpr.wrap(var1), ncexpr.wrap(var2)
+    mse = ((x-y)**2).mean().compute(workers=workers)
+    if mse is ma.masked:
+        raise ValueError("Input arrays have no valid values in common.")
+    return ma.sqrt(mse)
+
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,156 @@
+"""
+Approximate statistics for netcdf variables from a sample of their chunks.
+
+Reading every chunk of a very large variable just to get a first look at its
+distribution can take a long time. The functions in this module instead visit
+a reproducible (seeded) random, stratified or systematic sample of the chunks,
+as produced by nciter's hyperslab sequences, and estimate the mean, quantiles
+and fraction of missing values from that sample, with bootstrap confidence
+intervals. Example:
+
+    stats = estimate_stats(var, fraction=0.02, method='stratified', seed=1)
+    print(stats.report())
+"""
+
+import math
+
+import numpy as np
+
+from nciter import read_hyperslabs, var_hyperslabs
+
+
+def sample_hyperslabs(hyperslabs, fraction=0.01, method='random', seed=None, nsamples=None):
+    """
+    Return a sample of a sequence of hyperslabs, e.g. a HyperslabSequence, in
+    their original order. The sample size is nsamples, if specified, or else
+    the given fraction of the hyperslabs (rounded up, and at least one). The
+    method may be 'random' (a simple random sample), 'stratified' (one random
+    hyperslab from each of nsamples equal runs of consecutive hyperslabs) or
+    'systematic' (every k'th hyperslab from a random starting point). Samples
+    are reproducible for a given seed.
+    """
+    n = len(hyperslabs)
+    if nsamples is None: nsamples = int(math.ceil(fraction * n))
+    nsamples = max(min(int(nsamples), n), 1) if n else 0
+    rng = np.random.RandomState(seed)
+
+    if method == 'random':
+        picks = np.sort(rng.choice(n, nsamples, replace=False)) if n else []
+    elif method == 'stratified':
+        bounds = [n * i // nsamples for i in range(nsamples+1)]
+        picks = [rng.randint(bounds[i], bounds[i+1]) for i in range(nsamples)]
+    elif method == 'systematic':
+        step = float(n) / nsamples if nsamples else 1
+        start = rng.uniform(0, step)
+        picks = [min(int(start + i*step), n-1) for i in range(nsamples)]
+    else:
+        raise ValueError("Invalid sampling method: {0!r}".format(method))
+
+    return [hyperslabs[int(i)] for i in picks]
+
+
+def sample_chunks(var, fraction=0.01, method='random', seed=None, nsamples=None, workers=None,
+        mask='ma', target_bytes=None, max_chunk_multiple=None, region=None, order=None):
+    """
+    Iterate over a sample of the chunks in netCDF variable var, chosen as per
+    sample_hyperslabs, returning an NcDataChunk object for each one. The
+    remaining arguments have the same meaning as for nciter.iter_chunks.
+    """
+    hyperslabs = var_hyperslabs(var, target_bytes=target_bytes,
+        max_chunk_multiple=max_chunk_multiple, region=region, order=order)
+    hyperslabs = sample_hyperslabs(hyperslabs, fraction=fraction, method=method, seed=seed,
+        nsamples=nsamples)
+    for chunk in read_hyperslabs(var, hyperslabs, workers, mask=mask):
+        yield chunk
+
+
+class ChunkSampleStats(object):
+    """
+    Summary statistics for a netcdf variable estimated from a sample of its
+    chunks, as returned by estimate_stats. The mean, missing_fraction and
+    quantiles attributes hold the estimates, and the mean_ci, missing_ci and
+    quantiles_ci attributes the corresponding (lower, upper) bounds of the
+    bootstrap confidence intervals at the given confidence level. Quantile
+    levels are given by the quantile_levels attribute.
+    """
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+    def report(self):
+        """Return a multi-line text summary of the estimates."""
+        pct = 100 * self.confidence
+        lines = ["{0} of {1} chunks sampled ({2}), {3:.0f}% confidence intervals:".format(
+            self.nsampled, self.nchunks, self.method, pct)]
+        lines.append("  mean:             {0:.6g}  [{1:.6g}, {2:.6g}]".format(self.mean, *self.mean_ci))
+        lines.append("  missing fraction: {0:.4f}  [{1:.4f}, {2:.4f}]".format(self.missing_fraction,
+            *self.missing_ci))
+        for q, value, ci in zip(self.quantile_levels, self.quantiles, self.quantiles_ci):
+            lines.append("  quantile {0:<8.4g} {1:.6g}  [{2:.6g}, {3:.6g}]".format(q, value, *ci))
+        return '\n'.join(lines)
+
+
+def estimate_stats(var, fraction=0.01, method='random', seed=None, nsamples=None,
+        quantiles=(0.05, 0.25, 0.5, 0.75, 0.95), confidence=0.95, nboot=200, values_per_chunk=1000,
+        workers=None, target_bytes=None, max_chunk_multiple=None, region=None, order=None):
+    """
+    Estimate the mean, quantiles and fraction of missing values of netcdf
+    variable var from a sample of its chunks, chosen as per sample_hyperslabs,
+    and return a ChunkSampleStats object. Confidence intervals are obtained by
+    bootstrap resampling (nboot times) of the sampled chunks, which accounts
+    for the correlation of values within chunks. Quantiles are estimated from
+    a random subsample of up to values_per_chunk valid values from each chunk,
+    weighted by the number of valid values in the chunk. The remaining
+    arguments have the same meaning as for nciter.iter_chunks.
+    """
+    rng = np.random.RandomState(seed)
+    sums, valid, total, subsamples = [], [], [], []
+    options = dict(target_bytes=target_bytes, max_chunk_multiple=max_chunk_multiple,
+        region=region, order=order)
+    hyperslabs = var_hyperslabs(var, **options)
+    for chunk in sample_chunks(var, fraction=fraction, method=method, seed=seed,
+            nsamples=nsamples, workers=workers, **options):
+        data = np.ma.asarray(chunk.data)
+        values = np.asarray(data.compressed(), dtype=np.float64)
+        values = values[np.isfinite(values)]
+        sums.append(values.sum())
+        valid.append(len(values))
+        total.append(data.size)
+        if len(values) > values_per_chunk:
+            values = rng.choice(values, values_per_chunk, replace=False)
+        subsamples.append(values)
+
+    sums, valid, total = np.array(sums), np.array(valid, dtype=np.float64), np.array(total, dtype=np.float64)
+    weights = [np.full(len(v), c / len(v)) if len(v) else np.empty(0) for v, c in zip(subsamples, valid)]
+    levels = np.atleast_1d(np.asarray(quantiles, dtype=np.float64))
+
+    def estimates(picks):
+        nvalid = valid[picks].sum()
+        mean = sums[picks].sum() / nvalid if nvalid else np.nan
+        missing = 1 - nvalid / total[picks].sum() if total[picks].sum() else np.nan
+        values = np.concatenate([subsamples[i] for i in picks] + [np.empty(0)])
+        w = np.concatenate([weights[i] for i in picks] + [np.empty(0)])
+        return [mean, missing] + list(_weighted_quantiles(values, w, levels))
+
+    nsampled = len(sums)
+    point = estimates(np.arange(nsampled))
+    boot = np.array([estimates(rng.randint(0, nsampled, nsampled)) for _ in range(nboot)]) \
+        if nsampled else np.full((1, len(point)), np.nan)
+    alpha = (1 - confidence) / 2
+    with np.errstate(invalid='ignore'):
+        lower = np.nanpercentile(boot, 100*alpha, axis=0) if np.isfinite(boot).any() else boot[0]
+        upper = np.nanpercentile(boot, 100*(1-alpha), axis=0) if np.isfinite(boot).any() else boot[0]
+
+    return ChunkSampleStats(nchunks=len(hyperslabs), nsampled=nsampled, method=method,
+        confidence=confidence, mean=point[0], mean_ci=(lower[0], upper[0]),
+        missing_fraction=point[1], missing_ci=(lower[1], upper[1]), quantile_levels=levels,
+        quantiles=np.array(point[2:]), quantiles_ci=np.column_stack((lower[2:], upper[2:])))
+
+
+def _weighted_quantiles(values, weights, levels):
+    """Return the specified quantiles of values, each of which has the corresponding weight."""
+    if not len(values): return np.full(len(levels), np.nan)
+    order = np.argsort(values)
+    values, weights = values[order], weights[order]
+    cumulative = np.cumsum(weights) - 0.5 * weights
+    return np.interp(levels * weights.sum(), cumulative, values)
@@ -0,0 +1,276 @@
+"""
+Writing of data chunks to netcdf variables, and chunk-wise copying of variables
+between files.
+
+Incoming chunks need not match the output variable's chunk shape; they are
+assembled into whole storage chunks in memory, so that each storage chunk is
+normally written (and compressed) just once, and the memory used is bounded.
+The copy_variable function pairs nciter's chunk readers with such a writer to
+copy a variable of any size, and is also used by ncrechunk. Example:
+
+    with NcChunkWriter(outvar) as writer:
+        for chunk in iter_chunks(invar):
+            writer.write(NcDataChunk(chunk.data * 2, chunk.coords))
+"""
+
+from collections import OrderedDict
+
+import netCDF4
+import numpy as np
+
+from nciter import HyperslabSequence, get_chunkshape, nc_lock, read_hyperslabs, var_hyperslabs
+
+
+class NcChunkWriter(object):
+    """
+    Writes data chunks to netcdf variable var, buffering them so that writes
+    land on whole storage chunks of var. Pass NcDataChunk objects (or arrays
+    plus their hyperslab coordinates) to the write method, and call close, or
+    use the writer as a context manager, to write out any partially filled
+    chunks at the end. If the buffers grow beyond max_bytes bytes then the
+    least recently updated chunks are written out, partially filled, to make
+    room. Chunks which cover a whole number of storage chunks, and all chunks
+    written to a contiguous variable, are written immediately.
+
+    Chunks may extend unlimited dimensions of var. Since the final storage chunk
+    along an unlimited dimension is normally incomplete, it is written when the
+    writer is flushed. The nchunks_written and npartial attributes record the
+    number of storage chunks written whole and the number written in part,
+    respectively.
+    """
+
+    def __init__(self, var, max_bytes=256*1024**2):
+        self.var = var
+        self.max_bytes = max_bytes
+        self.nchunks_written = 0
+        self.npartial = 0
+        self._contiguous = not isinstance(var.chunking(), (list, tuple))
+        self._chunkshape = get_chunkshape(var)
+        self._unlimited = [dim.isunlimited() for dim in var.get_dims()]
+        self._shape = None
+        self._storage = None
+        self._buffers = OrderedDict()   # storage chunk origin -> [hyperslab, data, filled, parts]
+        self._nbytes = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def write(self, chunk, coords=None):
+        """
+        Write chunk, an NcDataChunk object or else an array, in which case coords
+        gives its hyperslab within var.
+        """
+        if hasattr(chunk, 'coords'):
+            data, mask = chunk.data, getattr(chunk, 'mask', None)
+            if coords is None: coords = chunk.coords
+        else:
+            data, mask = chunk, None
+        if coords is None:
+            raise ValueError("The hyperslab coordinates of an array chunk must be specified.")
+        if mask is not None and not np.ma.isMA(data): data = np.ma.MaskedArray(data, mask)
+        data = np.ma.asanyarray(data)
+        coords = tuple(slice(s.start, s.stop) for s in coords)
+        if not self._contiguous: self._update_grid(coords)
+
+        if self._contiguous:
+            self._write(coords, data)
+            self.nchunks_written += 1
+            return
+        nchunks = self._aligned_chunks(coords)
+        if nchunks:
+            self._write(coords, data)
+            self.nchunks_written += nchunks
+            return
+
+        # Copy each part of the chunk into the buffer for its storage chunk,
+        # writing out any storage chunks which are thereby completed.
+        for part in HyperslabSequence(self._shape, self._chunkshape, region=coords):
+            n = self._storage.chunk_number([s.start for s in part])
+            hs = self._storage[n]
+            key = tuple(s.start for s in hs)
+            buf = self._buffers.pop(key, None)
+            if buf is None:
+                buf = [hs, np.ma.masked_all([s.stop-s.start for s in hs], dtype=data.dtype),
+                    np.zeros([s.stop-s.start for s in hs], dtype=bool), []]
+                self._nbytes += buf[1].nbytes + buf[2].nbytes
+            hs = buf[0]
+            dst = tuple(slice(p.start-h.start, p.stop-h.start) for p, h in zip(part, hs))
+            src = tuple(slice(p.start-c.start, p.stop-c.start) for p, c in zip(part, coords))
+            buf[1][dst] = data[src]
+            buf[2][dst] = True
+            buf[3].append(dst)
+            if buf[2].all():
+                self._write(hs, buf[1])
+                self.nchunks_written += 1
+                self._nbytes -= buf[1].nbytes + buf[2].nbytes
+            else:
+                self._buffers[key] = buf
+
+        while self._nbytes > self.max_bytes and self._buffers:
+            self._flush(self._buffers.popitem(last=False)[1])
+
+    def flush(self):
+        """Write out all partially filled storage chunks."""
+        while self._buffers:
+            self._flush(self._buffers.popitem(last=False)[1])
+
+    def close(self):
+        """Flush the writer. The variable itself is not closed."""
+        self.flush()
+
+    def _update_grid(self, coords):
+        """
+        Extend the grid of storage chunks to cover hyperslab coords. The grid
+        extends to a whole number of chunks along unlimited dimensions, so that
+        chunks are never truncated by the current length of those dimensions.
+        """
+        shape = list(self.var.shape)
+        for d, unlimited in enumerate(self._unlimited):
+            if unlimited:
+                n = max(shape[d], coords[d].stop, self._shape[d] if self._shape else 0)
+                shape[d] = -(-n // self._chunkshape[d]) * self._chunkshape[d]
+        if shape != self._shape:
+            self._shape = shape
+            self._storage = HyperslabSequence(shape, self._chunkshape)
+
+    def _aligned_chunks(self, coords):
+        """
+        Return the number of storage chunks covered by hyperslab coords if it
+        covers them exactly, and none of them is partly buffered, else 0.
+        """
+        nchunks = 1
+        for s, c, n in zip(coords, self._chunkshape, self._shape):
+            if s.start % c or (s.stop % c and s.stop != n): return 0
+            nchunks *= -(-(s.stop - s.start) // c)
+        for key in self._buffers:
+            if all(s.start <= k < s.stop for s, k in zip(coords, key)): return 0
+        return nchunks
+
+    def _flush(self, buf):
+        """
+        Write the filled parts of a partially filled storage chunk buffer, one
+        part at a time, so that no unfilled element overwrites existing data.
+        """
+        hs, data, filled, parts = buf
+        self._nbytes -= data.nbytes + filled.nbytes
+        self.npartial += 1
+        for part in parts:
+            self._write(tuple(slice(h.start+p.start, h.start+p.stop) for h, p in zip(hs, part)),
+                data[part])
+
+    def _write(self, hyperslab, data):
+        with nc_lock:
+            self.var[hyperslab] = data
+
+
+def write_chunks(var, chunks, max_bytes=256*1024**2):
+    """
+    Write the data chunks produced by iterable chunks, e.g. a generator of
+    NcDataChunk objects, to netcdf variable var using an NcChunkWriter object,
+    which is returned.
+    """
+    with NcChunkWriter(var, max_bytes=max_bytes) as writer:
+        for chunk in chunks:
+            writer.write(chunk)
+    return writer
+
+
+def copy_variable(src, dst, name=None, workers=None, target_bytes=None, max_bytes=256*1024**2,
+        block=None, **kwargs):
+    """
+    Copy netcdf variable src, including its attributes, to dst, which is either
+    a netcdf variable of the same shape or else a dataset or group in which to
+    create a new variable called name (by default the name of src). Any missing
+    dimensions are created in dst. Keyword arguments are passed to the
+    createVariable method, and override the data type, fill value, chunk sizes
+    and compression settings otherwise copied from src. Data values are copied
+    as stored, i.e. without applying masking or scale factors, chunk by chunk
+    using an NcChunkWriter, so memory use does not depend on the size of the
+    variable. The workers and target_bytes arguments have the same meaning as
+    for nciter.iter_chunks, except that if target_bytes is not specified then
+    a contiguous source is read in blocks of up to max_bytes bytes. If block is
+    specified then data is instead read in hyperslabs of that shape, visited in
+    C order, e.g. blocks aligned with the chunks of both variables (see
+    ncrechunk). Returns the destination variable.
+    """
+    if not isinstance(dst, netCDF4.Variable):
+        dst = _create_copy(src, dst, name or src.name, kwargs)
+
+    src_mask, src_scale = getattr(src, 'mask', True), getattr(src, 'scale', True)
+    dst_mask, dst_scale = getattr(dst, 'mask', True), getattr(dst, 'scale', True)
+    src.set_auto_maskandscale(False)
+    dst.set_auto_maskandscale(False)
+    try:
+        if not src.ndim:
+            with nc_lock:
+                dst.assignValue(src.getValue())
+        elif src.size:
+            if block is None:
+                if target_bytes is None and not isinstance(src.chunking(), (list, tuple)):
+                    target_bytes = max_bytes
+                hyperslabs = var_hyperslabs(src, target_bytes=target_bytes)
+            else:
+                hyperslabs = HyperslabSequence(src.shape, block)
+            write_chunks(dst, read_hyperslabs(src, hyperslabs, workers), max_bytes=max_bytes)
+    finally:
+        src.set_auto_mask(src_mask)
+        src.set_auto_scale(src_scale)
+        dst.set_auto_mask(dst_mask)
+        dst.set_auto_scale(dst_scale)
+    return dst
+
+
+def _create_copy(src, group, name, kwargs):
+    """Create, and return, a variable in group like netcdf variable src."""
+    srcgrp = src.group()
+    for dim in src.dimensions:
+        if dim not in group.dimensions:
+            srcdim = srcgrp.dimensions[dim]
+            group.createDimension(dim, None if srcdim.isunlimited() else len(srcdim))
+
+    options = _copy_kwargs(src)
+    options.update(kwargs)
+    datatype = options.pop('datatype', None) or _copy_datatype(src)
+    if options.get('chunksizes') is not None or options.get('zlib'): options.pop('contiguous', None)
+
+    var = group.createVariable(name, datatype, src.dimensions, **options)
+    var.setncatts(dict((att, src.getncattr(att)) for att in src.ncattrs() if att != '_FillValue'))
+    return var
+
+
+def _copy_kwargs(var, chunkshape=None, complevel=None, shuffle=None):
+    """
+    Return the createVariable keyword arguments for a copy of netcdf variable
+    var, with the same fill value, endianness, compression and chunking. The
+    chunk shape, compression level (0 for none) and shuffle setting may be
+    overridden by the corresponding arguments.
+    """
+    kwargs = dict(endian=var.endian())
+    if '_FillValue' in var.ncattrs(): kwargs['fill_value'] = var.getncattr('_FillValue')
+    if not var.dimensions or var.dtype == str: return kwargs
+
+    filters = var.filters() or {}
+    zlib = filters.get('zlib', False) if complevel is None else complevel > 0
+    if zlib:
+        kwargs.update(zlib=True, complevel=filters.get('complevel', 4) if complevel is None else complevel)
+    kwargs['shuffle'] = filters.get('shuffle', False) if shuffle is None else shuffle
+    if filters.get('fletcher32'): kwargs['fletcher32'] = True
+
+    if chunkshape is None:
+        chunkshape = var.chunking()
+    if isinstance(chunkshape, (list, tuple)):
+        kwargs['chunksizes'] = chunkshape
+    elif not zlib and not any(var.group().dimensions[d].isunlimited() for d in var.dimensions):
+        kwargs['contiguous'] = True
+    return kwargs
+
+
+def _copy_datatype(var):
+    """Return the datatype argument for creating a copy of netcdf variable var."""
+    if var.dtype == str: return str
+    if not isinstance(var.datatype, np.dtype):
+        raise ValueError("Variable {0} has an unsupported user-defined type.".format(var.name))
+    return var.datatype
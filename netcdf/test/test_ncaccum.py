@@ -0,0 +1,159 @@
+"""
+Unit tests for the ncaccum module.
+"""
+import unittest
+import numpy as np
+import ncaccum
+from nciter import NcDataChunk, iter_hyperslabs
+
+#---------------------------------------------------------------------------------------------------
+class TestAccumulators(unittest.TestCase) :
+#---------------------------------------------------------------------------------------------------
+   def setUp(self) :
+      rng = np.random.RandomState(3)
+      self.data = rng.normal(280.0, 5.0, (6,8,10))
+      self.chunkshape = (2,3,4)
+
+   def chunks(self, data) :
+      for coords in iter_hyperslabs(data.shape, self.chunkshape) :
+         yield NcDataChunk(data[tuple(coords)], coords)
+
+   def accumulate(self, acc, data) :
+      # Accumulate the chunks in two halves, as two workers would, then merge.
+      chunks = list(self.chunks(data))
+      other = acc.empty()
+      ncaccum.accumulate(chunks[::2], acc)
+      ncaccum.accumulate(chunks[1::2], other)
+      return ncaccum.merge(acc, other)
+
+   def test_mean_variance(self) :
+      mv = self.accumulate(ncaccum.MeanVariance(self.data.shape), self.data)
+      self.assertEqual(mv.count, self.data.size)
+      self.assertTrue(np.allclose(mv.sum, self.data.sum()))
+      self.assertTrue(np.allclose(mv.mean, self.data.mean()))
+      self.assertTrue(np.allclose(mv.variance(), self.data.var()))
+      self.assertTrue(np.allclose(mv.std(ddof=1), self.data.std(ddof=1)))
+
+   def test_keep(self) :
+      mv = self.accumulate(ncaccum.MeanVariance(self.data.shape, keep=0), self.data)
+      self.assertEqual(mv.mean.shape, (6,))
+      self.assertTrue(np.allclose(mv.mean, self.data.mean(axis=(1,2))))
+      mv = self.accumulate(ncaccum.MeanVariance(self.data.shape, keep=(2,1)), self.data)
+      self.assertTrue(np.allclose(mv.variance(), self.data.var(axis=0)))
+
+   def test_min_max(self) :
+      mm = self.accumulate(ncaccum.MinMax(self.data.shape), self.data)
+      self.assertEqual(mm.min, self.data.min())
+      self.assertEqual(mm.max, self.data.max())
+      self.assertEqual(tuple(mm.argmin),
+         np.unravel_index(np.argmin(self.data), self.data.shape))
+      self.assertEqual(tuple(mm.argmax),
+         np.unravel_index(np.argmax(self.data), self.data.shape))
+
+      mm = self.accumulate(ncaccum.MinMax(self.data.shape, keep=0), self.data)
+      self.assertTrue(np.array_equal(mm.max, self.data.max(axis=(1,2))))
+      for t in range(6) :
+         self.assertEqual(self.data[tuple(mm.argmax[t])], mm.max[t])
+         self.assertEqual(mm.argmax[t][0], t)
+
+   def test_argmax_ties(self) :
+      data = np.zeros((6,8,10))
+      data[4,1,2] = data[1,7,9] = 1.0
+      mm = self.accumulate(ncaccum.MinMax(data.shape), data)
+      self.assertEqual(tuple(mm.argmax), (1,7,9))
+      self.assertEqual(tuple(mm.argmin), (0,0,0))
+
+   def test_histogram(self) :
+      hist = self.accumulate(ncaccum.Histogram(self.data.shape, bins=10, range=(270, 290)),
+         self.data)
+      counts, edges = np.histogram(self.data, bins=10, range=(270, 290))
+      self.assertTrue(np.array_equal(hist.edges, edges))
+      self.assertTrue(np.array_equal(hist.counts, counts))
+      self.assertEqual(hist.underflow, (self.data < 270).sum())
+      self.assertEqual(hist.overflow, (self.data > 290).sum())
+      self.assertRaises(ValueError, ncaccum.Histogram, self.data.shape, bins=10)
+      other = ncaccum.Histogram(self.data.shape, bins=[270, 280, 290])
+      self.assertRaises(ValueError, hist.merge, other)
+
+   def test_quantiles(self) :
+      sketch = self.accumulate(ncaccum.QuantileSketch(self.data.shape, 0.01), self.data)
+      self.assertEqual(sketch.count, self.data.size)
+      values = np.sort(self.data.ravel())
+      qs = [0.0, 0.1, 0.5, 0.9, 1.0]
+      result = sketch.quantile(qs)
+      for q, estimate in zip(qs, result) :
+         exact = values[int(np.floor(q * (values.size - 1)))]
+         self.assertTrue(abs(estimate - exact) <= 0.01 * abs(exact))
+
+      data = self.data - 280.0
+      sketch = self.accumulate(ncaccum.QuantileSketch(data.shape, 0.01, keep=0), data)
+      median = sketch.quantile(0.5)
+      for t in range(6) :
+         values = np.sort(data[t].ravel())
+         exact = values[(values.size - 1) // 2]
+         self.assertTrue(abs(median[t] - exact) <= 0.01 * abs(exact))
+
+   def test_merge_mismatch(self) :
+      mv = ncaccum.MeanVariance(self.data.shape)
+      self.assertRaises(ValueError, mv.merge, ncaccum.MinMax(self.data.shape))
+      self.assertRaises(ValueError, mv.merge, ncaccum.MeanVariance(self.data.shape, keep=0))
+
+   def test_chunk_mapper(self) :
+      mapper = ncaccum.ChunkMapper(ncaccum.MeanVariance(self.data.shape),
+         ncaccum.MinMax(self.data.shape))
+      results = [mapper(chunk) for chunk in self.chunks(self.data)]
+      mv, mm = results[0]
+      for result in results[1:] : ncaccum.merge([mv, mm], result)
+      self.assertTrue(np.allclose(mv.mean, self.data.mean()))
+      self.assertEqual(mm.max, self.data.max())
+
+   def test_missing(self) :
+      data = np.ma.masked_greater(self.data, 285.0)
+      data[0,0,:3] = np.nan
+      data[1,2,3] = np.inf
+      valid = np.isfinite(data.filled(np.nan))
+      values = self.data[valid]
+
+      count = self.accumulate(ncaccum.Count(data.shape), data)
+      self.assertEqual(count.valid, valid.sum())
+      self.assertEqual(count.missing, data.size - valid.sum())
+      self.assertEqual(count.total, data.size)
+      mv = self.accumulate(ncaccum.MeanVariance(data.shape), data)
+      self.assertTrue(np.allclose(mv.mean, values.mean()))
+      self.assertTrue(np.allclose(mv.variance(), values.var()))
+      mm = self.accumulate(ncaccum.MinMax(data.shape), data)
+      self.assertEqual(mm.max, values.max())
+      self.assertTrue(valid[tuple(mm.argmax)])
+      hist = self.accumulate(ncaccum.Histogram(data.shape, [-np.inf, 280, np.inf]), data)
+      self.assertEqual(hist.counts.sum(), valid.sum())
+
+   def test_separate_mask(self) :
+      mask = self.data > 285.0
+      mv = ncaccum.MeanVariance(self.data.shape)
+      for coords in iter_hyperslabs(self.data.shape, self.chunkshape) :
+         index = tuple(coords)
+         mv.update(NcDataChunk(self.data[index], coords, mask=mask[index]))
+      self.assertTrue(np.allclose(mv.mean, self.data[~mask].mean()))
+
+   def test_all_missing(self) :
+      data = np.ma.masked_all((6,8,10))
+      mv = ncaccum.MeanVariance(data.shape, keep=0).update(data)
+      self.assertTrue(np.isnan(mv.mean).all())
+      mm = ncaccum.MinMax(data.shape).update(data)
+      self.assertTrue(np.isnan(mm.max))
+      self.assertEqual(tuple(mm.argmax), (-1,-1,-1))
+      sketch = ncaccum.QuantileSketch(data.shape).update(data)
+      self.assertTrue(np.isnan(sketch.quantile(0.5)))
+
+   def test_plain_array(self) :
+      part = self.data[2:4,3:6,:]
+      coords = [slice(2,4), slice(3,6), slice(0,10)]
+      mm = ncaccum.MinMax(self.data.shape).update(part, coords)
+      self.assertEqual(self.data[tuple(mm.argmax)], part.max())
+      mv = ncaccum.MeanVariance(part.shape).update(part)
+      self.assertTrue(np.allclose(mv.mean, part.mean()))
+
+#---------------------------------------------------------------------------------------------------
+if __name__ == '__main__':
+#---------------------------------------------------------------------------------------------------
+   unittest.main()
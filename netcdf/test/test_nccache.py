@@ -0,0 +1,72 @@
+"""
+Unit tests for the shared chunk cache.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+import netCDF4
+import numpy as np
+import nciter
+import nccache
+import ncwrite
+
+#---------------------------------------------------------------------------------------------------
+class TestChunkCache(unittest.TestCase) :
+#---------------------------------------------------------------------------------------------------
+   def setUp(self) :
+      self.tmpdir = tempfile.mkdtemp()
+      ncpath = os.path.join(self.tmpdir, 'packed.nc')
+      ds = netCDF4.Dataset(ncpath, 'w')
+      ds.createDimension('x', 40)
+      var = ds.createVariable('v', 'i2', ('x',), chunksizes=(10,), fill_value=-1)
+      var.scale_factor = 0.5
+      var.add_offset = 100.0
+      var.set_auto_maskandscale(False)
+      var[:] = np.arange(0, 80, 2)
+      var[5] = -1
+      ds.close()
+      self.ds = netCDF4.Dataset(ncpath)
+      self.out = netCDF4.Dataset(os.path.join(self.tmpdir, 'copy.nc'), 'w')
+      self.cache = nccache.enable_chunk_cache()
+
+   def tearDown(self) :
+      nccache.disable_chunk_cache()
+      self.out.close()
+      self.ds.close()
+      shutil.rmtree(self.tmpdir)
+
+   def test_repeat_reads(self) :
+      var = self.ds['v']
+      first = [chunk.data for chunk in nciter.iter_chunks(var)]
+      hits = self.cache.hits
+      second = [chunk.data for chunk in nciter.iter_chunks(var)]
+      self.assertEqual(self.cache.hits, hits + 4)
+      for a, b in zip(first, second) :
+         self.assertTrue(np.ma.allequal(a, b))
+
+   def test_masking_settings(self) :
+      var = self.ds['v']
+      masked = next(nciter.iter_chunks(var)).data
+      self.assertTrue(masked.mask[5])
+      raw = next(nciter.iter_chunks(var, mask='none')).data
+      self.assertEqual(raw[5], 100 + 0.5 * -1)
+      var.set_auto_maskandscale(False)
+      packed = next(nciter.iter_chunks(var)).data
+      self.assertTrue(np.array_equal(packed, [0, 2, 4, 6, 8, -1, 12, 14, 16, 18]))
+
+   def test_copy_after_scaled_read(self) :
+      var = self.ds['v']
+      for chunk in nciter.iter_chunks(var) :
+         expected = 100 + 0.5 * np.arange(0, 80, 2)[chunk.coords]
+         self.assertTrue(np.allclose(chunk.data.compressed(), expected[~chunk.data.mask]))
+      copy = ncwrite.copy_variable(var, self.out)
+      copy.set_auto_maskandscale(False)
+      expected = np.arange(0, 80, 2)
+      expected[5] = -1
+      self.assertTrue(np.array_equal(copy[:], expected))
+
+#---------------------------------------------------------------------------------------------------
+if __name__ == '__main__':
+#---------------------------------------------------------------------------------------------------
+   unittest.main()
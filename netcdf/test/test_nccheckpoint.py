@@ -0,0 +1,67 @@
+"""
+Unit tests for checkpointing chunk iterations.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+import netCDF4
+import numpy as np
+import nciter
+import nccheckpoint
+
+#---------------------------------------------------------------------------------------------------
+class TestChunkCheckpoint(unittest.TestCase) :
+#---------------------------------------------------------------------------------------------------
+   def setUp(self) :
+      self.tmpdir = tempfile.mkdtemp()
+      ncpath = os.path.join(self.tmpdir, 'ckpt.nc')
+      ds = netCDF4.Dataset(ncpath, 'w')
+      for name, size in (('t', 10), ('y', 20), ('x', 30)) :
+         ds.createDimension(name, size)
+      var = ds.createVariable('t', 'f4', ('t','y','x'), chunksizes=(1,10,15))
+      var[:] = np.random.RandomState(1).rand(10,20,30)
+      ds.close()
+      self.ds = netCDF4.Dataset(ncpath)
+      self.path = os.path.join(self.tmpdir, 'job.ckpt')
+
+   def tearDown(self) :
+      self.ds.close()
+      shutil.rmtree(self.tmpdir)
+
+   def interrupt(self, nchunks, **kwargs) :
+      ckpt = nccheckpoint.ChunkCheckpoint(self.path, interval=5, state={'total': 0.0})
+      for i, chunk in enumerate(nciter.iter_chunks(self.ds['t'], checkpoint=ckpt, **kwargs)) :
+         if i == nchunks : break
+         ckpt.state['total'] += float(chunk.data.sum())
+
+   def test_resume(self) :
+      self.interrupt(12)
+      ckpt = nccheckpoint.ChunkCheckpoint(self.path)
+      self.assertEqual(ckpt.position, 10)
+      chunks = list(nciter.iter_chunks(self.ds['t'], checkpoint=ckpt))
+      self.assertEqual(len(chunks), 30)
+      for chunk in chunks :
+         ckpt.state['total'] += float(chunk.data.sum())
+      self.assertTrue(np.isclose(ckpt.state['total'], float(self.ds['t'][:].sum())))
+      self.assertTrue(nccheckpoint.ChunkCheckpoint(self.path).complete)
+
+   def test_resume_shard(self) :
+      self.interrupt(7, shard=1, nshards=3, strategy='round_robin')
+      ckpt = nccheckpoint.ChunkCheckpoint(self.path)
+      chunks = list(nciter.iter_chunks(self.ds['t'], checkpoint=ckpt, shard=1, nshards=3,
+         strategy='round_robin'))
+      self.assertEqual(len(chunks), 13 - 5)
+
+   def test_mismatch(self) :
+      self.interrupt(12)
+      for kwargs in (dict(order='F'), dict(region=(slice(0,5),)), dict(target_bytes=4800),
+            dict(shard=0, nshards=2)) :
+         ckpt = nccheckpoint.ChunkCheckpoint(self.path)
+         self.assertRaises(ValueError, list, nciter.iter_chunks(self.ds['t'], checkpoint=ckpt,
+            **kwargs))
+
+#---------------------------------------------------------------------------------------------------
+if __name__ == '__main__':
+#---------------------------------------------------------------------------------------------------
+   unittest.main()
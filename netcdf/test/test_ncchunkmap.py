@@ -0,0 +1,123 @@
+"""
+Unit tests for reading netcdf chunks directly via a ChunkByteIndex.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+import netCDF4
+import numpy as np
+import nciter
+import ncchunkmap
+
+try:
+   import h5py
+except ImportError:
+   h5py = None
+
+#---------------------------------------------------------------------------------------------------
+@unittest.skipIf(h5py is None, "building a chunk index requires h5py")
+class TestDirectChunks(unittest.TestCase) :
+#---------------------------------------------------------------------------------------------------
+   def setUp(self) :
+      self.tmpdir = tempfile.mkdtemp()
+      self.ncpath = os.path.join(self.tmpdir, 'direct.nc')
+      rng = np.random.RandomState(1)
+      ds = netCDF4.Dataset(self.ncpath, 'w')
+      ds.createDimension('t', None)
+      ds.createDimension('y', 45)
+      ds.createDimension('x', 70)
+      a = ds.createVariable('a', 'f4', ('t','y','x'), zlib=True, shuffle=True, chunksizes=(3,20,30),
+         fill_value=-1e20)
+      a[:] = np.ma.masked_less(rng.rand(7,45,70).astype('f4'), 0.1)
+      b = ds.createVariable('b', 'i2', ('t','y','x'), zlib=True, chunksizes=(4,25,25),
+         fletcher32=True)
+      b.scale_factor = 0.01
+      b.add_offset = 5.0
+      b.missing_value = np.int16(-5)
+      b[:5] = np.ma.masked_greater(rng.rand(5,45,70)*20, 18)
+      g = ds.createGroup('g')
+      c = g.createVariable('c', 'f8', ('y','x'), contiguous=True)
+      c[:] = rng.rand(45,70)
+      e = ds.createVariable('e', 'f4', ('y','x'), chunksizes=(10,10), zlib=True)
+      e[:30,:40] = 1.5
+      f = ds.createVariable('f', 'f4', ('y','x'), chunksizes=(20,30), fletcher32=True)
+      f[:] = rng.rand(45,70)
+      ds.close()
+      self.index = ncchunkmap.ChunkByteIndex.build(self.ncpath)
+      self.ds = netCDF4.Dataset(self.ncpath)
+
+   def tearDown(self) :
+      self.ds.close()
+      shutil.rmtree(self.tmpdir)
+
+   def assertSameChunks(self, varname, var, **kwargs) :
+      mask = kwargs.get('mask', 'ma')
+      direct = list(ncchunkmap.iter_direct_chunks(self.index, varname, **kwargs))
+      direct.sort(key=lambda chunk: [s.start for s in chunk.coords])
+      normal = list(nciter.iter_chunks(var, mask=mask))
+      self.assertEqual(len(direct), len(normal))
+      for x, y in zip(direct, normal) :
+         self.assertEqual(x.coords, y.coords)
+         self.assertEqual(x.data.dtype, y.data.dtype)
+         self.assertTrue(np.array_equal(np.ma.getmaskarray(x.data), np.ma.getmaskarray(y.data)))
+         if mask == 'separate' :
+            self.assertTrue(np.array_equal(x.mask, y.mask))
+            valid = ~np.asarray(y.mask)
+         else :
+            valid = ~np.ma.getmaskarray(y.data)
+         self.assertTrue(np.array_equal(np.ma.getdata(x.data)[valid], np.ma.getdata(y.data)[valid]))
+
+   def test_deflate_shuffle_fill(self) :
+      for mask in ('ma', 'separate', 'none') :
+         self.assertSameChunks('a', self.ds['a'], mask=mask)
+
+   def test_scale_offset_missing_value(self) :
+      for mask in ('ma', 'separate', 'none') :
+         self.assertSameChunks('b', self.ds['b'], mask=mask)
+
+   def test_contiguous_in_group(self) :
+      self.assertSameChunks('g/c', self.ds['g']['c'])
+
+   def test_unwritten_chunks(self) :
+      self.assertSameChunks('e', self.ds['e'])
+
+   def test_threads_unordered(self) :
+      self.assertSameChunks('a', self.ds['a'], workers=3, ordered=False)
+
+   def test_processes(self) :
+      self.assertSameChunks('b', self.ds['b'], processes=2)
+
+   def test_saved_index(self) :
+      path = ncchunkmap.ChunkByteIndex.default_path(self.ncpath)
+      self.index.save(path)
+      self.index = path
+      self.assertSameChunks('a', self.ds['a'])
+
+   def test_modified_file(self) :
+      with open(self.ncpath, 'ab') as fh :
+         fh.write(b'\0')
+      self.assertRaises(Exception, list, ncchunkmap.iter_direct_chunks(self.index, 'a'))
+
+   def test_checksum(self) :
+      self.assertEqual(ncchunkmap._fletcher32(b''), 0)
+      self.assertEqual(ncchunkmap._fletcher32(b'\xff\xff'), 0xffffffff)
+      self.assertEqual(ncchunkmap._fletcher32(b'\x01\x02\x03'), 0x05040402)
+      self.assertSameChunks('f', self.ds['f'])
+      self.ds.close()
+      offset = int(self.index.variables['f']['offsets'][1])
+      with open(self.ncpath, 'r+b') as fh :
+         fh.seek(offset + 10)
+         byte = bytearray(fh.read(1))
+         fh.seek(offset + 10)
+         fh.write(bytes(bytearray([byte[0] ^ 0xff])))
+      self.index = ncchunkmap.ChunkByteIndex.build(self.ncpath)
+      self.ds = netCDF4.Dataset(self.ncpath)
+      self.assertRaises(IOError, list, ncchunkmap.iter_direct_chunks(self.index, 'f'))
+      chunks = ncchunkmap.iter_direct_chunks(self.index, 'f')
+      self.assertEqual(next(chunks).coords, list(nciter.iter_hyperslabs((45,70), (20,30)))[0])
+
+#---------------------------------------------------------------------------------------------------
+if __name__ == '__main__':
+#---------------------------------------------------------------------------------------------------
+   unittest.main()
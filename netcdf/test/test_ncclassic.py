@@ -0,0 +1,97 @@
+"""
+Unit tests for the netcdf-3 header parser and memory-mapped reader.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+import netCDF4
+import numpy as np
+import nciter
+import ncclassic
+
+#---------------------------------------------------------------------------------------------------
+class TestClassicNcFile(unittest.TestCase) :
+#---------------------------------------------------------------------------------------------------
+   def setUp(self) :
+      self.tmpdir = tempfile.mkdtemp()
+      self.rng = np.random.RandomState(1)
+
+   def tearDown(self) :
+      shutil.rmtree(self.tmpdir)
+
+   def write(self, fmt, specs, nrecs=11) :
+      """Write a file in the given format, returning its path and the data written."""
+      path = os.path.join(self.tmpdir, fmt.lower() + '.nc')
+      ds = netCDF4.Dataset(path, 'w', format=fmt)
+      ds.title = 'hello'
+      ds.nums = np.array([1,2,3], 'i2')
+      for name, size in (('t', None), ('y', 5), ('x', 7), ('s', 3)) :
+         ds.createDimension(name, size)
+      values = {}
+      for name, dtype, dims in specs :
+         var = ds.createVariable(name, dtype, dims)
+         var.units = 'm'
+         shape = tuple(nrecs if d == 't' else len(ds.dimensions[d]) for d in dims)
+         if dtype == 'S1' :
+            data = self.rng.choice(list(b'abc'), size=shape).astype('u1').view('S1')
+         else :
+            data = np.asarray(self.rng.rand(*shape) * 100).astype(dtype)
+         var.set_auto_mask(False)
+         var[...] = data
+         values[name] = data
+      ds.close()
+      return path, values
+
+   def assertParsed(self, path, values) :
+      ncfile = ncclassic.ClassicNcFile(path)
+      ds = netCDF4.Dataset(path)
+      try :
+         self.assertEqual(ncfile.numrecs, len(ds.dimensions['t']))
+         self.assertEqual(ncfile.ncattrs['title'], 'hello')
+         self.assertTrue(np.array_equal(ncfile.ncattrs['nums'], [1,2,3]))
+         self.assertEqual(list(ncfile.dimensions), list(ds.dimensions))
+         with open(path, 'rb') as fh :
+            raw = fh.read()
+         for name, data in values.items() :
+            var = ncfile.variables[name]
+            self.assertEqual(var.shape, ds[name].shape)
+            self.assertEqual(var.dimensions, ds[name].dimensions)
+            self.assertEqual(var.ncattrs['units'], 'm')
+            # The variable's data (or its first record) begins at the parsed offset.
+            first = data[0] if var.isrecord else data
+            first = np.ascontiguousarray(first).astype(var.dtype).tobytes()
+            self.assertEqual(raw[var.begin:var.begin+len(first)], first)
+            self.assertTrue(np.array_equal(var[...], data))
+            if var.ndim :
+               result = np.empty(data.shape, data.dtype)
+               for chunk in nciter.iter_chunks(var, target_bytes=50) :
+                  result[chunk.coords] = chunk.data
+               self.assertTrue(np.array_equal(result, data))
+      finally :
+         ds.close()
+
+   def test_formats(self) :
+      specs = [('a','f4',('t','y','x')), ('b','i2',('y','x')), ('c','S1',('t','s')),
+         ('d','f8',('t',)), ('e','i1',('t','x')), ('z','f8',())]
+      for fmt in ('NETCDF3_CLASSIC', 'NETCDF3_64BIT_OFFSET', 'NETCDF3_64BIT_DATA') :
+         path, values = self.write(fmt, specs)
+         self.assertParsed(path, values)
+         self.assertEqual(ncclassic.ClassicNcFile(path).version, {'NETCDF3_CLASSIC': 1,
+            'NETCDF3_64BIT_OFFSET': 2, 'NETCDF3_64BIT_DATA': 5}[fmt])
+
+   def test_single_record_variable(self) :
+      specs = [('a','f4',('t','y','x')), ('b','i2',('y','x'))]
+      for fmt in ('NETCDF3_CLASSIC', 'NETCDF3_64BIT_DATA') :
+         path, values = self.write(fmt, specs, nrecs=4)
+         self.assertParsed(path, values)
+
+   def test_not_classic(self) :
+      path = os.path.join(self.tmpdir, 'nc4.nc')
+      netCDF4.Dataset(path, 'w', format='NETCDF4').close()
+      self.assertRaises(ValueError, ncclassic.ClassicNcFile, path)
+
+#---------------------------------------------------------------------------------------------------
+if __name__ == '__main__':
+#---------------------------------------------------------------------------------------------------
+   unittest.main()
@@ -0,0 +1,75 @@
+"""
+Unit tests for the ncexpr module.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+import netCDF4
+import numpy as np
+import ncexpr
+
+#---------------------------------------------------------------------------------------------------
+class TestExpressions(unittest.TestCase) :
+#---------------------------------------------------------------------------------------------------
+   def setUp(self) :
+      self.tmpdir = tempfile.mkdtemp()
+      rng = np.random.RandomState(5)
+      self.t1 = rng.normal(280.0, 5.0, (40,50,60)).astype('f4')
+      self.t2 = (self.t1 + rng.normal(0.0, 1.0, self.t1.shape)).astype('f4')
+      self.t2[3,4,:] = 1e20
+      self.datasets = []
+
+   def tearDown(self) :
+      for ds in self.datasets : ds.close()
+      shutil.rmtree(self.tmpdir)
+
+   def create(self, fmt, **kwargs) :
+      path = os.path.join(self.tmpdir, fmt.lower() + '.nc')
+      ds = netCDF4.Dataset(path, 'w', format=fmt)
+      for name, size in zip(('time','lat','lon'), self.t1.shape) :
+         ds.createDimension(name, size)
+      for name, data in (('t1', self.t1), ('t2', self.t2)) :
+         var = ds.createVariable(name, 'f4', ('time','lat','lon'), fill_value=1e20, **kwargs)
+         var[:] = data
+      ds.close()
+      ds = netCDF4.Dataset(path)
+      self.datasets.append(ds)
+      return ds
+
+   def check(self, ds, target_bytes, nblocks) :
+      t1, t2 = ncexpr.wrap(ds['t1']), ncexpr.wrap(ds['t2'])
+      diff = t1 - t2
+      blocks = list(diff.iter_chunks(target_bytes=target_bytes))
+      self.assertEqual(len(blocks), nblocks)
+      for block in blocks :
+         self.assertTrue(block.data.size * 8 <= target_bytes)
+
+      expected = np.ma.masked_equal(self.t2, np.float32(1e20))
+      expected = self.t1.astype('f8') - expected
+      self.assertTrue(np.ma.allclose(diff.compute(target_bytes=target_bytes), expected))
+      rmse = ncexpr.sqrt((diff**2).mean()).compute(workers=2, target_bytes=target_bytes)
+      self.assertTrue(np.allclose(rmse, np.sqrt((expected**2).mean())))
+      anomaly = (t1 - t1.mean(axis=0)).compute(target_bytes=target_bytes)
+      self.assertTrue(np.allclose(anomaly, self.t1 - self.t1.mean(axis=0, dtype='f8')))
+
+   def test_classic(self) :
+      # Each time step is 24000 bytes as doubles, so a 100000-byte target gives 4 steps per block.
+      ds = self.create('NETCDF3_CLASSIC')
+      self.check(ds, 100000, 10)
+
+   def test_chunked(self) :
+      # Blocks are made up of whole (5,25,30) chunks: two along lon fit within the target.
+      ds = self.create('NETCDF4', chunksizes=(5,25,30))
+      self.check(ds, 100000, 16)
+
+   def test_arrays(self) :
+      diff = ncexpr.wrap(self.t1) - ncexpr.wrap(self.t1[0])
+      blocks = list(diff.iter_chunks(target_bytes=50000))
+      self.assertEqual(len(blocks), 20)
+      self.assertTrue(np.allclose(diff.compute(target_bytes=50000), self.t1 - self.t1[0]))
+
+#---------------------------------------------------------------------------------------------------
+if __name__ == '__main__':
+#---------------------------------------------------------------------------------------------------
+   unittest.main()
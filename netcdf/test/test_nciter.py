@@ -0,0 +1,358 @@
+"""
+Unit tests for chunk iteration over netcdf variables.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+from itertools import product
+import netCDF4
+import numpy as np
+import nciter
+
+#---------------------------------------------------------------------------------------------------
+class TestHyperslabSequence(unittest.TestCase) :
+#---------------------------------------------------------------------------------------------------
+   def setUp(self) :
+      self.shape = (5, 7, 11)
+      self.chunkshape = (2, 3, 4)
+      self.seq = nciter.HyperslabSequence(self.shape, self.chunkshape)
+      self.expected = [tuple(slice(a, min(a+c, n), 1) for a, c, n in
+         zip(start, self.chunkshape, self.shape))
+         for start in product(range(0,5,2), range(0,7,3), range(0,11,4))]
+
+   def test_len_and_iteration(self) :
+      self.assertEqual(len(self.seq), 27)
+      self.assertEqual(list(self.seq), self.expected)
+      self.assertEqual(list(nciter.iter_hyperslabs(self.shape, self.chunkshape)), self.expected)
+
+   def test_indexing(self) :
+      for i in range(-27, 27) :
+         self.assertEqual(self.seq[i], self.expected[i])
+      self.assertRaises(IndexError, lambda : self.seq[27])
+      self.assertRaises(IndexError, lambda : self.seq[-28])
+
+   def test_slicing(self) :
+      for key in (slice(None), slice(3, 20), slice(None, None, 4), slice(None, None, -1),
+            slice(20, 2, -3), slice(-5, None), slice(30, 40), slice(5, 5), slice(-1, -30, -7)) :
+         sub = self.seq[key]
+         self.assertEqual(len(sub), len(self.expected[key]))
+         self.assertEqual(list(sub), self.expected[key])
+         self.assertEqual([sub[i] for i in range(len(sub))], self.expected[key])
+      sub = self.seq[::-2][1:10:3]
+      self.assertEqual(list(sub), self.expected[::-2][1:10:3])
+
+   def test_index(self) :
+      sub = self.seq[::-3]
+      for i, hyperslab in enumerate(self.expected[::-3]) :
+         self.assertEqual(sub.index(hyperslab), i)
+      self.assertFalse(self.expected[1] in sub)
+      self.assertTrue(self.expected[2] in sub)
+      self.assertEqual(self.seq.chunk_number((4, 6, 10)), 26)
+      self.assertEqual(self.seq.chunk_number((0, 3, 5)), 4)
+      self.assertRaises(ValueError, self.seq.chunk_number, (5, 0, 0))
+
+   def test_order(self) :
+      seq = nciter.HyperslabSequence(self.shape, self.chunkshape, order='F')
+      key = lambda hs : [s.start for s in reversed(hs)]
+      self.assertEqual(list(seq), sorted(self.expected, key=key))
+      self.assertEqual([seq[i] for i in range(len(seq))], list(seq))
+      seq = nciter.HyperslabSequence(self.shape, self.chunkshape, order=(1, 2, 0))
+      key = lambda hs : [hs[1].start, hs[2].start, hs[0].start]
+      self.assertEqual(list(seq), sorted(self.expected, key=key))
+      self.assertEqual(list(seq[::-1]), sorted(self.expected, key=key)[::-1])
+
+   def test_region(self) :
+      seq = nciter.HyperslabSequence(self.shape, self.chunkshape, region=(slice(1,4), 2))
+      self.assertEqual(len(seq), 2 * 1 * 3)
+      self.assertEqual(seq[0], (slice(1,2,1), slice(2,3,1), slice(0,4,1)))
+      self.assertEqual(seq[-1], (slice(2,4,1), slice(2,3,1), slice(8,11,1)))
+
+#---------------------------------------------------------------------------------------------------
+class TestBlockShape(unittest.TestCase) :
+#---------------------------------------------------------------------------------------------------
+   def setUp(self) :
+      self.tmpdir = tempfile.mkdtemp()
+      ncpath = os.path.join(self.tmpdir, 'classic.nc')
+      ds = netCDF4.Dataset(ncpath, 'w', format='NETCDF3_CLASSIC')
+      for name, size in (('t', 10), ('y', 20), ('x', 30)) :
+         ds.createDimension(name, size)
+      var = ds.createVariable('t', 'f4', ('t','y','x'))
+      var[:] = np.random.RandomState(1).rand(10,20,30)
+      ds.close()
+      self.ds = netCDF4.Dataset(ncpath)
+      self.ds4 = netCDF4.Dataset(os.path.join(self.tmpdir, 'chunked.nc'), 'w')
+      for name, size in (('t', 10), ('y', 20), ('x', 30)) :
+         self.ds4.createDimension(name, size)
+      self.ds4.createVariable('t', 'f4', ('t','y','x'), chunksizes=(1,10,15))
+
+   def tearDown(self) :
+      self.ds.close()
+      self.ds4.close()
+      shutil.rmtree(self.tmpdir)
+
+   def test_split_shape(self) :
+      self.assertEqual(nciter.split_shape((10,20,30), 10**6, 4), (10,20,30))
+      self.assertEqual(nciter.split_shape((10,20,30), 2400*3, 4), (3,20,30))
+      self.assertEqual(nciter.split_shape((10,20,30), 2400, 4), (1,20,30))
+      self.assertEqual(nciter.split_shape((10,20,30), 1000, 4), (1,8,30))
+      self.assertEqual(nciter.split_shape((10,20,30), 100, 4), (1,1,25))
+      self.assertEqual(nciter.split_shape((10,20,30), 1, 4), (1,1,1))
+      self.assertEqual(nciter.split_shape((0,20,30), 1000, 4), (1,8,30))
+      self.assertEqual(nciter.split_shape((), 1000, 4), ())
+
+   def test_contiguous(self) :
+      var = self.ds['t']
+      self.assertEqual(nciter.block_shape(var), (10,20,30))
+      self.assertEqual(nciter.block_shape(var, target_bytes=5000), (2,20,30))
+      self.assertEqual(nciter.block_shape(var, target_bytes=5000, itemsize=8), (1,20,30))
+      chunks = list(nciter.iter_chunks(var, target_bytes=1000))
+      self.assertEqual(len(chunks), 30)
+      for chunk in chunks :
+         self.assertTrue(chunk.data.nbytes <= 1000)
+         self.assertTrue(np.array_equal(chunk.data, var[chunk.coords]))
+
+   def test_chunked(self) :
+      var = self.ds4['t']
+      self.assertEqual(nciter.block_shape(var), (1,10,15))
+      self.assertEqual(nciter.block_shape(var, target_bytes=1500), (1,10,30))
+      self.assertEqual(nciter.block_shape(var, max_chunk_multiple=6), (1,20,30))
+      self.assertEqual(nciter.block_shape(var, target_bytes=100), (1,10,15))
+
+#---------------------------------------------------------------------------------------------------
+class TestSharding(unittest.TestCase) :
+#---------------------------------------------------------------------------------------------------
+   def setUp(self) :
+      self.tmpdir = tempfile.mkdtemp()
+      ncpath = os.path.join(self.tmpdir, 'shard.nc')
+      ds = netCDF4.Dataset(ncpath, 'w')
+      for name, size in (('t', 9), ('y', 20), ('x', 30)) :
+         ds.createDimension(name, size)
+      var = ds.createVariable('t', 'f4', ('t','y','x'), chunksizes=(1,10,15), zlib=True)
+      var[:] = np.random.RandomState(1).rand(9,20,30)
+      var[:4] = 0
+      ds.close()
+      self.ds = netCDF4.Dataset(ncpath)
+      self.seq = nciter.HyperslabSequence((9,20,30), (1,10,15))
+
+   def tearDown(self) :
+      self.ds.close()
+      shutil.rmtree(self.tmpdir)
+
+   def assertPartition(self, shards) :
+      full = list(self.seq)
+      union = [hs for shard in shards for hs in shard]
+      self.assertEqual(len(union), len(full))
+      self.assertEqual(sorted(union, key=full.index), full)
+      for shard in shards :
+         positions = [full.index(hs) for hs in shard]
+         self.assertEqual(positions, sorted(positions))
+
+   def test_strategies(self) :
+      weights = np.arange(len(self.seq)) % 5 + 1
+      for nshards in (1, 2, 5, 36, 50) :
+         for strategy in ('contiguous', 'round_robin', 'balanced') :
+            shards = [list(nciter.shard_hyperslabs(self.seq, shard, nshards, strategy=strategy,
+               weights=weights)) for shard in range(nshards)]
+            self.assertPartition(shards)
+
+   def test_balanced_loads(self) :
+      weights = np.arange(len(self.seq)) % 5 + 1
+      loads = [sum(weights[self.seq.index(hs)] for hs in
+         nciter.shard_hyperslabs(self.seq, shard, 4, strategy='balanced', weights=weights))
+         for shard in range(4)]
+      self.assertTrue(max(loads) - min(loads) <= max(weights))
+
+   def test_invalid_shards(self) :
+      for shard, nshards in ((None, 3), (3, 3), (-1, 3), (0, 0)) :
+         self.assertRaises(ValueError, nciter.shard_hyperslabs, self.seq, shard, nshards)
+      self.assertRaises(ValueError, nciter.shard_hyperslabs, self.seq, 0, 2, strategy='bogus')
+      self.assertRaises(ValueError, nciter.shard_hyperslabs, self.seq, 0, 2, strategy='balanced')
+
+   def test_iter_chunks(self) :
+      var = self.ds['t']
+      for strategy in ('contiguous', 'round_robin', 'balanced') :
+         shards = [[chunk.coords for chunk in nciter.iter_chunks(var, shard=shard, nshards=3,
+            strategy=strategy)] for shard in range(3)]
+         self.assertPartition(shards)
+      self.assertRaises(ValueError, list, nciter.iter_chunks(var, shard=1))
+      self.assertRaises(ValueError, list, nciter.iter_chunks(var, nshards=3))
+      self.assertRaises(ValueError, list, nciter.iter_chunks(var, shard=3, nshards=3))
+
+#---------------------------------------------------------------------------------------------------
+class TestIterChunks(unittest.TestCase) :
+#---------------------------------------------------------------------------------------------------
+   def setUp(self) :
+      self.tmpdir = tempfile.mkdtemp()
+      ncpath = os.path.join(self.tmpdir, 'iter.nc')
+      ds = netCDF4.Dataset(ncpath, 'w')
+      for name, size in (('t', 10), ('y', 20), ('x', 30)) :
+         ds.createDimension(name, size)
+      var = ds.createVariable('t', 'f4', ('t','y','x'), chunksizes=(1,10,15), fill_value=-999.0)
+      var[:] = np.ma.masked_less(np.random.RandomState(1).rand(10,20,30), 0.1)
+      ds.close()
+      self.ds = netCDF4.Dataset(ncpath)
+
+   def tearDown(self) :
+      self.ds.close()
+      shutil.rmtree(self.tmpdir)
+
+   def assertChunks(self, chunks, count) :
+      var = self.ds['t']
+      self.assertEqual(len(chunks), count)
+      for chunk in chunks :
+         self.assertTrue(np.ma.allequal(chunk.data, var[chunk.coords]))
+         self.assertTrue(np.array_equal(chunk.data.mask, np.ma.getmaskarray(var[chunk.coords])))
+
+   def test_serial(self) :
+      self.assertChunks(list(nciter.iter_chunks(self.ds['t'])), 40)
+
+   def test_threaded(self) :
+      var = self.ds['t']
+      serial = [chunk.coords for chunk in nciter.iter_chunks(var)]
+      chunks = list(nciter.iter_chunks(var, workers=4, max_inflight=3))
+      self.assertEqual([chunk.coords for chunk in chunks], serial)
+      self.assertChunks(chunks, 40)
+      chunks = list(nciter.iter_chunks(var, workers=4, ordered=False))
+      starts = sorted([s.start for s in chunk.coords] for chunk in chunks)
+      self.assertEqual(starts, [[s.start for s in coords] for coords in serial])
+      self.assertChunks(chunks, 40)
+
+   def test_threaded_without_futures(self) :
+      executor = nciter.ThreadPoolExecutor
+      nciter.ThreadPoolExecutor = None
+      try :
+         self.assertChunks(list(nciter.iter_chunks(self.ds['t'], workers=4)), 40)
+      finally :
+         nciter.ThreadPoolExecutor = executor
+
+#---------------------------------------------------------------------------------------------------
+class TestChunkPrefetcher(unittest.TestCase) :
+#---------------------------------------------------------------------------------------------------
+   def setUp(self) :
+      self.tmpdir = tempfile.mkdtemp()
+      ncpath = os.path.join(self.tmpdir, 'prefetch.nc')
+      ds = netCDF4.Dataset(ncpath, 'w')
+      for name, size in (('t', 10), ('y', 20), ('x', 30)) :
+         ds.createDimension(name, size)
+      var = ds.createVariable('t', 'f4', ('t','y','x'), chunksizes=(1,10,15))
+      var[:] = np.random.RandomState(1).rand(10,20,30)
+      ds.close()
+      self.ds = netCDF4.Dataset(ncpath)
+
+   def tearDown(self) :
+      self.ds.close()
+      shutil.rmtree(self.tmpdir)
+
+   def test_read_ahead(self) :
+      var = self.ds['t']
+      prefetcher = nciter.NcChunkPrefetcher(var, depth=3, max_bytes=2000)
+      chunks = list(prefetcher)
+      self.assertEqual([chunk.coords for chunk in chunks],
+         [chunk.coords for chunk in nciter.iter_chunks(var)])
+      for chunk in chunks :
+         self.assertTrue(np.array_equal(chunk.data, var[chunk.coords]))
+      self.assertEqual(prefetcher.nchunks, 40)
+      self.assertEqual(prefetcher.nbytes, var.size * 4)
+
+   def test_repeated_passes(self) :
+      prefetcher = nciter.NcChunkPrefetcher(self.ds['t'], depth=2)
+      for i, chunk in enumerate(prefetcher) :
+         if i == 5 : break
+      self.assertEqual(len(list(prefetcher)), 40)
+      self.assertEqual(len(list(prefetcher)), 40)
+
+   def test_concurrent_passes(self) :
+      prefetcher = nciter.NcChunkPrefetcher(self.ds['t'])
+      first = iter(prefetcher)
+      next(first)
+      self.assertRaises(RuntimeError, next, iter(prefetcher))
+      self.assertEqual(len(list(first)), 39)
+
+#---------------------------------------------------------------------------------------------------
+class TestZipChunks(unittest.TestCase) :
+#---------------------------------------------------------------------------------------------------
+   def setUp(self) :
+      self.tmpdir = tempfile.mkdtemp()
+      ncpath = os.path.join(self.tmpdir, 'zip.nc')
+      rng = np.random.RandomState(1)
+      ds = netCDF4.Dataset(ncpath, 'w')
+      for name, size in (('t', 10), ('c', 1), ('y', 20), ('x', 30)) :
+         ds.createDimension(name, size)
+      t = ds.createVariable('t', 'f4', ('t','y','x'), chunksizes=(1,10,15))
+      t[:] = rng.rand(10,20,30)
+      clim = ds.createVariable('clim', 'f4', ('c','y','x'), chunksizes=(1,10,15))
+      clim[:] = rng.rand(1,20,30)
+      u = ds.createVariable('u', 'f4', ('t','y','x'), chunksizes=(5,20,10))
+      u[:] = rng.rand(10,20,30)
+      ds.close()
+      self.ds = netCDF4.Dataset(ncpath)
+
+   def tearDown(self) :
+      self.ds.close()
+      shutil.rmtree(self.tmpdir)
+
+   def test_grids(self) :
+      t, u = self.ds['t'], self.ds['u']
+      self.assertEqual(len(list(nciter.zip_chunks(t, u))), 2)
+      cells = list(nciter.zip_chunks(t, u, grid='refine'))
+      self.assertEqual(len(cells), 80)
+      for a, b in cells :
+         self.assertEqual(a.coords, b.coords)
+         self.assertTrue(np.array_equal(a.data, t[a.coords]))
+         self.assertTrue(np.array_equal(b.data, u[b.coords]))
+
+   def test_broadcast_first(self) :
+      t, clim = self.ds['t'], self.ds['clim']
+      self.assertEqual(len(list(nciter.zip_chunks(clim, t))), 40)
+      self.assertEqual(len(list(nciter.zip_chunks(t, clim))), 40)
+      for a, b in nciter.zip_chunks(clim, t) :
+         self.assertTrue(np.array_equal(a.data, clim[a.coords]))
+         self.assertTrue(np.array_equal(b.data, t[b.coords]))
+
+#---------------------------------------------------------------------------------------------------
+class TestAggregatedVariable(unittest.TestCase) :
+#---------------------------------------------------------------------------------------------------
+   def setUp(self) :
+      self.tmpdir = tempfile.mkdtemp()
+      self.paths = []
+      for i in range(4) :
+         path = os.path.join(self.tmpdir, 'agg{0}.nc'.format(i))
+         ds = netCDF4.Dataset(path, 'w')
+         ds.createDimension('t', None)
+         ds.createDimension('x', 6)
+         var = ds.createVariable('v', 'f4', ('t','x'), chunksizes=(1,6))
+         var[:] = np.arange(30*i, 30*i+30).reshape(5,6)
+         ds.close()
+         self.paths.append(path)
+      self.expected = np.arange(120).reshape(20,6)
+
+   def tearDown(self) :
+      shutil.rmtree(self.tmpdir)
+
+   def test_iter_chunks(self) :
+      ag = nciter.AggregatedNcVariable(self.paths, 'v')
+      try :
+         self.assertEqual(ag.shape, (20,6))
+         self.assertTrue(np.array_equal(ag[3:12], self.expected[3:12]))
+         chunks = list(ag.iter_chunks())
+         self.assertEqual(len(chunks), 20)
+         for chunk in chunks :
+            self.assertTrue(np.array_equal(chunk.data, self.expected[chunk.coords]))
+      finally :
+         ag.close()
+
+   def test_eviction_during_iteration(self) :
+      ag = nciter.AggregatedNcVariable(self.paths, 'v', max_open=1)
+      try :
+         for chunk in ag.iter_chunks() :
+            self.assertTrue(np.array_equal(chunk.data, self.expected[chunk.coords]))
+            self.assertTrue(np.array_equal(ag[8:10], self.expected[8:10]))
+            self.assertTrue(np.array_equal(ag[17:19], self.expected[17:19]))
+      finally :
+         ag.close()
+
+#---------------------------------------------------------------------------------------------------
+if __name__ == '__main__':
+#---------------------------------------------------------------------------------------------------
+   unittest.main()
@@ -0,0 +1,112 @@
+"""
+Unit tests for bounded-memory rechunking.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+import netCDF4
+import numpy as np
+import ncrechunk
+
+#---------------------------------------------------------------------------------------------------
+class TestPlanRechunk(unittest.TestCase) :
+#---------------------------------------------------------------------------------------------------
+   def setUp(self) :
+      self.shape = (200, 100, 100)
+
+   def nbytes(self, shape) :
+      return int(np.prod(shape)) * 4
+
+   def test_direct(self) :
+      plan = ncrechunk.plan_rechunk(self.shape, (1,100,100), (200,10,10), 4, 2**24)
+      self.assertEqual(plan, [(200,100,100)])
+      plan = ncrechunk.plan_rechunk(self.shape, (10,50,50), (20,25,100), 4, 2**24)
+      self.assertEqual(plan, [(20,50,100)])
+
+   def test_two_stage(self) :
+      max_bytes = 4 * 1024**2
+      plan = ncrechunk.plan_rechunk(self.shape, (1,100,100), (200,10,10), 4, max_bytes)
+      self.assertEqual(len(plan), 2)
+      inter, (block1, block2) = plan
+      self.assertTrue(self.nbytes(block1) <= max_bytes)
+      self.assertTrue(self.nbytes(block2) <= max_bytes)
+      for c, a, b in zip(inter, (1,100,100), (200,10,10)) :
+         self.assertTrue(a % c == 0 or b % c == 0)
+      for blk, a, b in ((block1, (1,100,100), inter), (block2, inter, (200,10,10))) :
+         for n, x, y, m in zip(blk, a, b, self.shape) :
+            self.assertTrue(n == m or (n % x == 0 and n % y == 0))
+
+   def test_budget_too_small(self) :
+      self.assertRaises(ValueError, ncrechunk.plan_rechunk, self.shape, (1,100,100),
+         (200,10,10), 4, 1000)
+      self.assertRaises(ValueError, ncrechunk.plan_rechunk, self.shape, None, (200,10,10), 4,
+         1000)
+
+   def test_contiguous(self) :
+      max_bytes = 4 * 1024**2
+      plan = ncrechunk.plan_rechunk(self.shape, None, (200,10,10), 4, max_bytes)
+      self.assertEqual(plan, [(200,50,100)])
+      plan = ncrechunk.plan_rechunk(self.shape, (10,100,100), None, 4, max_bytes)
+      self.assertEqual(plan, [(100,100,100)])
+      plan = ncrechunk.plan_rechunk(self.shape, None, None, 4, max_bytes)
+      self.assertEqual(plan, [(104,100,100)])
+
+#---------------------------------------------------------------------------------------------------
+class TestRechunkFile(unittest.TestCase) :
+#---------------------------------------------------------------------------------------------------
+   def setUp(self) :
+      self.tmpdir = tempfile.mkdtemp()
+      self.outfile = os.path.join(self.tmpdir, 'out.nc')
+      rng = np.random.RandomState(1)
+      self.data = rng.rand(200,100,100).astype('f4')
+      self.series = rng.randint(0, 1000, (12,100)).astype('i2')
+
+   def tearDown(self) :
+      shutil.rmtree(self.tmpdir)
+
+   def create(self, fmt, **kwargs) :
+      path = os.path.join(self.tmpdir, fmt.lower() + '.nc')
+      ds = netCDF4.Dataset(path, 'w', format=fmt)
+      ds.title = 'rechunk test'
+      for name, size in (('time', None), ('lat', 100), ('lon', 100), ('level', 200)) :
+         ds.createDimension(name, size)
+      var = ds.createVariable('ta', 'f4', ('level','lat','lon'), **kwargs)
+      var.units = 'K'
+      var[:] = self.data
+      series = ds.createVariable('series', 'i2', ('time','lon'))
+      series.scale_factor = 0.1
+      series.set_auto_maskandscale(False)
+      series[:] = self.series
+      ds.close()
+      return path
+
+   def check(self, chunks) :
+      ds = netCDF4.Dataset(self.outfile)
+      try :
+         self.assertEqual(ds.title, 'rechunk test')
+         self.assertEqual(ds['ta'].chunking(), chunks)
+         self.assertEqual(ds['ta'].units, 'K')
+         self.assertTrue(np.array_equal(ds['ta'][:], self.data))
+         ds['series'].set_auto_maskandscale(False)
+         self.assertTrue(np.array_equal(ds['series'][:], self.series))
+      finally :
+         ds.close()
+
+   def test_classic(self) :
+      infile = self.create('NETCDF3_CLASSIC')
+      ncrechunk.rechunk_file(infile, self.outfile, chunks=dict(lat=10, lon=10),
+         max_bytes=4*1024**2)
+      self.check([200,10,10])
+
+   def test_two_stage(self) :
+      infile = self.create('NETCDF4', chunksizes=(1,100,100), zlib=True)
+      ncrechunk.rechunk_file(infile, self.outfile, chunks=dict(level=200, lat=10, lon=10),
+         max_bytes=1024**2, tmpdir=self.tmpdir)
+      self.check([200,10,10])
+      self.assertEqual(sorted(os.listdir(self.tmpdir)), ['netcdf4.nc', 'out.nc'])
+
+#---------------------------------------------------------------------------------------------------
+if __name__ == '__main__':
+#---------------------------------------------------------------------------------------------------
+   unittest.main()
@@ -0,0 +1,68 @@
+"""
+Unit tests for chunk sampling and approximate statistics.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+import netCDF4
+import numpy as np
+import nciter
+import ncsample
+
+#---------------------------------------------------------------------------------------------------
+class TestChunkSampling(unittest.TestCase) :
+#---------------------------------------------------------------------------------------------------
+   def setUp(self) :
+      self.tmpdir = tempfile.mkdtemp()
+      ncpath = os.path.join(self.tmpdir, 'sample.nc')
+      ds = netCDF4.Dataset(ncpath, 'w')
+      for name, size in (('t', 10), ('y', 20), ('x', 30)) :
+         ds.createDimension(name, size)
+      var = ds.createVariable('t', 'f4', ('t','y','x'), chunksizes=(1,10,15), fill_value=-999.0)
+      var[:] = np.ma.masked_less(np.random.RandomState(1).rand(10,20,30), 0.1)
+      ds.close()
+      self.ds = netCDF4.Dataset(ncpath)
+
+   def tearDown(self) :
+      self.ds.close()
+      shutil.rmtree(self.tmpdir)
+
+   def test_sample_hyperslabs(self) :
+      hyperslabs = nciter.HyperslabSequence((10,20,30), (1,10,15))
+      for method in ('random', 'stratified', 'systematic') :
+         sample = ncsample.sample_hyperslabs(hyperslabs, nsamples=8, method=method, seed=3)
+         self.assertEqual(len(sample), 8)
+         self.assertEqual(sample, ncsample.sample_hyperslabs(hyperslabs, nsamples=8,
+            method=method, seed=3))
+         numbers = [hyperslabs.index(hs) for hs in sample]
+         self.assertEqual(numbers, sorted(numbers))
+      self.assertRaises(ValueError, ncsample.sample_hyperslabs, hyperslabs, method='bogus')
+
+   def test_sample_chunks(self) :
+      var = self.ds['t']
+      chunks = list(ncsample.sample_chunks(var, nsamples=5, seed=1, region=(slice(0,5),),
+         mask='separate'))
+      self.assertEqual(len(chunks), 5)
+      for chunk in chunks :
+         self.assertTrue(chunk.coords[0].stop <= 5)
+         self.assertTrue(np.array_equal(chunk.mask, np.ma.getmaskarray(var[chunk.coords])))
+
+   def test_estimate_stats(self) :
+      var = self.ds['t']
+      stats = ncsample.estimate_stats(var, fraction=0.5, seed=1, nboot=20, region=(slice(0,5),))
+      self.assertEqual(stats.nchunks, 20)
+      self.assertEqual(stats.nsampled, 10)
+      self.assertTrue(stats.mean_ci[0] <= stats.mean <= stats.mean_ci[1])
+      self.assertTrue(0 < stats.missing_fraction < 0.5)
+      stats = ncsample.estimate_stats(var, fraction=1.0, nboot=5, target_bytes=10**6)
+      data = var[:]
+      self.assertEqual(stats.nsampled, 1)
+      self.assertTrue(np.isclose(stats.mean, data.mean()))
+      missing = np.ma.count_masked(data) / float(data.size)
+      self.assertTrue(np.isclose(stats.missing_fraction, missing))
+
+#---------------------------------------------------------------------------------------------------
+if __name__ == '__main__':
+#---------------------------------------------------------------------------------------------------
+   unittest.main()
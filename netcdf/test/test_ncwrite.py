@@ -0,0 +1,128 @@
+"""
+Unit tests for the chunk writer and variable copying.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+import netCDF4
+import numpy as np
+import nciter
+import ncwrite
+
+#---------------------------------------------------------------------------------------------------
+class TestNcChunkWriter(unittest.TestCase) :
+#---------------------------------------------------------------------------------------------------
+   def setUp(self) :
+      self.tmpdir = tempfile.mkdtemp()
+      self.ds = netCDF4.Dataset(os.path.join(self.tmpdir, 'write.nc'), 'w')
+      for name, size in (('t', None), ('y', 20), ('x', 30)) :
+         self.ds.createDimension(name, size)
+      self.data = np.random.RandomState(1).rand(6,20,30).astype('f4')
+
+   def tearDown(self) :
+      self.ds.close()
+      shutil.rmtree(self.tmpdir)
+
+   def blocks(self, shape) :
+      return nciter.HyperslabSequence(self.data.shape, shape)
+
+   def test_plain_arrays(self) :
+      var = self.ds.createVariable('v', 'f4', ('t','y','x'), chunksizes=(2,10,10))
+      with ncwrite.NcChunkWriter(var) as writer :
+         for hs in self.blocks((1,7,30)) :
+            writer.write(self.data[hs], hs)
+      self.assertTrue(np.array_equal(var[:], self.data))
+      self.assertEqual(writer.nchunks_written, 18)
+      self.assertEqual(writer.npartial, 0)
+
+   def test_chunks(self) :
+      var = self.ds.createVariable('v', 'f4', ('t','y','x'), chunksizes=(2,10,10),
+         fill_value=-1.0)
+      mask = self.data < 0.2
+      with ncwrite.NcChunkWriter(var, max_bytes=10000) as writer :
+         for hs in self.blocks((3,20,15)) :
+            if hs[2].start == 0 :
+               writer.write(nciter.NcDataChunk(np.ma.MaskedArray(self.data[hs], mask[hs]), hs))
+            else :
+               writer.write(nciter.NcDataChunk(self.data[hs], hs, mask=mask[hs]))
+      result = var[:]
+      self.assertTrue(np.array_equal(result.mask, mask))
+      self.assertTrue(np.array_equal(result.compressed(), self.data[~mask]))
+
+   def test_contiguous(self) :
+      var = self.ds.createVariable('v', 'f4', ('y','x'), contiguous=True)
+      writer = ncwrite.write_chunks(var, (nciter.NcDataChunk(self.data[0][hs], hs) for hs in
+         nciter.HyperslabSequence((20,30), (7,7))))
+      self.assertTrue(np.array_equal(var[:], self.data[0]))
+      self.assertEqual(writer.nchunks_written, 15)
+
+   def test_missing_coords(self) :
+      var = self.ds.createVariable('v', 'f4', ('t','y','x'))
+      writer = ncwrite.NcChunkWriter(var)
+      self.assertRaises(ValueError, writer.write, self.data)
+
+#---------------------------------------------------------------------------------------------------
+class TestCopyVariable(unittest.TestCase) :
+#---------------------------------------------------------------------------------------------------
+   def setUp(self) :
+      self.tmpdir = tempfile.mkdtemp()
+      self.data = np.random.RandomState(1).rand(20,30,40).astype('f4')
+      self.read_chunk = nciter.read_chunk
+      self.reads = []
+
+   def tearDown(self) :
+      nciter.read_chunk = self.read_chunk
+      shutil.rmtree(self.tmpdir)
+
+   def create(self, fmt, **kwargs) :
+      path = os.path.join(self.tmpdir, fmt.lower() + '.nc')
+      ds = netCDF4.Dataset(path, 'w', format=fmt)
+      for name, size in (('t', 20), ('y', 30), ('x', 40)) :
+         ds.createDimension(name, size)
+      var = ds.createVariable('v', 'f4', ('t','y','x'), **kwargs)
+      var.units = 'K'
+      var[:] = self.data
+      ds.close()
+      return path
+
+   def record_reads(self) :
+      def read_chunk(var, hyperslab, mask='ma') :
+         self.reads.append(hyperslab)
+         return self.read_chunk(var, hyperslab, mask)
+      nciter.read_chunk = read_chunk
+
+   def copy(self, path, **kwargs) :
+      src = netCDF4.Dataset(path)
+      dst = netCDF4.Dataset(os.path.join(self.tmpdir, 'copy.nc'), 'w')
+      try :
+         var = ncwrite.copy_variable(src['v'], dst, **kwargs)
+         self.assertEqual(var.units, 'K')
+         self.assertTrue(np.array_equal(var[:], self.data))
+         return var.chunking()
+      finally :
+         src.close()
+         dst.close()
+
+   def test_chunked(self) :
+      path = self.create('NETCDF4', chunksizes=(5,10,10), zlib=True)
+      self.assertEqual(self.copy(path, workers=3), [5,10,10])
+      self.assertEqual(self.copy(path, chunksizes=(20,5,5)), [20,5,5])
+
+   def test_contiguous_source(self) :
+      for fmt in ('NETCDF3_CLASSIC', 'NETCDF4') :
+         path = self.create(fmt, contiguous=True) if fmt == 'NETCDF4' else self.create(fmt)
+         self.record_reads()
+         del self.reads[:]
+         self.copy(path, max_bytes=20000)
+         self.assertEqual(len(self.reads), 5)
+         for hs in self.reads :
+            self.assertTrue(np.prod([s.stop - s.start for s in hs]) * 4 <= 20000)
+         del self.reads[:]
+         self.copy(path, target_bytes=4800, chunksizes=(1,10,40))
+         self.assertEqual(len(self.reads), 20)
+
+#---------------------------------------------------------------------------------------------------
+if __name__ == '__main__':
+#---------------------------------------------------------------------------------------------------
+   unittest.main()